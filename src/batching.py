@@ -0,0 +1,159 @@
+"""
+File: batching.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Batches concurrent inference requests together before they are run through the trained models.
+
+Running the stage and locations models on one image at a time leaves most of the CPU idle, and concurrent queries
+end up waiting on each other anyway. The InferenceScheduler defined here collects the images submitted by concurrent
+queries for a short window (or until a maximum batch size is reached), runs each model once on the whole batch, and
+hands each caller back its own predictions. Statistics on batch sizes and queue waits are kept for monitoring.
+"""
+
+## Libraries
+import os
+import queue
+import threading
+import time
+from collections import Counter
+from concurrent.futures import Future
+from typing import Callable, Dict, Sequence
+import torch
+
+## Settings
+# Disables autograd while the models run: inference mode where torch has it (which also skips the bookkeeping for
+# in-place operations), otherwise no_grad
+inference_mode = getattr(torch, "inference_mode", torch.no_grad)
+
+## Objects
+class _Request():
+    "A single image submitted to the scheduler, along with the models it needs and where to send the results."
+    __slots__ = ("x", "outputs", "future", "submitted")
+    def __init__(self, x, outputs):
+        self.x = x
+        self.outputs = tuple(outputs)
+        self.future = Future()
+        self.submitted = time.perf_counter()
+
+class InferenceScheduler():
+    """
+    Runs the models on batches of concurrently submitted images.
+
+    Arguments:
+    - models: a dictionary mapping output names (e.g. "stage", "locations") to functions which accept a batch of
+    images (a tensor of shape (bs, channels, height, width)) and return a tensor of predictions with one row per image
+    - max_batch_size: the largest number of images run through the models at once
+    - max_wait: the longest time (in seconds) the first image in a batch waits for others to join it
+    - on_batch: optionally, a function called with (batch size, list of each image's queue wait in seconds) for each
+    batch, e.g. to record metrics
+
+    Images are submitted with `predict` (blocking) or `submit` (returns a Future). A background thread collects them
+    into batches, runs each model needed by the batch once (in inference mode), and splits the predictions
+    back out to the callers. The thread is started on the first submission in each process, so a scheduler created
+    before a server forks its worker processes (see serving.py) works in each of them.
+    """
+    def __init__(self, models:Dict[str, Callable], max_batch_size:int=8, max_wait:float=0.005, on_batch:Callable=None):
+        self.models = models
+        self.on_batch = on_batch
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max(0., max_wait)
+        self._stats_lock = threading.Lock()
+        self._batch_sizes = Counter()
+        self._total_queue_wait = 0.
+        self._max_queue_wait = 0.
+        self._worker_pid = None
+        self._start_lock = threading.Lock()
+
+    def _start_worker(self):
+        "Starts the worker thread (and its queue) if it isn't running in this process yet."
+        if self._worker_pid == os.getpid(): return
+        with self._start_lock:
+            if self._worker_pid == os.getpid(): return
+            # Threads and queued requests aren't carried over into forked processes
+            self._queue = queue.Queue()
+            self._worker = threading.Thread(target=self._run, name="inference-scheduler", daemon=True)
+            self._worker.start()
+            self._worker_pid = os.getpid()
+
+    def submit(self, x, outputs:Sequence[str]=None) -> Future:
+        """
+        Submits an image to be predicted on.
+
+        Arguments:
+        - x: the image as a tensor of shape (1, channels, height, width), or (channels, height, width)
+        - outputs: the names of the models to run on the image. Defaults to all of them.
+
+        Returns:
+        A Future which resolves to a tuple of predictions (one for each of `outputs`, in order), each a tensor with a
+        leading batch dimension of 1.
+        """
+        if x.dim() == 3: x = x.unsqueeze(0)
+        self._start_worker()
+        request = _Request(x, self.models.keys() if outputs is None else outputs)
+        self._queue.put(request)
+        return request.future
+
+    def predict(self, x, outputs:Sequence[str]=None) -> tuple:
+        "Submits an image (see `submit`) and waits for its predictions."
+        return self.submit(x, outputs).result()
+
+    def _collect_batch(self):
+        "Blocks until at least one request is queued, then collects requests until the batch is full or time is up."
+        batch = [self._queue.get()]
+        deadline = time.perf_counter() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.perf_counter()
+            try:
+                batch.append(self._queue.get(timeout=remaining) if remaining > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        "Worker loop: collects batches and runs them through the models."
+        while True:
+            batch = self._collect_batch()
+            started = time.perf_counter()
+            self._record(batch, started)
+            try:
+                results = self._run_batch(batch)
+            except Exception as e:
+                for request in batch: request.future.set_exception(e)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+
+    def _run_batch(self, batch):
+        "Runs each model needed by the batch once, and returns each request's predictions."
+        results = [[] for _ in batch]
+        with inference_mode():
+            for name, model in self.models.items():
+                needed = [i for i, request in enumerate(batch) if name in request.outputs]
+                if not needed: continue
+                preds = model(torch.cat([batch[i].x for i in needed]))
+                for row, i in enumerate(needed):
+                    results[i].append((name, preds[row:row+1]))
+        # Order each request's predictions as it asked for them
+        return [tuple(dict(res)[name] for name in request.outputs) for request, res in zip(batch, results)]
+
+    def _record(self, batch, started):
+        "Updates the batch size and queue wait statistics."
+        waits = [started - request.submitted for request in batch]
+        with self._stats_lock:
+            self._batch_sizes[len(batch)] += 1
+            self._total_queue_wait += sum(waits)
+            self._max_queue_wait = max(self._max_queue_wait, max(waits))
+        if self.on_batch is not None: self.on_batch(len(batch), waits)
+
+    def stats(self) -> dict:
+        """
+        Returns statistics on the batches run so far: the number of batches and images, the mean batch size, the
+        number of batches of each size, and the mean and max time (in seconds) images waited in the queue.
+        """
+        with self._stats_lock:
+            batches = sum(self._batch_sizes.values())
+            images = sum(size*count for size, count in self._batch_sizes.items())
+            return {"batches": batches, "images": images,
+                    "mean_batch_size": images/batches if batches else 0.,
+                    "batch_size_counts": dict(sorted(self._batch_sizes.items())),
+                    "mean_queue_wait": self._total_queue_wait/images if images else 0.,
+                    "max_queue_wait": self._max_queue_wait}
@@ -0,0 +1,259 @@
+"""
+File: candidate_index.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Finds the database images most similar to an input embryo without scanning the whole database.
+
+The RankingEngine (see ranking.py) computes the similarity of every database image on every query, which grows
+linearly with the database. The CandidateIndex defined here only scores a small set of candidates:
+- A stage index: the database stages in sorted order, so the images closest in stage are found by binary search
+- An IVF (inverted file) index on the locations vectors: the vectors are clustered with k-means, and only the
+images in the clusters closest to the input embryo's locations vector are considered
+
+The candidates from both indexes are then reranked exactly, with the same z-scored, alpha-weighted blend of stage
+and locations similarity as the default algorithm (see `embryo_similarity` in search.py). The z-scores are over the
+whole database, as in the exact ranking: the stage similarity statistics are computed exactly from prefix sums of
+the sorted stages, and the locations similarity statistics are estimated from a fixed random sample of rows.
+
+The results are approximate: an image can be missed if it is neither close in stage nor in one of the probed
+clusters. `recall_at_n` measures how many of the exact top n are found; `nprobe`, `stage_candidates` and
+`stats_sample` trade speed for recall.
+
+When rows are appended to the database, `extend` only places the new rows in the existing indexes (the clusters are
+retrained once the database has grown enough since they were last trained).
+"""
+
+## Libraries
+from typing import Tuple
+import numpy as np
+from ranking import is_constant
+
+## Objects
+class CandidateIndex():
+    """
+    Indexes the database predictions for approximate top-n search.
+
+    Arguments:
+    - stages: the saved stage predictions of the database images, shape (N,) or (N, 1)
+    - locations: the saved locations predictions of the database images, shape (N, number of locations). These are
+    used in place (e.g. memory-mapped, at float16) and only the candidates' rows are read on a query.
+    - nlist: the number of IVF clusters. Defaults to about sqrt(N).
+    - nprobe: the number of clusters searched per query. More clusters give better recall, but are slower.
+    - stage_candidates: the number of images closest in stage considered per query (half on either side)
+    - stats_sample: the number of rows sampled to estimate the mean and standard deviation of the locations
+    similarity. Larger samples give z-scores closer to the exact ones, but are slower.
+    - train_size: the largest number of rows k-means is trained on
+    - retrain_factor: `extend` retrains the clusters once the database is this many times larger than when they
+    were trained
+    - seed: the random seed for k-means and the statistics sample
+
+    Indexes are never modified once built, so one index can be shared by concurrent requests.
+    """
+    def __init__(self, stages, locations, nlist:int=None, nprobe:int=8, stage_candidates:int=2048,
+                 stats_sample:int=8192, train_size:int=65536, retrain_factor:float=2., seed:int=0):
+        self.nprobe, self.stage_candidates, self.stats_sample = nprobe, stage_candidates, stats_sample
+        self.train_size, self.retrain_factor, self.seed = train_size, retrain_factor, seed
+        self.nlist = nlist
+        self._set_arrays(stages, locations)
+        rng = np.random.default_rng(seed)
+        # Stage index
+        self.stage_order = np.argsort(self.stages, kind="stable")
+        self._update_stage_sums()
+        # IVF index on the locations vectors
+        self.centroids = _train_kmeans(self.locations, nlist or _default_nlist(len(self)), train_size, rng)
+        self.trained_size = len(self)
+        self.assignments, self.sq_norms = _assign(self.locations, self.centroids)
+        self._update_lists()
+        # Rows the locations similarity statistics are estimated from
+        self._set_sample(np.sort(rng.choice(len(self), size=min(stats_sample, len(self)), replace=False)))
+
+    def __len__(self): return len(self.stages)
+
+    def _set_arrays(self, stages, locations):
+        self.stages = np.asarray(stages, dtype=np.float32).reshape(-1)
+        self.locations = np.asarray(locations)
+        assert len(self.stages) == len(self.locations)
+
+    def _update_stage_sums(self):
+        "Computes the sorted stages and their prefix sums, used for exact stage similarity statistics."
+        self.sorted_stages = self.stages[self.stage_order]
+        self.stage_prefix_sums = np.concatenate([[0.], np.cumsum(self.sorted_stages, dtype=np.float64)])
+        self.stage_sum_sq = float(np.dot(self.stages.astype(np.float64), self.stages.astype(np.float64)))
+
+    def _update_lists(self):
+        "Groups the rows by cluster: the rows of cluster c are list_rows[list_offsets[c]:list_offsets[c+1]]."
+        self.list_rows = np.argsort(self.assignments, kind="stable")
+        counts = np.bincount(self.assignments, minlength=len(self.centroids))
+        self.list_offsets = np.concatenate([[0], np.cumsum(counts)])
+
+    def _set_sample(self, sample:np.ndarray):
+        "Sets the rows the locations similarity statistics are estimated from, keeping a float32 copy of them."
+        self.sample = sample
+        self.sample_locations = np.asarray(self.locations[sample], dtype=np.float32)
+        self.sample_sq_norms = self.sq_norms[sample]
+
+    def extend(self, stages, locations) -> "CandidateIndex":
+        """
+        Returns an index of a database that has had rows appended to this index's database. `stages` and
+        `locations` are the predictions of the whole new database, whose first len(self) rows must be the rows this
+        index was built on. Only the new rows are placed in the indexes; the clusters are retrained if the database
+        has grown by `retrain_factor` since they were trained. This index is left unchanged.
+        """
+        index = object.__new__(CandidateIndex)
+        index.__dict__.update(self.__dict__)
+        index._set_arrays(stages, locations)
+        old_size, new_size = len(self), len(index)
+        assert new_size >= old_size, "Rows can only be appended to an indexed database"
+        if new_size == old_size: return index
+        rng = np.random.default_rng((self.seed, new_size))
+        new_rows = np.arange(old_size, new_size)
+        # Stage index: merge the new rows into the sorted order
+        new_order = new_rows[np.argsort(index.stages[old_size:], kind="stable")]
+        positions = np.searchsorted(self.sorted_stages, index.stages[new_order], side="right")
+        index.stage_order = np.insert(self.stage_order, positions, new_order)
+        index._update_stage_sums()
+        # IVF index: assign the new rows to their clusters, or retrain the clusters if the database has grown enough
+        if new_size >= self.retrain_factor*self.trained_size:
+            index.centroids = _train_kmeans(index.locations, self.nlist or _default_nlist(new_size),
+                                            self.train_size, rng)
+            index.trained_size = new_size
+            index.assignments, index.sq_norms = _assign(index.locations, index.centroids)
+        else:
+            assignments, sq_norms = _assign(index.locations[old_size:], self.centroids)
+            index.assignments = np.concatenate([self.assignments, assignments])
+            index.sq_norms = np.concatenate([self.sq_norms, sq_norms])
+        index._update_lists()
+        # Statistics sample: keep it a uniform sample of the rows (reservoir sampling)
+        sample, k = self.sample.copy(), self.stats_sample
+        if len(sample) < k:
+            sample = np.concatenate([sample, new_rows[:k-len(sample)]])
+            new_rows = new_rows[k-len(self.sample):]
+        if len(new_rows):
+            slots = rng.integers(0, new_rows + 1)
+            replaced = slots < k
+            sample[slots[replaced]] = new_rows[replaced]
+        index._set_sample(np.sort(sample))
+        return index
+
+    def candidates(self, stage_pred:float, locations_pred:np.ndarray) -> np.ndarray:
+        "Returns the (sorted, unique) rows of the images closest in stage or in the closest clusters."
+        # The images closest in stage lie on either side of the input stage in the sorted order
+        middle = np.searchsorted(self.sorted_stages, stage_pred)
+        half = self.stage_candidates // 2
+        stage_rows = self.stage_order[max(0, middle-half):middle+half]
+        # The images in the clusters whose centroids are closest to the input locations vector
+        centroid_dists = ((self.centroids - locations_pred)**2).sum(axis=1)
+        nprobe = min(self.nprobe, len(self.centroids))
+        probed = np.argpartition(centroid_dists, nprobe-1)[:nprobe]
+        cluster_rows = [self.list_rows[self.list_offsets[c]:self.list_offsets[c+1]] for c in probed]
+        rows = np.sort(np.concatenate([stage_rows] + cluster_rows))
+        return rows[np.concatenate([[True], rows[1:] != rows[:-1]])]
+
+    def stage_stats(self, stage_pred:float) -> Tuple[float, float]:
+        """
+        Returns the exact mean and (sample) standard deviation of the stage similarity, -|stage - stage_pred|, over the
+        whole database, computed from the prefix sums of the sorted stages.
+        """
+        count = len(self)
+        below = np.searchsorted(self.sorted_stages, stage_pred)
+        below_sum, total = self.stage_prefix_sums[below], self.stage_prefix_sums[-1]
+        abs_sum = (stage_pred*below - below_sum) + (total - below_sum - stage_pred*(count - below))
+        sq_sum = self.stage_sum_sq - 2*stage_pred*total + count*stage_pred**2
+        mean = -abs_sum/count
+        var = (sq_sum - count*mean**2)/(count-1) if count > 1 else 0.
+        return mean, float(np.sqrt(max(var, 0.)))
+
+    def locations_stats(self, locations_pred:np.ndarray) -> Tuple[float, float]:
+        "Estimates the mean and standard deviation of the locations similarity over the database, from the sample."
+        sims = _locations_sims(self.sample_locations, self.sample_sq_norms, locations_pred)
+        return float(sims.mean()), float(sims.std(ddof=1)) if len(sims) > 1 else 0.
+
+    def top_n(self, stage_pred, locations_pred, n:int, alpha:float=0.5) -> np.ndarray:
+        """
+        Returns the rows of (approximately) the `n` database images most similar to the input embryo, from most to
+        least similar, by the same combined score as RankingEngine.top_n. If there are fewer than `n` candidates,
+        all of them are returned.
+
+        Arguments:
+        - stage_pred: the input embryo's stage prediction (a single value)
+        - locations_pred: the input embryo's locations prediction (a vector)
+        - n: the number of most similar images to return
+        - alpha: the percent weight given to the stage similarity
+        """
+        stage_pred = float(np.asarray(stage_pred, dtype=np.float32).reshape(-1)[0])
+        locations_pred = np.asarray(locations_pred, dtype=np.float32).reshape(-1)
+        rows = self.candidates(stage_pred, locations_pred)
+        # Rerank the candidates exactly, with z-scores over the whole database
+        stage_mean, stage_std = self.stage_stats(stage_pred)
+        locations_mean, locations_std = self.locations_stats(locations_pred)
+        scores = np.zeros(len(rows), dtype=np.float32)
+        if not is_constant(stage_mean, stage_std):
+            scores += alpha*(-np.abs(self.stages[rows] - stage_pred) - stage_mean)/stage_std
+        if not is_constant(locations_mean, locations_std):
+            locations_sims = _locations_sims(self.locations[rows], self.sq_norms[rows], locations_pred)
+            scores += (1-alpha)*(locations_sims - locations_mean)/locations_std
+        n = max(0, min(n, len(rows)))
+        if n == 0: return rows[:0]
+        top = np.argpartition(-scores, n-1)[:n]
+        return rows[top[np.lexsort((top, -scores[top]))]]
+
+## Functions
+def recall_at_n(index:CandidateIndex, ranking_engine, stage_preds, locations_preds, n:int=50,
+                alpha:float=0.5) -> float:
+    """
+    Returns the mean fraction of the exact top `n` images (from `ranking_engine.top_n`, see ranking.py) that the
+    index also returns in its top `n`, over the given input embryos (stage_preds of shape (Q,) or (Q, 1), and
+    locations_preds of shape (Q, number of locations)).
+    """
+    stage_preds = np.asarray(stage_preds, dtype=np.float32).reshape(-1)
+    locations_preds = np.asarray(locations_preds, dtype=np.float32).reshape(len(stage_preds), -1)
+    recalls = []
+    for stage_pred, locations_pred in zip(stage_preds, locations_preds):
+        exact = ranking_engine.top_n(stage_pred, locations_pred, n=n, alpha=alpha).numpy()
+        approximate = index.top_n(stage_pred, locations_pred, n=n, alpha=alpha)
+        recalls.append(len(np.intersect1d(exact, approximate))/max(1, len(exact)))
+    return float(np.mean(recalls)) if recalls else 1.
+
+def _default_nlist(count:int) -> int:
+    return max(1, int(np.sqrt(count)))
+
+def _locations_sims(rows, sq_norms:np.ndarray, locations_pred:np.ndarray) -> np.ndarray:
+    """
+    Euclidean locations similarity, 1/(1 + distance), of `rows` (with squared norms `sq_norms`) to the input
+    locations vector, using ||a-b||^2 = ||a||^2 - 2a.b + ||b||^2.
+    """
+    sq_dists = sq_norms - 2*(np.asarray(rows, dtype=np.float32) @ locations_pred) + locations_pred @ locations_pred
+    return 1/(1 + np.sqrt(np.maximum(sq_dists, 0)))
+
+def _assign(locations, centroids:np.ndarray, chunk_size:int=65536) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Returns the index of the closest centroid to each row of `locations`, and the squared norm of each row. Rows are
+    converted to float32 a chunk at a time.
+    """
+    assignments = np.empty(len(locations), dtype=np.int32)
+    sq_norms = np.empty(len(locations), dtype=np.float32)
+    centroid_sq_norms = (centroids*centroids).sum(axis=1)
+    for start in range(0, len(locations), chunk_size):
+        chunk = np.asarray(locations[start:start+chunk_size], dtype=np.float32)
+        # ||x - c||^2 = ||x||^2 - 2x.c + ||c||^2, and ||x||^2 doesn't affect which centroid is closest
+        assignments[start:start+len(chunk)] = (centroid_sq_norms - 2*chunk @ centroids.T).argmin(axis=1)
+        sq_norms[start:start+len(chunk)] = (chunk*chunk).sum(axis=1)
+    return assignments, sq_norms
+
+def _train_kmeans(locations, k:int, train_size:int, rng, iterations:int=10) -> np.ndarray:
+    "Clusters (a random sample of up to `train_size` rows of) `locations` into `k` clusters, returning the centroids."
+    rows = np.sort(rng.choice(len(locations), size=min(train_size, len(locations)), replace=False))
+    sample = np.asarray(locations[rows], dtype=np.float32)
+    k = max(1, min(k, len(sample)))
+    centroids = sample[rng.choice(len(sample), size=k, replace=False)].copy()
+    for _ in range(iterations):
+        assignments, _ = _assign(sample, centroids)
+        counts = np.bincount(assignments, minlength=k)
+        # Sum each cluster's rows, by sorting the rows by cluster
+        order = np.argsort(assignments, kind="stable")
+        starts = np.cumsum(counts) - counts
+        # Clusters left empty are restarted at random rows
+        empty = counts == 0
+        sums = np.add.reduceat(sample[order], starts[~empty], axis=0)
+        centroids[~empty] = sums/counts[~empty, None]
+        centroids[empty] = sample[rng.choice(len(sample), size=empty.sum())]
+    return centroids
@@ -0,0 +1,33 @@
+"""
+File: convert-predictions.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Description: Converts the legacy pickled predictions (data/database-image-predictions.pkl) into the memory-mapped
+prediction store (data/predictions) that search.py and update-data.py read from. See prediction_store.py.
+
+This only needs to be run once. search.py and update-data.py also convert the pickle automatically if the store
+doesn't exist yet. An optional command-line argument gives the type to store predictions as ("float32", the
+default, or "float16", which halves the store's size and memory use):
+
+python src/convert-predictions.py # Convert, storing predictions as float32
+python src/convert-predictions.py float16 # Convert, storing predictions as float16
+"""
+
+import os
+import sys
+from prediction_store import convert_pickle
+
+# Grab storage type from command line
+if len(sys.argv) == 1:
+    dtype = "float32"
+elif len(sys.argv) == 2:
+    dtype = sys.argv[1]
+else:
+    raise TypeError("Too many command line arguments (one allowed)")
+
+# Change working directory to src/
+current_file_filepath = os.path.abspath(__file__)
+dname = os.path.dirname(current_file_filepath)
+os.chdir(dname)
+
+manifest = convert_pickle("../data/database-image-predictions.pkl", "../data/predictions", dtype=dtype)
+print(f"Converted {manifest['count']} images to data/predictions (version {manifest['version']}, {manifest['dtype']})")
@@ -0,0 +1,139 @@
+"""
+File: cursor_cache.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Caches the rankings of recent searches, so later pages of their results are served without ranking again.
+
+The GEISHA UI shows search results a page at a time. Without a cache, every page would mean ranking the whole
+database again (and, for images that aren't in it, running the models again). Instead, the first page of a search
+ranks past it (see `paged_similarity` in search.py), and the ranking is kept here as a cursor: the database rows of
+the top results, in order. Later pages are slices of it.
+
+Cursors are keyed by everything the ranking depends on (a CursorKey):
+- The input embryo's features (its stage and locations predictions, hashed with `hash_features`). Two searches for
+the same image, or for images with identical predictions, share a cursor.
+- The weight given to stage similarity (alpha)
+- The search filter (see filters.py)
+- The version of the prediction database that was ranked
+
+The CursorCache defined here is bounded in memory (the least recently used cursors are evicted first) and in time
+(cursors expire a while after they were created). Cursors for older versions of the database are dropped as soon
+as a newer version is seen, so a page is never served from a ranking of stale predictions.
+"""
+
+## Libraries
+import hashlib
+import threading
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Any, Optional
+import numpy as np
+import torch
+
+## Objects
+class CursorKey(NamedTuple):
+    "Identifies a ranking: the input embryo's features (see `hash_features`), alpha, search filter and database version."
+    features: str
+    alpha: float
+    search_filter: Any
+    version: int
+
+class Cursor(NamedTuple):
+    """
+    The ranking of a search: the database rows of its top results, from most to least similar. `complete` is True if
+    the rows are every result of the search (so there are no more pages past them).
+    """
+    rows: np.ndarray
+    complete: bool
+
+class CursorCache():
+    """
+    A thread-safe cache of Cursors, bounded in memory and time.
+
+    Arguments:
+    - max_bytes: the memory the cursors' rows may take up in total (plus a small allowance per cursor). The least
+    recently used cursors are evicted to stay under it. 0 disables the cache.
+    - ttl: the number of seconds a cursor is kept after it is created
+
+    Hits, misses, evictions and expirations are counted so the cache's effectiveness can be monitored.
+    """
+    # Memory counted for each cursor on top of its rows (its key, entry and bookkeeping)
+    ENTRY_OVERHEAD = 512
+
+    def __init__(self, max_bytes:int=64*2**20, ttl:float=600.):
+        self.max_bytes, self.ttl = max_bytes, ttl
+        self.version = None
+        self.bytes = 0
+        self.hits = self.misses = self.evictions = self.expirations = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key:CursorKey) -> Optional[Cursor]:
+        "Returns the cursor saved under `key` (marking it as recently used), or None if it isn't cached or has expired."
+        with self._lock:
+            self._check_version(key.version)
+            entry = self._entries.get(key)
+            if entry is not None and entry[1] <= time.monotonic():
+                self._remove(key)
+                self.expirations += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key:CursorKey, cursor:Cursor):
+        "Saves `cursor` under `key`, evicting the least recently used cursors if the cache is full."
+        size = cursor.rows.nbytes + self.ENTRY_OVERHEAD
+        if size > self.max_bytes: return
+        with self._lock:
+            self._check_version(key.version)
+            # Rankings of an older version of the database won't be asked for again
+            if key.version != self.version: return
+            if key in self._entries: self._remove(key)
+            self._entries[key] = (cursor, time.monotonic() + self.ttl, size)
+            self.bytes += size
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+
+    def clear(self):
+        "Empties the cache and resets its counters."
+        with self._lock:
+            self._entries.clear()
+            self.version, self.bytes = None, 0
+            self.hits = self.misses = self.evictions = self.expirations = 0
+
+    def stats(self) -> dict:
+        "Returns the cache's size (cursors and bytes), capacity, and hit/miss/eviction/expiration counts."
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "bytes": self.bytes, "max_bytes": self.max_bytes, "hits": self.hits,
+                    "misses": self.misses, "evictions": self.evictions, "expirations": self.expirations,
+                    "hit_rate": self.hits/lookups if lookups else 0.}
+
+    def _check_version(self, version:int):
+        "Drops every cursor if a newer version of the database has been published (called with the lock held)."
+        if self.version is not None and version <= self.version: return
+        self._entries.clear()
+        self.version, self.bytes = version, 0
+
+    def _remove(self, key:CursorKey):
+        self.bytes -= self._entries.pop(key)[2]
+
+    def __len__(self): return len(self._entries)
+    def __contains__(self, key): return key in self._entries
+
+## Functions
+def hash_features(stage_pred, locations_pred) -> str:
+    "Returns the SHA-1 hex digest of an input embryo's stage and locations predictions (as float32)."
+    digest = hashlib.sha1()
+    for pred in (stage_pred, locations_pred):
+        digest.update(torch.as_tensor(pred).detach().float().cpu().contiguous().numpy().tobytes())
+    return digest.hexdigest()
+
+def compact_rows(rows) -> np.ndarray:
+    "Returns database rows (a tensor or array) as the smallest integer array that holds them, to keep cursors small."
+    rows = np.asarray(rows)
+    return rows.astype(np.int32) if len(rows) and rows.max() < 2**31 else rows
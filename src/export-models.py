@@ -0,0 +1,49 @@
+"""
+File: export-models.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Description: Exports the trained stage and locations models to TorchScript, for faster inference on the CPU.
+
+Each model in models/ is traced and frozen into the variants given as command-line arguments (all of them by
+default), which are saved to models/torchscript (see model_export.py):
+- fp32: the model as trained
+- int8: the model with its linear layers dynamically quantized to int8
+- channels_last: the model run on channels-last tensors
+
+python src/export-models.py # Export every variant
+python src/export-models.py fp32 int8 # Export the fp32 and int8 variants
+
+Set GEISHA_MODEL_RUNTIME to a variant to use it in search.py and update-data.py, after checking its accuracy with
+validate-models.py. Re-export the models whenever they are retrained.
+"""
+
+import os
+import sys
+import torch
+from fastai.vision import load_learner
+from model_export import VARIANTS, MODEL_FNS, export_model, exported_model_path, prediction_drift
+from preprocess import IMAGE_SIZE
+
+# Grab variants from command line
+variants = sys.argv[1:] or list(VARIANTS)
+for variant in variants:
+    if variant not in VARIANTS: raise TypeError(f"Unknown variant {variant} (choose from {', '.join(VARIANTS)})")
+
+# Change working directory to src/
+current_file_filepath = os.path.abspath(__file__)
+dname = os.path.dirname(current_file_filepath)
+os.chdir(dname)
+
+# Export each model, checking the export on a batch of a different size from the one it was traced with
+check_batch = torch.randn((3, 3) + IMAGE_SIZE)
+for name, model_fn in MODEL_FNS.items():
+    model = load_learner("../models/", model_fn).model.cpu().eval()
+    with torch.no_grad():
+        reference = model(check_batch)
+    for variant in variants:
+        path = exported_model_path("../models", name, variant)
+        exported = export_model(model, variant, path)
+        with torch.no_grad():
+            drift = prediction_drift(reference, exported(check_batch.contiguous(
+                memory_format=torch.channels_last if variant == "channels_last" else torch.contiguous_format)))
+        print(f"Exported {name} model ({variant}) to {os.path.relpath(path, '..')}: "
+              f"max difference {drift['max_abs']:.2e} on random inputs")
@@ -0,0 +1,95 @@
+"""
+File: feature_cache.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Caches the predicted features (stage and anatomical locations) of input embryo images.
+
+Running the stage and locations models is by far the most expensive part of an image search. Most queries are for
+images that have already been predicted on– either GEISHA images whose predictions are saved in the database, or
+images that were uploaded/searched for recently. This module provides the objects that let the search skip the
+models for those queries:
+- ImageFeatures, a light container for the stage and locations predictions of a single image
+- FeatureCache, a bounded LRU cache of ImageFeatures keyed by the hash of an image's contents
+- hash_image_file and hash_image_bytes, which compute that key for an image on disk or in memory
+"""
+
+## Libraries
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import NamedTuple, Any, Optional
+
+## Objects
+class ImageFeatures(NamedTuple):
+    """
+    The predicted features of a single embryo image, in the same form `run_inference` returns them: a stage
+    prediction tensor of shape (1, 1) and a locations prediction tensor of shape (1, number of locations).
+    """
+    stage: Any
+    locations: Any
+
+class FeatureCache():
+    """
+    A thread-safe, bounded LRU cache mapping image content hashes to ImageFeatures.
+
+    When the cache holds `max_size` entries, adding a new entry evicts the least recently used one. A `max_size`
+    of 0 disables the cache. Hits and misses are counted so the cache's effectiveness can be monitored.
+    """
+    def __init__(self, max_size:int=1024):
+        self.max_size = max_size
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key:str) -> Optional[ImageFeatures]:
+        "Returns the features saved under `key` (marking them as recently used), or None if they aren't cached."
+        with self._lock:
+            features = self._entries.get(key)
+            if features is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return features
+
+    def put(self, key:str, features:ImageFeatures):
+        "Saves `features` under `key`, evicting the least recently used entries if the cache is full."
+        if self.max_size <= 0: return
+        with self._lock:
+            self._entries[key] = features
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        "Empties the cache and resets its counters."
+        with self._lock:
+            self._entries.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def stats(self) -> dict:
+        "Returns the cache's size, capacity, and hit/miss counts."
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {"size": len(self._entries), "max_size": self.max_size, "hits": self.hits,
+                    "misses": self.misses, "hit_rate": self.hits/lookups if lookups else 0.}
+
+    def __len__(self): return len(self._entries)
+    def __contains__(self, key): return key in self._entries
+
+## Functions
+def hash_image_file(image_fn:str, chunk_size:int=1<<20) -> str:
+    """
+    Returns the SHA-1 hex digest of the contents of the image file `image_fn`. Two files with the same contents
+    (e.g. the same image uploaded twice under different names) hash to the same key.
+    """
+    digest = hashlib.sha1()
+    with open(image_fn, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def hash_image_bytes(image_bytes:bytes) -> str:
+    "Returns the SHA-1 hex digest of an image's raw bytes. Matches `hash_image_file` for the same contents."
+    return hashlib.sha1(image_bytes).hexdigest()
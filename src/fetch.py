@@ -0,0 +1,228 @@
+"""
+File: fetch.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Downloads input embryo images from the Geisha website into a bounded on-disk cache.
+
+Input images that aren't available locally are downloaded from the Geisha website. Previously, each was downloaded
+with a new connection (and no timeout or retries) into src/downloaded-search-images, which was never cleaned up.
+The ImageFetcher defined here:
+- Reuses pooled HTTP(S) connections, with a timeout on every request and a limited number of retries (with backoff)
+for connection errors and server errors. Redirects (e.g. from http to https) are followed, up to a limit.
+- Shares one download between concurrent requests for the same image
+- Keeps downloaded images in a cache directory capped by total size and by age, evicting the least recently used
+images first
+
+The base URL is configurable (GEISHA_PHOTOS_URL in search.py), so a local HTTP server can stand in for the website.
+"""
+
+## Libraries
+import http.client
+import os
+import threading
+import time
+import urllib.parse
+from collections import OrderedDict
+from concurrent.futures import Future
+
+## Objects
+class ConnectionPool():
+    """
+    A small pool of keep-alive HTTP(S) connections, kept per host.
+
+    Arguments:
+    - timeout: the timeout (in seconds) for connecting and for each read
+    - max_idle: the largest number of idle connections kept per host
+    - max_redirects: the largest number of redirects followed for one request
+    """
+    # Statuses of the redirects that are followed (to the URL in the Location header)
+    REDIRECT_STATUSES = (301, 302, 303, 307, 308)
+
+    def __init__(self, timeout:float=10., max_idle:int=8, max_redirects:int=5):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.max_redirects = max_redirects
+        self._idle = {}
+        self._lock = threading.Lock()
+
+    def get(self, url:str):
+        """
+        Sends a GET request for `url`, following redirects, and returns the final response's (status, body). If there
+        are more than `max_redirects` redirects, the last redirect's response is returned.
+        """
+        for _ in range(self.max_redirects + 1):
+            status, body, location = self._get_once(url)
+            if status not in self.REDIRECT_STATUSES or not location: break
+            url = urllib.parse.urljoin(url, location)
+        return status, body
+
+    def _get_once(self, url:str):
+        "Sends a GET request for `url`, and returns the response's (status, body, Location header)."
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.netloc)
+        conn = self._checkout(key)
+        path = parts.path + ("?" + parts.query if parts.query else "")
+        try:
+            conn.request("GET", path or "/")
+            response = conn.getresponse()
+            body = response.read()
+        except Exception:
+            conn.close()
+            raise
+        if response.will_close: conn.close()
+        else: self._checkin(key, conn)
+        return response.status, body, response.getheader("Location")
+
+    def _checkout(self, key):
+        "Returns an idle connection to the host, or a new one."
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle: return idle.pop()
+        scheme, netloc = key
+        conn_cls = http.client.HTTPSConnection if scheme == "https" else http.client.HTTPConnection
+        return conn_cls(netloc, timeout=self.timeout)
+
+    def _checkin(self, key, conn):
+        "Returns a connection to the pool, closing it if the pool is full."
+        with self._lock:
+            idle = self._idle.setdefault(key, [])
+            if len(idle) < self.max_idle:
+                idle.append(conn)
+                return
+        conn.close()
+
+class ImageFetcher():
+    """
+    Downloads images by filename from `base_url` into the cache directory `cache_dir`.
+
+    Arguments:
+    - base_url: the URL that image filenames are appended to (e.g. http://geisha.arizona.edu/geisha/photos/)
+    - cache_dir: the directory downloaded images are kept in
+    - max_bytes: the largest total size of the cached images. Least recently used images are evicted past this.
+    - max_age: the longest time (in seconds) a downloaded image is kept before being downloaded again
+    - timeout: the timeout (in seconds) for each request
+    - retries: the number of times a failed download (connection error or server error) is retried
+    - min_age: images used within this many seconds are not evicted (they may still be being read)
+    """
+    def __init__(self, base_url:str, cache_dir:str, max_bytes:int=1<<30, max_age:float=7*24*3600,
+                 timeout:float=10., retries:int=2, min_age:float=60.):
+        self.base_url = base_url
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.retries = retries
+        self.min_age = min_age
+        self.pool = ConnectionPool(timeout=timeout)
+        self.hits = 0
+        self.misses = 0
+        self.bytes_downloaded = 0
+        # Cached images, least recently used first: filename -> [size, download time, last use time]
+        self._entries = OrderedDict()
+        self._total_bytes = 0
+        self._in_flight = {}
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._scan()
+
+    def fetch(self, image_fn:str) -> str:
+        """
+        Returns the path to a local copy of the image `image_fn`, downloading it if it isn't cached (or has expired).
+        Concurrent calls for the same image share one download. Raises FileNotFoundError if the image doesn't exist.
+        """
+        now = time.time()
+        with self._lock:
+            entry = self._entries.get(image_fn)
+            if entry is not None and now - entry[1] < self.max_age:
+                entry[2] = now
+                self._entries.move_to_end(image_fn)
+                self.hits += 1
+                return self.cache_path(image_fn)
+            future = self._in_flight.get(image_fn)
+            owner = future is None
+            if owner:
+                future = self._in_flight[image_fn] = Future()
+                self.misses += 1
+        if not owner: return future.result()
+        try:
+            path = self._download(image_fn)
+            future.set_result(path)
+            return path
+        except Exception as e:
+            future.set_exception(e)
+            raise
+        finally:
+            with self._lock:
+                del self._in_flight[image_fn]
+
+    def cache_path(self, image_fn:str) -> str:
+        "Returns where the image `image_fn` is kept in the cache (filenames are escaped, so they stay in the cache)."
+        return os.path.join(self.cache_dir, urllib.parse.quote(image_fn, safe=""))
+
+    def url(self, image_fn:str) -> str:
+        "Returns the URL of the image `image_fn`."
+        return self.base_url + urllib.parse.quote(image_fn)
+
+    def stats(self) -> dict:
+        "Returns the cache's size and hit/miss counts, and the number of bytes downloaded."
+        with self._lock:
+            return {"images": len(self._entries), "bytes": self._total_bytes, "max_bytes": self.max_bytes,
+                    "hits": self.hits, "misses": self.misses, "bytes_downloaded": self.bytes_downloaded}
+
+    def _download(self, image_fn:str) -> str:
+        "Downloads an image into the cache (retrying failures) and returns its path."
+        url = self.url(image_fn)
+        for attempt in range(self.retries + 1):
+            try:
+                status, body = self.pool.get(url)
+            except (OSError, http.client.HTTPException):
+                if attempt == self.retries: raise
+            else:
+                if status == 200: break
+                if status < 500 or attempt == self.retries:
+                    raise FileNotFoundError(f"Image not found locally or on the Geisha database. Tried {url}")
+            time.sleep(0.1 * 2**attempt)
+        # Write to a temporary file first, so readers never see a partial image
+        path = self.cache_path(image_fn)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "wb") as file:
+            file.write(body)
+        os.replace(tmp_path, path)
+        now = time.time()
+        with self._lock:
+            self.bytes_downloaded += len(body)
+            old = self._entries.pop(image_fn, None)
+            if old is not None: self._total_bytes -= old[0]
+            self._entries[image_fn] = [len(body), now, now]
+            self._total_bytes += len(body)
+            self._evict(now)
+        return path
+
+    def _evict(self, now:float):
+        "Removes expired images, then least recently used images until the cache fits (call with the lock held)."
+        for image_fn, (size, downloaded, used) in list(self._entries.items()):
+            expired = now - downloaded >= self.max_age
+            over_size = self._total_bytes > self.max_bytes
+            if not (expired or over_size): continue
+            if now - used < self.min_age: continue
+            del self._entries[image_fn]
+            self._total_bytes -= size
+            try:
+                os.remove(self.cache_path(image_fn))
+            except FileNotFoundError:
+                pass
+
+    def _scan(self):
+        "Indexes images already in the cache directory (e.g. from before a restart), oldest first."
+        files = []
+        for fn in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, fn)
+            if not os.path.isfile(path): continue
+            if fn.endswith(".tmp"):
+                os.remove(path)
+                continue
+            stat = os.stat(path)
+            files.append((stat.st_mtime, urllib.parse.unquote(fn), stat.st_size))
+        for mtime, image_fn, size in sorted(files):
+            self._entries[image_fn] = [size, mtime, mtime]
+            self._total_bytes += size
+        with self._lock:
+            self._evict(time.time())
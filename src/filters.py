@@ -0,0 +1,135 @@
+"""
+File: filters.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Restricts searches to database images in a range of stages, or showing expression in chosen locations.
+
+Searches can be filtered by:
+- A stage range, e.g. only images predicted to be between stages 10 and 14
+- Required locations, e.g. only images showing expression in the Anterior Neuropore
+- Excluded locations, e.g. no images showing expression in the Allantois
+
+Locations are named as in data/locations.txt (which gives the order of the columns of the locations predictions).
+The FilterIndex defined here precomputes what the filters need, so that the matching images are found without
+scanning the predictions on every query:
+- The stages in sorted order, so a stage range is found by binary search
+- For each location, a packed bitset of the images whose locations prediction passes a threshold
+
+The matching images are found before anything is scored, and only they are ranked (see `embryo_similarity` in
+search.py).
+"""
+
+## Libraries
+from typing import NamedTuple, Optional, Sequence, Tuple, List
+import numpy as np
+
+## Objects
+class SearchFilter(NamedTuple):
+    """
+    The images a search is restricted to.
+
+    - stage_range: (lowest stage, highest stage), inclusive. Either may be None to leave that end open.
+    - required: names of locations the images must show expression in
+    - excluded: names of locations the images must not show expression in
+    """
+    stage_range: Optional[Tuple[Optional[float], Optional[float]]] = None
+    required: Tuple[str, ...] = ()
+    excluded: Tuple[str, ...] = ()
+
+    def is_empty(self) -> bool:
+        "Returns whether the filter allows every image."
+        no_stage_range = self.stage_range is None or all(stage is None for stage in self.stage_range)
+        return no_stage_range and not self.required and not self.excluded
+
+class FilterIndex():
+    """
+    Finds the database images that match a SearchFilter.
+
+    Arguments:
+    - stages: the saved stage predictions of the database images, shape (N,) or (N, 1)
+    - locations: the saved locations predictions of the database images, shape (N, number of locations)
+    - location_names: the name of each locations column (see `load_location_names`)
+    - threshold: the locations prediction at or above which an image counts as showing expression in a location
+    - chunk_size: the number of rows thresholded at a time (a multiple of 8)
+    """
+    def __init__(self, stages, locations, location_names:Sequence[str], threshold:float=0.5, chunk_size:int=65536):
+        self.location_names = list(location_names)
+        self.columns = {name: column for column, name in enumerate(self.location_names)}
+        self.threshold, self.chunk_size = threshold, chunk_size
+        self.stages = np.asarray(stages, dtype=np.float32).reshape(-1)
+        locations = np.asarray(locations)
+        assert len(self.stages) == len(locations)
+        assert locations.shape[1] == len(self.location_names), "Location names don't match the locations predictions"
+        self.stage_order = np.argsort(self.stages, kind="stable")
+        self.sorted_stages = self.stages[self.stage_order]
+        self.bitsets = _pack_locations(locations, threshold, chunk_size)
+
+    def __len__(self): return len(self.stages)
+
+    def extend(self, stages, locations) -> "FilterIndex":
+        """
+        Returns an index of a database that has had rows appended to this index's database (`stages` and `locations`
+        are the predictions of the whole new database). Only the new rows are thresholded and sorted into place; this
+        index is left unchanged.
+        """
+        index = object.__new__(FilterIndex)
+        index.__dict__.update(self.__dict__)
+        index.stages = np.asarray(stages, dtype=np.float32).reshape(-1)
+        old_size, new_size = len(self), len(index)
+        assert new_size >= old_size, "Rows can only be appended to an indexed database"
+        # Merge the new rows into the sorted stages
+        new_rows = np.arange(old_size, new_size)
+        new_order = new_rows[np.argsort(index.stages[old_size:], kind="stable")]
+        positions = np.searchsorted(self.sorted_stages, index.stages[new_order], side="right")
+        index.stage_order = np.insert(self.stage_order, positions, new_order)
+        index.sorted_stages = index.stages[index.stage_order]
+        # Keep the complete bytes of the bitsets, and pack the rows from the last partial byte on
+        full_bytes = old_size // 8
+        new_bits = _pack_locations(np.asarray(locations)[full_bytes*8:], self.threshold, self.chunk_size)
+        index.bitsets = np.concatenate([self.bitsets[:, :full_bytes], new_bits], axis=1)
+        return index
+
+    def stage_rows(self, lowest:float=None, highest:float=None) -> np.ndarray:
+        "Returns the rows of the images with stages between `lowest` and `highest` (inclusive), in order of stage."
+        start = 0 if lowest is None else np.searchsorted(self.sorted_stages, lowest, side="left")
+        end = len(self) if highest is None else np.searchsorted(self.sorted_stages, highest, side="right")
+        return self.stage_order[start:max(start, end)]
+
+    def location_bitset(self, name:str) -> np.ndarray:
+        "Returns the packed bitset of the images showing expression in the location called `name`."
+        if name not in self.columns: raise ValueError(f"Unknown location: {name!r} (see data/locations.txt)")
+        return self.bitsets[self.columns[name]]
+
+    def rows(self, search_filter:SearchFilter) -> np.ndarray:
+        "Returns the rows of the images that match `search_filter`, in order."
+        if search_filter.is_empty(): return np.arange(len(self))
+        mask = np.full(self.bitsets.shape[1], 0xFF, dtype=np.uint8)
+        if search_filter.stage_range is not None:
+            stage_rows = self.stage_rows(*search_filter.stage_range)
+            if not search_filter.required and not search_filter.excluded: return np.sort(stage_rows)
+            stage_mask = np.zeros(len(self), dtype=bool)
+            stage_mask[stage_rows] = True
+            mask &= np.packbits(stage_mask)
+        for name in search_filter.required:
+            mask &= self.location_bitset(name)
+        for name in search_filter.excluded:
+            mask &= ~self.location_bitset(name)
+        return np.flatnonzero(np.unpackbits(mask, count=len(self)))
+
+## Functions
+def load_location_names(locations_fn:str="data/locations.txt") -> List[str]:
+    "Returns the names of the anatomical locations, in the order of the columns of the locations predictions."
+    with open(locations_fn, "r") as file:
+        return [line.strip() for line in file if line.strip()]
+
+def _pack_locations(locations, threshold:float, chunk_size:int) -> np.ndarray:
+    """
+    Thresholds the locations predictions a chunk of rows at a time, and returns a packed bitset for each location,
+    shape (number of locations, ceil(N/8)). Bit i of a location's bitset is set if image i shows expression there.
+    """
+    assert chunk_size % 8 == 0
+    count, width = locations.shape
+    bitsets = np.empty((width, (count + 7)//8), dtype=np.uint8)
+    for start in range(0, count, chunk_size):
+        chunk = np.asarray(locations[start:start+chunk_size]) >= threshold
+        bitsets[:, start//8:(start+len(chunk)+7)//8] = np.packbits(chunk.T, axis=1)
+    return bitsets
@@ -20,6 +20,13 @@ The app accepts two parameters, which are given as query parameters in the app's
 the image home directory, or the filename of an image on the Geisha website (upon which it will be downloaded).
 Anything else will result in an error.
 - num_images: the number of similar images to return. The default is 50.
+- offset or page (optional): which page of results to return. offset skips that many of the most similar images;
+page (starting from 1) skips the first page-1 pages of n images. The default is the first page. The ranking is cached
+on the server after the first page, so later pages are sliced from it instead of searching again (see
+cursor_cache.py).
+- stage_min, stage_max (optional): only return images whose predicted stage is in this range
+- require, exclude (optional): only return images that show (or don't show) expression in these anatomical locations,
+named as in data/locations.txt. Either can be repeated, or given as a comma separated list.
 
 Given the input embryo, the web app searches through the publicly available embryo images within the Geisha
 database, and finds and returns the most similar images. A sorted list of the most similar filenames are
@@ -40,13 +47,134 @@ Displayed Output (with new lines instead of spaces):
 similar-image-one.jpg
 similar-image-two.jpg
 ...
+
+Input link: http://localhost:8080/?filename=R449.CDH5.S17.001.jpg&n=10&stage_min=10&stage_max=14&require=Anterior%20Neuropore
+Displayed Output: the 10 most similar images between stages 10 and 14 that show expression in the Anterior Neuropore
+
+Input link: http://localhost:8080/?filename=R449.CDH5.S17.001.jpg&n=10&page=2
+Displayed Output: the 11th to 20th most similar images
+
+The app also has a batch search route, /batch, which finds similar images for many input images in one POST
+request. Input images are given either as a JSON body ({"filenames": [...], "n": 50}), or as a multipart form
+with any number of "filenames" fields and/or uploaded "images" files (plus an optional "n" field). Results are
+streamed back as JSON lines, one per input image in order, as soon as they are computed:
+{"query": "R449.CDH5.S17.001.jpg", "results": ["R449.CDH5.S17.001.jpg", "R449.CDH5.S16.001.jpg", ...]}
+Input images that can't be found are given an "error" instead of "results".
+
+Example Batch Usage:
+curl -X POST -H "Content-Type: application/json" -d '{"filenames": ["R449.CDH5.S17.001.jpg"], "n": 10}' \
+    http://localhost:8080/batch
+curl -X POST -F "images=@local-embryo.jpg" -F "filenames=R449.CDH5.S17.001.jpg" http://localhost:8080/batch
+
+Monitoring:
+- /metrics returns the app's metrics in the Prometheus text format: histograms of the time spent in each phase of a
+search (download, preprocessing, inference, ranking, ...) and in each route, plus cache hit/miss counts, bytes
+downloaded, inference batch sizes and queue waits, and the database size.
+- Adding "timing=1" to a request's query parameters (or setting GEISHA_TIMING_HEADER=1 for every request) returns
+the time spent in each phase of that request in a Server-Timing header (except for streamed /batch responses, which
+are still timed in the metrics, once they finish streaming).
+- Setting GEISHA_PROFILE_RATE (e.g. to 0.01) profiles that fraction of requests, saving the profiles to src/profiles.
+GEISHA_PROFILE_MODE chooses between "cprofile" (the default) and "torch" (the torch profiler).
+- /healthz returns 200 while the app's process is running, and /readyz returns 200 once the models and data are
+loaded and warmed up (503 before then).
+
+Production:
+By default, the app runs on Flask's development server (a single process, which reloads when the code changes).
+Setting GEISHA_SERVER=production serves it from several worker processes instead (see serving.py). The models and
+data are loaded once, before the workers are forked, so the workers share them; each worker then warms up the
+models before it starts serving. These settings tune the production server:
+- GEISHA_WORKERS: the number of worker processes (default: the number of CPUs)
+- GEISHA_WORKER_TORCH_THREADS: the number of threads torch uses in each worker (default: the number of CPUs divided
+by the number of workers, so workers don't compete for cores)
+- GEISHA_HOST: the address to listen on (default 127.0.0.1)
+
+Example Production Usage:
+GEISHA_SERVER=production GEISHA_WORKERS=4 python src/image-search-flask.py 8081 /home/geisha/images
 """
-from flask import Flask, request
+from flask import Flask, request, Response, stream_with_context, g
 from search import *
+from serving import PreforkServer
+import search
+import metrics
+import json
 import sys
+import time
 
 app = Flask(__name__)
 
+# Monitoring settings
+TIMING_HEADER = os.environ.get("GEISHA_TIMING_HEADER", "0") == "1"
+request_profiler = metrics.RequestProfiler(rate=float(os.environ.get("GEISHA_PROFILE_RATE", 0)),
+                                           mode=os.environ.get("GEISHA_PROFILE_MODE", "cprofile"))
+
+@app.before_request
+
+def start_request():
+    """Starts timing (and possibly profiling) a request."""
+    g.request_start = time.perf_counter()
+    g.request_timings = metrics.start_request_timings()
+    g.profiler = request_profiler.start()
+    g.finish_on_close = False
+
+@app.after_request
+
+def add_timing_header(response):
+    """
+    Adds the request's phase timings to the response if they were asked for. Streamed responses (e.g. from /batch)
+    are measured once they finish streaming, so they can't have the header.
+    """
+    if response.is_streamed:
+        g.finish_on_close = True
+        response.call_on_close(_request_finisher())
+    elif TIMING_HEADER or request.args.get("timing"):
+        elapsed = time.perf_counter() - g.request_start
+        response.headers["Server-Timing"] = metrics.server_timing_header(dict(g.request_timings, total=elapsed))
+    return response
+
+@app.teardown_request
+
+def finish_request(exception=None):
+    """
+    Records how long a request took, and stops profiling it. This runs even when the view raised an exception
+    (after_request doesn't, in debug mode). Streamed responses are finished when they're closed instead.
+    """
+    if "request_start" not in g or g.finish_on_close: return
+    _request_finisher()()
+
+def _request_finisher():
+    "Returns a function that records the current request's time and stops its profiler (it may run outside the request)."
+    start, route, profiler = g.request_start, request.endpoint or "unknown", g.profiler
+    def finish():
+        metrics.registry.request_seconds.observe(time.perf_counter() - start, route)
+        metrics.stop_request_timings()
+        if profiler is not None: request_profiler.stop(profiler, route)
+    return finish
+
+# Production server settings
+SERVER = os.environ.get("GEISHA_SERVER", "development")
+WORKERS = int(os.environ.get("GEISHA_WORKERS", os.cpu_count() or 1))
+WORKER_TORCH_THREADS = int(os.environ.get("GEISHA_WORKER_TORCH_THREADS", max(1, (os.cpu_count() or 1)//WORKERS)))
+HOST = os.environ.get("GEISHA_HOST", "127.0.0.1")
+
+@app.route("/healthz")
+
+def health():
+    """Returns 200 while the app is running."""
+    return "ok"
+
+@app.route("/readyz")
+
+def ready():
+    """Returns 200 once the models and data are loaded and warmed up, and 503 until then."""
+    if search.is_ready(): return "ready"
+    return Response("not ready", status=503)
+
+@app.route("/metrics")
+
+def metrics_route():
+    """Returns the app's metrics in the Prometheus text format."""
+    return Response(metrics.registry.render(), mimetype="text/plain; version=0.0.4")
+
 @app.route("/")
 
 def main():
@@ -55,7 +183,11 @@ def main():
 
     Given a filename and number of images to return (uses the 'n' argument; defaults to 50), the app
     finds or downloads the image locally, predicts on its features using the trained models, compares it
-    with the public database images, and returns the filenames of the most similar ones.
+    with the public database images, and returns the filenames of the most similar ones. Images in the
+    database (or searched for recently) reuse their saved features instead of being predicted on again.
+
+    Results are paged (uses the 'offset' or 'page' argument): later pages of a search are served from its cached
+    ranking (see `paged_similarity`).
     """
     # Parse app arguments (filename and n)
     fname = request.args.get("filename", None)
@@ -63,12 +195,57 @@ def main():
     if fname is None: raise TypeError("Missing filename of image to compare to.")
     n = request.args.get("n", None)
     n = int(ifnone(n, 50))
-    # Retrieve image, find similar image filenames, display top results
-    image_in = grab_image(fname, image_home_dir = app.config.get('image_home_dir'))
-    similar_images = embryo_similarity(image_in)  # Using euclidean similarity with equal weight
-    similar_images = [Path(fn).name for fn in similar_images[:n]]
+    # Parse the page of results (offset, or page number starting from 1)
+    page = request.args.get("page", None, type=int)
+    offset = request.args.get("offset", 0 if page is None else (page-1)*n, type=int)
+    if n < 0 or offset < 0 or (page is not None and page < 1):
+        raise ValueError("n and offset can't be negative, and pages start at 1.")
+    # Parse filters (stage range, and locations to require/exclude)
+    stage_range = (request.args.get("stage_min", None, type=float), request.args.get("stage_max", None, type=float))
+    required, excluded = _location_list("require"), _location_list("exclude")
+    # Retrieve image features (skipping the models for known images), find similar image filenames, display the page
+    image_in = grab_features(fname, image_home_dir = app.config.get('image_home_dir'))
+    similar_images = paged_similarity(image_in, offset=offset, n=n, stage_range=stage_range, required=required,
+                                      excluded=excluded)  # Using euclidean similarity with equal weight
+    similar_images = [Path(fn).name for fn in similar_images]
     return "\n".join(similar_images)
 
+def _location_list(name:str) -> List[str]:
+    "Returns the location names given in the query parameter `name` (repeated and/or comma separated)."
+    return [location.strip() for value in request.args.getlist(name) for location in value.split(",") if location.strip()]
+
+@app.route("/batch", methods=["POST"])
+
+def batch():
+    """
+    Executes the image search engine for many input images at once.
+
+    Input images are given by filename (in a JSON body or as form fields) and/or as uploaded files, along with the
+    number of images to return for each (uses the 'n' argument; defaults to 50). Their features are predicted in
+    batches, they are ranked against the database together, and their results are streamed back as JSON lines.
+    """
+    # Parse input images (filenames, then uploads) and n
+    payload = request.get_json(silent=True) or {}
+    if not isinstance(payload, dict): return Response("The JSON body must be an object.", status=400)
+    filenames = payload.get("filenames", request.form.getlist("filenames"))
+    if not isinstance(filenames, list) or not all(isinstance(fn, str) for fn in filenames):
+        return Response("filenames must be a list of strings.", status=400)
+    uploads = request.files.getlist("images")
+    if not filenames and not uploads: raise TypeError("Missing filenames or images to compare to.")
+    n = int(ifnone(payload.get("n", request.values.get("n", None)), 50))
+    images = list(filenames) + [upload.read() for upload in uploads]
+    names = list(filenames) + [upload.filename for upload in uploads]
+    image_home_dir = app.config.get('image_home_dir')
+    # Find similar images, streaming results back as they're computed
+    def generate():
+        for i, similar_images in batch_similarity(images, image_home_dir=image_home_dir, n=n):
+            if isinstance(similar_images, Exception):
+                result = {"query": names[i], "error": str(similar_images)}
+            else:
+                result = {"query": names[i], "results": [Path(fn).name for fn in similar_images]}
+            yield json.dumps(result) + "\n"
+    return Response(stream_with_context(generate()), mimetype="application/x-ndjson")
+
 if __name__ == "__main__":
     # No command line arguments
     if len(sys.argv) == 1:
@@ -90,4 +267,14 @@ if __name__ == "__main__":
         app.config['image_home_dir'] = sys.argv[2]
     else:
         raise TypeError("Too many command line arguments (two allowed)")
-    app.run(debug=True, port=port)
+    if SERVER == "production":
+        # Load the models and data once (single threaded, so the workers can be forked safely), then warm up each worker
+        def post_fork(worker:int):
+            torch.set_num_threads(WORKER_TORCH_THREADS)
+            search.warm_up()
+        PreforkServer(app, host=HOST, port=port, workers=WORKERS, setup=lambda: search.init(torch_threads=1),
+                      post_fork=post_fork).serve_forever()
+    else:
+        # The reloader's main process only watches for code changes, so only the process it starts loads the models
+        if os.environ.get("WERKZEUG_RUN_MAIN") == "true": search.warm_up()
+        app.run(debug=True, port=port)
@@ -0,0 +1,194 @@
+"""
+File: metrics.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Measures where the time goes in image searches, and exposes the measurements in the Prometheus text format.
+
+The search engine is instrumented with low-overhead timers and counters (see search.py and image-search-flask.py):
+- Each phase of a search (downloading the image, preprocessing, inference, ranking, ...) is timed into a histogram
+- Counters and gauges are read from the objects that already keep them (cache hit/miss counts, bytes downloaded,
+inference batch sizes, database size) when the metrics are collected, so they cost nothing per request
+- The phases of the current request are also collected, so they can be returned in a timing header
+
+RequestProfiler samples a small fraction of requests with cProfile or the torch profiler, for a closer look.
+"""
+
+## Libraries
+import bisect
+import contextvars
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, Tuple
+
+## Settings
+# Histogram buckets (in seconds), from 0.5 ms to 30 s
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1., 2.5, 5., 10., 30.)
+
+## Objects
+class Histogram():
+    """
+    A Prometheus histogram, with one series per combination of label values.
+
+    Arguments:
+    - name: the metric's name
+    - help: a description of the metric
+    - label_names: the names of the metric's labels
+    - buckets: the upper bounds of the buckets
+    """
+    def __init__(self, name:str, help:str, label_names:Tuple[str, ...]=(), buckets=DEFAULT_BUCKETS):
+        self.name, self.help, self.label_names = name, help, tuple(label_names)
+        self.buckets = tuple(sorted(buckets))
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value:float, *label_values):
+        "Records one observation of `value` for the series with the given label values."
+        with self._lock:
+            series = self._series.get(label_values)
+            if series is None:
+                series = self._series[label_values] = [[0]*(len(self.buckets)+1), 0., 0]
+            series[0][bisect.bisect_left(self.buckets, value)] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> Iterable[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        with self._lock:
+            series = {labels: (list(counts), total, count) for labels, (counts, total, count) in self._series.items()}
+        for label_values, (counts, total, count) in sorted(series.items()):
+            labels = list(zip(self.label_names, label_values))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float("inf"),), counts):
+                cumulative += bucket_count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                yield f"{self.name}_bucket{_format_labels(labels + [('le', le)])} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(labels)} {total}"
+            yield f"{self.name}_count{_format_labels(labels)} {count}"
+
+class MetricsRegistry():
+    """
+    Holds the search engine's metrics, and renders them in the Prometheus text format.
+
+    Besides histograms, the registry has collectors: functions called when the metrics are rendered, which return
+    lines of already-formatted metrics (see `counter_lines` and `gauge_lines`). These report values
+    that other objects keep track of anyway.
+    """
+    def __init__(self):
+        self.histograms = {}
+        self.collectors = []
+        self.phase_seconds = self.histogram("geisha_phase_seconds", "Time spent in each phase of a search", ("phase",))
+        self.request_seconds = self.histogram("geisha_request_seconds", "Time spent handling requests", ("route",))
+
+    def histogram(self, name:str, help:str, label_names=(), buckets=DEFAULT_BUCKETS) -> Histogram:
+        "Returns the histogram called `name`, creating it if it doesn't exist yet."
+        if name not in self.histograms: self.histograms[name] = Histogram(name, help, label_names, buckets)
+        return self.histograms[name]
+
+    def add_collector(self, collector:Callable[[], Iterable[str]]):
+        "Adds a function that returns lines of metrics each time the metrics are rendered."
+        self.collectors.append(collector)
+
+    @contextmanager
+    def timer(self, phase:str):
+        """
+        Times the code within the context as one phase of a search, recording it in the `geisha_phase_seconds`
+        histogram and in the current request's timings (if any).
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            self.phase_seconds.observe(elapsed, phase)
+            timings = _request_timings.get()
+            if timings is not None: timings[phase] = timings.get(phase, 0.) + elapsed
+
+    def render(self) -> str:
+        "Returns every metric in the Prometheus text format."
+        lines = []
+        for histogram in self.histograms.values():
+            lines.extend(histogram.render())
+        for collector in self.collectors:
+            lines.extend(collector())
+        return "\n".join(lines) + "\n"
+
+class RequestProfiler():
+    """
+    Profiles a random sample of requests, saving each profile to `output_dir`.
+
+    Arguments:
+    - rate: the fraction of requests to profile (0 disables profiling)
+    - mode: "cprofile" (saves .prof files, readable with pstats/snakeviz) or "torch" (saves chrome traces of the
+    torch operators run, readable in chrome://tracing)
+    - output_dir: the directory profiles are saved in
+    """
+    def __init__(self, rate:float=0., mode:str="cprofile", output_dir:str="src/profiles"):
+        assert mode in ("cprofile", "torch"), "Profiler mode must be 'cprofile' or 'torch'"
+        self.rate, self.mode, self.output_dir = rate, mode, output_dir
+
+    def start(self):
+        "Decides whether to profile the current request, and starts profiling it if so. Returns the profiler, or None."
+        if self.rate <= 0 or random.random() >= self.rate: return None
+        if self.mode == "torch":
+            import torch
+            profiler = torch.autograd.profiler.profile()
+            profiler.__enter__()
+        else:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another request is already being profiled (newer Pythons allow one profiler at a time)
+                return None
+        return profiler
+
+    def stop(self, profiler, name:str):
+        "Stops profiling a request, and saves the profile."
+        os.makedirs(self.output_dir, exist_ok=True)
+        fn = os.path.join(self.output_dir, f"{time.strftime('%Y%m%d-%H%M%S')}-{name}-{random.getrandbits(32):08x}")
+        if self.mode == "torch":
+            profiler.__exit__(None, None, None)
+            profiler.export_chrome_trace(fn + ".json")
+        else:
+            profiler.disable()
+            profiler.dump_stats(fn + ".prof")
+
+## Functions
+# The phase timings of the request being handled (in the current thread/context), if they're being collected
+_request_timings = contextvars.ContextVar("request_timings", default=None)
+
+def start_request_timings() -> Dict[str, float]:
+    "Starts collecting the phase timings of the current request, and returns the dictionary they're collected in."
+    timings = {}
+    _request_timings.set(timings)
+    return timings
+
+def stop_request_timings() -> Dict[str, float]:
+    "Stops collecting the phase timings of the current request, and returns them."
+    timings = _request_timings.get()
+    _request_timings.set(None)
+    return timings or {}
+
+def server_timing_header(timings:Dict[str, float]) -> str:
+    "Formats phase timings (in seconds) as a Server-Timing header value (in milliseconds)."
+    return ", ".join(f"{phase};dur={seconds*1000:.2f}" for phase, seconds in timings.items())
+
+def _format_labels(labels) -> str:
+    if not labels: return ""
+    escaped = (str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for _, value in labels)
+    return "{" + ",".join(f'{name}="{value}"' for (name, _), value in zip(labels, escaped)) + "}"
+
+def counter_lines(name:str, help:str, value:float, labels=()) -> Iterable[str]:
+    "Returns the lines of a Prometheus counter."
+    return [f"# HELP {name} {help}", f"# TYPE {name} counter", f"{name}{_format_labels(list(labels))} {value}"]
+
+def gauge_lines(name:str, help:str, value:float, labels=()) -> Iterable[str]:
+    "Returns the lines of a Prometheus gauge."
+    return [f"# HELP {name} {help}", f"# TYPE {name} gauge", f"{name}{_format_labels(list(labels))} {value}"]
+
+# The search engine's metrics
+registry = MetricsRegistry()
@@ -0,0 +1,125 @@
+"""
+File: model_export.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Exports the trained models to TorchScript for faster CPU inference, and loads the exported models.
+
+The trained models are fastai Learners, whose models are run eagerly (one Python call per layer). For serving, each
+model can be exported (see export-models.py) as a traced, frozen TorchScript module, in one of these variants:
+- fp32: the model as trained. Freezing inlines the weights and folds batch norms into the convolutions.
+- int8: the linear layers (the model's head) are dynamically quantized to int8. The convolutions stay in fp32.
+- channels_last: the model runs on channels-last (NHWC) tensors, which are faster for convolutions on many CPUs
+
+Exported models are saved to models/torchscript/<model>-<variant>.pt, and loaded with `load_exported_models`. Both
+search.py and update-data.py choose between the eager models and an exported variant with GEISHA_MODEL_RUNTIME.
+Variants change the predictions slightly; validate-models.py reports how much, and how much that changes rankings.
+Exported models have to be exported again after the models are retrained.
+
+Predictions made by different trained models can't be compared, so the prediction store records which models made
+its predictions (see `model_fingerprint`), and search.py checks them against the models it has loaded.
+"""
+
+## Libraries
+import copy
+import hashlib
+import os
+from typing import Dict
+import numpy as np
+import torch
+import torch.nn as nn
+from preprocess import IMAGE_SIZE
+from ranking import RankingEngine
+
+## Settings
+VARIANTS = ("fp32", "int8", "channels_last")
+# The trained models (as saved by fastai in models/), by name
+MODEL_FNS = {"stage": "stage-prediction-model.pkl", "locations": "locations-prediction-model.pkl"}
+# Where exported models are saved, within the models directory
+EXPORT_DIR = "torchscript"
+
+## Objects
+class ExportedModel():
+    "Runs an exported model (loaded from `path`), converting inputs to the memory format it was exported for."
+    def __init__(self, path:str):
+        extra_files = {"variant": ""}
+        self.module = torch.jit.load(path, map_location="cpu", _extra_files=extra_files)
+        variant = extra_files["variant"]
+        self.variant = variant.decode() if isinstance(variant, bytes) else variant
+        self.channels_last = self.variant == "channels_last"
+
+    def __call__(self, xb):
+        if self.channels_last: xb = xb.contiguous(memory_format=torch.channels_last)
+        return self.module(xb)
+
+## Functions
+def exported_model_path(models_dir:str, name:str, variant:str) -> str:
+    "Returns where the `variant` export of the model called `name` (\"stage\" or \"locations\") is saved."
+    return os.path.join(models_dir, EXPORT_DIR, f"{name}-{variant}.pt")
+
+def export_model(model:nn.Module, variant:str="fp32", path:str=None, example=None) -> torch.jit.ScriptModule:
+    """
+    Exports a model to TorchScript, by tracing it on an example batch of images and freezing the result.
+
+    Arguments:
+    - model: the model to export (e.g. a Learner's `model`). It isn't modified.
+    - variant: "fp32", "int8" or "channels_last" (see above)
+    - path: where to save the exported model, if anywhere
+    - example: the batch of images to trace the model with. Defaults to two blank images of the input size.
+
+    Returns:
+    The exported model.
+    """
+    assert variant in VARIANTS, f"Variant must be one of {VARIANTS}"
+    model = copy.deepcopy(model).cpu().eval()
+    example = example if example is not None else torch.zeros((2, 3) + IMAGE_SIZE)
+    if variant == "int8":
+        model = torch.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    elif variant == "channels_last":
+        model = model.to(memory_format=torch.channels_last)
+        example = example.contiguous(memory_format=torch.channels_last)
+    with torch.no_grad():
+        exported = torch.jit.freeze(torch.jit.trace(model, example))
+    if path is not None:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        torch.jit.save(exported, path, _extra_files={"variant": variant})
+    return exported
+
+def load_exported_models(models_dir:str, variant:str) -> Dict[str, ExportedModel]:
+    "Loads the `variant` exports of the stage and locations models from `models_dir`, as {name: model}."
+    assert variant in VARIANTS, f"Variant must be one of {VARIANTS}"
+    return {name: ExportedModel(exported_model_path(models_dir, name, variant)) for name in MODEL_FNS}
+
+def model_fingerprint(models_dir:str, chunk_size:int=1<<20) -> Dict[str, str]:
+    """
+    Identifies the trained models in `models_dir` (which every variant is exported from) by the SHA-1 hex digests of
+    their files, as {name: digest}. Models whose files are missing (e.g. where only exported models are deployed) are
+    left out.
+    """
+    fingerprint = {}
+    for name, fn in MODEL_FNS.items():
+        path = os.path.join(models_dir, fn)
+        if not os.path.exists(path): continue
+        digest = hashlib.sha1()
+        with open(path, "rb") as file:
+            for chunk in iter(lambda: file.read(chunk_size), b""):
+                digest.update(chunk)
+        fingerprint[name] = digest.hexdigest()
+    return fingerprint
+
+def prediction_drift(reference, predictions) -> dict:
+    "Returns the largest and mean absolute difference between predictions and reference predictions."
+    diff = (torch.as_tensor(predictions).float() - torch.as_tensor(reference).float()).abs()
+    return {"max_abs": diff.max().item() if diff.numel() else 0., "mean_abs": diff.mean().item() if diff.numel() else 0.}
+
+def top_n_overlap(database_stages, database_locations, reference_preds, preds, n:int=50, alpha:float=0.5) -> float:
+    """
+    Ranks the database against each input embryo twice, once with its reference predictions (stage predictions, locations
+    predictions) and once with other predictions of it (e.g. from an exported model), and returns the mean fraction
+    of the reference top `n` images that are also in the other top `n`.
+    """
+    engine = RankingEngine(database_stages, database_locations)
+    overlaps = []
+    for ref_stage, ref_locations, stage, locations in zip(*reference_preds, *preds):
+        reference = engine.top_n(ref_stage, ref_locations, n=n, alpha=alpha).numpy()
+        other = engine.top_n(stage, locations, n=n, alpha=alpha).numpy()
+        overlaps.append(len(np.intersect1d(reference, other))/max(1, len(reference)))
+    return float(np.mean(overlaps)) if overlaps else 1.
@@ -0,0 +1,112 @@
+"""
+File: pipeline.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Streams large numbers of images from disk through the trained models, for scripts that update the saved
+predictions (see update-data.py and reindex-predictions.py).
+
+Images are decoded and preprocessed (see preprocess.py) in parallel by DataLoader worker processes, while the main
+process runs the models. Each decoded batch is shared by both the stage and locations models, so every image is
+only decoded once. Predictions are yielded batch by batch, so callers can save them in chunks as they go, rather than
+holding everything until the end. Images that can't be read are reported instead of stopping the run.
+
+`append_new_predictions` puts this together for update-data.py: it streams new images through the models and
+appends their predictions to the prediction store (see prediction_store.py) a chunk at a time.
+"""
+
+## Libraries
+from typing import Callable, Iterator, Sequence, Tuple, List
+import torch
+from torch.utils.data import Dataset, DataLoader
+from preprocess import ImagePreprocessor
+from batching import inference_mode
+from prediction_store import append_predictions
+
+## Objects
+class ImageFileDataset(Dataset):
+    """
+    A dataset of preprocessed image files. Each item is (index, image tensor, whether the image could be read);
+    unreadable images are given as a tensor of zeros.
+    """
+    def __init__(self, image_fns:Sequence[str], preprocessor:ImagePreprocessor=None):
+        self.image_fns = image_fns
+        self.preprocessor = preprocessor if preprocessor is not None else ImagePreprocessor()
+
+    def __len__(self): return len(self.image_fns)
+
+    def __getitem__(self, i):
+        x = torch.zeros((3,) + self.preprocessor.size)
+        try:
+            self.preprocessor(self.image_fns[i], out=x)
+            return i, x, True
+        except Exception:
+            return i, x, False
+
+## Functions
+def predict_images(image_fns:Sequence[str], stage_net:Callable, locations_net:Callable, bs:int=64,
+                   num_workers:int=0, device=None) -> Iterator[Tuple[List[int], List[int], torch.Tensor, torch.Tensor]]:
+    """
+    Runs the stage and locations models over image files, decoding them in parallel.
+
+    Arguments:
+    - image_fns: the paths of the images
+    - stage_net: the stage model (or any function that accepts a batch of images and returns their stage predictions)
+    - locations_net: the locations model, which returns the locations predictions before the sigmoid (applied here)
+    - bs: the number of images run through the models at once
+    - num_workers: the number of processes that decode images (0 decodes them in this process)
+    - device: the device to run the models on
+
+    Yields:
+    For each batch, in order: (indices of the images predicted on, indices of the images that couldn't be read,
+    their stage predictions, their locations predictions). If none of a batch's images could be read, its predictions
+    are empty tensors (whose number of columns isn't meaningful), so callers should skip them.
+    """
+    loader = DataLoader(ImageFileDataset(image_fns), batch_size=bs, shuffle=False, num_workers=num_workers)
+    with inference_mode():
+        for indices, xb, ok in loader:
+            failed = indices[~ok].tolist()
+            indices, xb = indices[ok].tolist(), xb[ok]
+            if not indices:
+                yield indices, failed, torch.empty(0, 1), torch.empty(0, 0)
+                continue
+            if device is not None: xb = xb.to(device)
+            yield indices, failed, stage_net(xb).cpu(), locations_net(xb).sigmoid().cpu()
+
+def append_new_predictions(store_dir:str, fnames:Sequence[str], image_fns:Sequence[str], stage_net:Callable,
+                           locations_net:Callable, bs:int=64, num_workers:int=0, device=None,
+                           chunk_size:int=1024, on_chunk:Callable[[int], None]=None) -> Tuple[List[str], List[str]]:
+    """
+    Predicts on new images (see `predict_images`) and appends their predictions to the prediction store in
+    `store_dir`, a chunk of at least `chunk_size` images at a time, so an interrupted run keeps what it has saved.
+
+    Arguments:
+    - store_dir: the directory containing the prediction store
+    - fnames: the filenames the images are saved under in the store
+    - image_fns: the paths of the images (in the same order)
+    - stage_net, locations_net, bs, num_workers, device: as for `predict_images`
+    - chunk_size: the number of new predictions saved at a time
+    - on_chunk: optionally, called with the total number of images saved after each chunk is saved
+
+    Returns:
+    (the filenames of the images saved, the filenames of the images that couldn't be read)
+    """
+    added_fnames, unreadable_fnames = [], []
+    chunk_fnames, chunk_stage_preds, chunk_locations_preds = [], [], []
+    def save_chunk():
+        if chunk_fnames:
+            stages, locations = torch.cat(chunk_stage_preds), torch.cat(chunk_locations_preds)
+            assert len(chunk_fnames) == len(stages) == len(locations)
+            append_predictions(store_dir, chunk_fnames, stages, locations)
+            added_fnames.extend(chunk_fnames)
+            if on_chunk is not None: on_chunk(len(added_fnames))
+        chunk_fnames.clear(); chunk_stage_preds.clear(); chunk_locations_preds.clear()
+    for indices, failed, stage_preds, locations_preds in predict_images(
+            image_fns, stage_net, locations_net, bs=bs, num_workers=num_workers, device=device):
+        unreadable_fnames += [fnames[i] for i in failed]
+        # Batches where every image was unreadable have no predictions
+        if not indices: continue
+        chunk_fnames += [fnames[i] for i in indices]
+        chunk_stage_preds.append(stage_preds)
+        chunk_locations_preds.append(locations_preds)
+        if len(chunk_fnames) >= chunk_size: save_chunk()
+    save_chunk()
+    return added_fnames, unreadable_fnames
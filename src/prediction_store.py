@@ -0,0 +1,483 @@
+"""
+File: prediction_store.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Stores the saved predictions on the Geisha database images in a memory-mapped, columnar format.
+
+The saved predictions used to live in a single pickled tuple (database-image-predictions.pkl), which every search
+process unpickled into its own private memory, and which update-data.py rewrote entirely on every run. The store
+defined here keeps each column in its own file within a directory (data/predictions by default):
+- filenames-<generation>.txt: the database image filenames, one per line
+- stages-<generation>.npy: the stage predictions, shape (capacity, 1)
+- locations-<generation>.npy: the locations predictions, shape (capacity, number of locations)
+- manifest.json: which generation of files is current, how many rows of them are valid, the store's version, its
+lineage (which changes whenever the store is recreated, rather than appended to), and (once reindexed) which models
+made the predictions
+
+Readers open the arrays memory-mapped (optionally stored as float16), so processes share the same pages. The array
+files are allocated with spare capacity: new rows are written past the last valid row, and only become visible when
+a new manifest is swapped in (atomically, with os.replace). When the capacity runs out, a new generation of files
+is written and published the same way. The previous generation is kept until the one after it is published, so
+processes that are still reading it aren't disrupted.
+
+Search processes use PredictionStore, which notices when a new version is published and switches to it without a
+restart. update-data.py uses `append_predictions`, and the existing pickle is converted with `convert_pickle`
+(see convert-predictions.py).
+
+When the models are retrained, every prediction is regenerated into a new generation of files (see
+reindex-predictions.py). Until it is complete, that generation is staged: it is described by reindex.json (which
+also records how far the reindex has got, so an interrupted one resumes) rather than by the manifest, so readers
+never see it. `publish_reindex` then swaps it in as a new version and lineage, and records the generation it
+replaced in the manifest, whose files are kept so that `rollback` can switch back to it.
+
+Readers never block, but only one writer can change the store at a time: every function that does (appending, and
+each step of a reindex) holds an exclusive lock on the store's lock file while it runs (see `store_lock`).
+"""
+
+## Libraries
+import fcntl
+import json
+import os
+import pickle
+import threading
+import time
+from contextlib import contextmanager
+from typing import NamedTuple, Callable, Any, Sequence, Tuple, List, Optional
+import numpy as np
+
+## Settings
+MANIFEST_FN = "manifest.json"
+# The staged generation of a reindex, and the images it reindexes (see `begin_reindex`)
+REINDEX_FN = "reindex.json"
+REINDEX_IMAGES_FN = "reindex-images.txt"
+# The file locked by writers (see `store_lock`)
+LOCK_FN = "lock"
+# Minimum number of rows allocated for a new generation of array files
+MIN_CAPACITY = 1024
+
+## Objects
+class PredictionSnapshot(NamedTuple):
+    """
+    One version of the saved predictions. `stages` and `locations` are views of copy-on-write memory-mapped arrays with
+    `count` rows; `filenames` is an array of the corresponding filenames. Versions with the same `lineage` only differ
+    by rows appended to the end. `models` identifies the models that made the predictions (see `model_fingerprint` in
+    model_export.py), if known.
+    """
+    version: int
+    count: int
+    filenames: np.ndarray
+    stages: np.ndarray
+    locations: np.ndarray
+    lineage: int = 0
+    models: Optional[dict] = None
+
+class PredictionStore():
+    """
+    Reads the prediction store in `store_dir`, and keeps track of the current version.
+
+    Arguments:
+    - store_dir: the directory containing the store
+    - loader: a function that converts each PredictionSnapshot loaded into the object returned by `current` (e.g. to
+    build indexes on it). It is called with the snapshot and the object loaded from the previous version (None at
+    first), so indexes can be extended rather than rebuilt. Defaults to returning the snapshot itself.
+    - reload_interval: how often (in seconds) `current` checks for a new version. None disables the checks; call
+    `refresh` to check manually.
+
+    Switching versions is a single reference swap, so requests still running on the previous version are unaffected.
+    """
+    def __init__(self, store_dir:str, loader:Callable[[PredictionSnapshot, Any], Any]=None, reload_interval:float=5.):
+        self.store_dir = store_dir
+        self.loader = loader if loader is not None else (lambda snapshot, previous: snapshot)
+        self.reload_interval = reload_interval
+        self.version = None
+        self._current = None
+        self._manifest_stat = None
+        self._last_check = 0.
+        self._lock = threading.Lock()
+        self.refresh(force=True)
+
+    def current(self):
+        "Returns the loaded form of the current version, first checking for a new one if it's time to."
+        if self.reload_interval is not None and time.monotonic() - self._last_check >= self.reload_interval:
+            self.refresh()
+        return self._current
+
+    def refresh(self, force:bool=False) -> bool:
+        """
+        Loads the latest version of the store if it has changed since it was last loaded (or if `force` is given).
+        Returns whether a new version was loaded. If another thread is already checking, returns immediately.
+        """
+        if not self._lock.acquire(blocking=force): return False
+        try:
+            self._last_check = time.monotonic()
+            stat = os.stat(os.path.join(self.store_dir, MANIFEST_FN))
+            manifest_stat = (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+            if not force and manifest_stat == self._manifest_stat: return False
+            snapshot = load_snapshot(self.store_dir)
+            self._manifest_stat = manifest_stat
+            if not force and snapshot.version == self.version: return False
+            self._current = self.loader(snapshot, self._current)
+            self.version = snapshot.version
+            return True
+        finally:
+            self._lock.release()
+
+# The store locks held by this process, as {lock file path: [thread lock, depth, open lock file]}
+_held_locks = {}
+_held_locks_lock = threading.Lock()
+
+## Functions
+@contextmanager
+def store_lock(store_dir:str):
+    """
+    Holds an exclusive lock on the store in `store_dir` (an flock on its lock file), waiting for any other process
+    or thread that holds it. Functions that change the store take it themselves; callers can also hold it across
+    several of them (e.g. to check nothing was appended before publishing a reindex), since it is re-entrant.
+    """
+    path = os.path.realpath(os.path.join(store_dir, LOCK_FN))
+    with _held_locks_lock:
+        held = _held_locks.setdefault(path, [threading.RLock(), 0, None])
+    with held[0]:
+        if held[1] == 0:
+            held[2] = open(path, "a")
+            fcntl.flock(held[2], fcntl.LOCK_EX)
+        held[1] += 1
+        try:
+            yield
+        finally:
+            held[1] -= 1
+            if held[1] == 0:
+                # Closing the file releases the flock
+                held[2].close()
+                held[2] = None
+
+def store_exists(store_dir:str) -> bool:
+    "Returns whether `store_dir` contains a prediction store."
+    return os.path.exists(os.path.join(store_dir, MANIFEST_FN))
+
+def read_manifest(store_dir:str) -> dict:
+    "Reads the manifest of the store in `store_dir`."
+    with open(os.path.join(store_dir, MANIFEST_FN), "r") as file:
+        return json.load(file)
+
+def load_snapshot(store_dir:str, manifest:dict=None) -> PredictionSnapshot:
+    """
+    Opens the version of the store described by `manifest` (the current manifest by default). The stage and locations
+    arrays are memory-mapped copy-on-write, so they share pages with every other process reading the store.
+    """
+    # The files of the current generation may be replaced between reading the manifest and opening them, so retry
+    for attempt in range(3):
+        current_manifest = manifest if manifest is not None else read_manifest(store_dir)
+        try:
+            return _open_generation(store_dir, current_manifest)
+        except FileNotFoundError:
+            if manifest is not None or attempt == 2: raise
+
+def _open_generation(store_dir:str, manifest:dict) -> PredictionSnapshot:
+    "Opens the files described by `manifest`, limited to its valid rows."
+    count = manifest["count"]
+    with open(os.path.join(store_dir, manifest["filenames"]), "rb") as file:
+        filenames = file.read(manifest["filenames_nbytes"]).decode("utf-8").split("\n")[:count]
+    filenames = np.array(filenames, dtype=object)
+    stages = np.load(os.path.join(store_dir, manifest["stages"]), mmap_mode="c")[:count]
+    locations = np.load(os.path.join(store_dir, manifest["locations"]), mmap_mode="c")[:count]
+    return PredictionSnapshot(manifest.get("version", 0), count, filenames, stages, locations,
+                              manifest.get("lineage", 0), manifest.get("models"))
+
+def create_store(store_dir:str, filenames:Sequence[str], stages, locations, dtype:str="float32") -> dict:
+    """
+    Creates a new prediction store in `store_dir` (replacing any current version) containing the given predictions.
+
+    Arguments:
+    - store_dir: the directory to write the store to
+    - filenames: the database image filenames
+    - stages: the stage predictions, shape (N,) or (N, 1) (numpy arrays or PyTorch tensors)
+    - locations: the locations predictions, shape (N, number of locations)
+    - dtype: the type to store predictions as, "float32" or "float16"
+
+    Returns:
+    The published manifest.
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    stages, locations = _as_rows(stages), _as_rows(locations)
+    with store_lock(store_dir):
+        previous = read_manifest(store_dir) if store_exists(store_dir) else None
+        manifest = {"version": previous["version"] if previous else 0,
+                    "lineage": previous.get("lineage", 0)+1 if previous else 1,
+                    "generation": _next_generation(store_dir),
+                    "count": 0, "filenames_nbytes": 0, "dtype": np.dtype(dtype).name,
+                    "num_locations": locations.shape[1], "capacity": max(MIN_CAPACITY, 2*len(filenames))}
+        _write_generation(store_dir, manifest, [], None, None)
+        return _append_to_generation(store_dir, manifest, previous, filenames, stages, locations)
+
+def append_predictions(store_dir:str, filenames:Sequence[str], stages, locations) -> dict:
+    """
+    Appends new rows to the prediction store in `store_dir`, and publishes them as a new version.
+
+    Rows are written into the spare capacity of the current array files, past the rows readers can see, and are
+    published by atomically swapping in a new manifest. If the files are full, a new generation with double the
+    capacity is written instead. Appends (and other changes to the store) are serialized by the store's lock.
+
+    Returns:
+    The published manifest.
+    """
+    stages, locations = _as_rows(stages), _as_rows(locations)
+    assert len(filenames) == len(stages) == len(locations)
+    with store_lock(store_dir):
+        manifest = read_manifest(store_dir)
+        assert locations.shape[1] == manifest["num_locations"]
+        if manifest["count"] + len(filenames) <= manifest["capacity"]:
+            return _append_to_generation(store_dir, dict(manifest), None, filenames, stages, locations)
+        # Out of capacity: copy the existing rows into a larger generation of files
+        snapshot = load_snapshot(store_dir, manifest)
+        new_manifest = dict(manifest, generation=_next_generation(store_dir), count=0, filenames_nbytes=0,
+                            capacity=max(2*manifest["capacity"], 2*(manifest["count"]+len(filenames))))
+        _write_generation(store_dir, new_manifest, snapshot.filenames, snapshot.stages, snapshot.locations)
+        return _append_to_generation(store_dir, new_manifest, manifest, filenames, stages, locations)
+
+def begin_reindex(store_dir:str, image_fns:Sequence[str], num_locations:int, job:dict=None,
+                  dtype:str=None) -> Tuple[dict, List[str]]:
+    """
+    Starts a reindex of the store in `store_dir`: stages a new, unpublished generation of files for the predictions
+    of `image_fns`, to be filled in with `checkpoint_reindex` and published with `publish_reindex`.
+
+    If a reindex of the same `job` was interrupted, it is resumed instead: its staged generation and list of images
+    are returned as they were last checkpointed. A staged reindex of a different job is discarded.
+
+    Arguments:
+    - store_dir: the directory containing the store
+    - image_fns: the filenames of the images to reindex, in the order they'll be predicted on
+    - num_locations: the number of locations predicted
+    - job: describes the reindex (e.g. where its images came from, and which models predict on them). Only a reindex
+    of an equal job is resumed.
+    - dtype: the type to store predictions as. Defaults to the current version's.
+
+    Returns:
+    (the staged manifest, the filenames of the images to reindex). The manifest's "position" is the number of those
+    images already predicted on (and saved, or skipped as unreadable).
+    """
+    job = json.loads(json.dumps(job or {}))
+    with store_lock(store_dir):
+        live = read_manifest(store_dir)
+        staged = read_reindex(store_dir)
+        if staged is not None and staged["job"] == job:
+            with open(os.path.join(store_dir, REINDEX_IMAGES_FN), "r", encoding="utf-8") as file:
+                return staged, file.read().split("\n")[:staged["total"]]
+        if staged is not None: abort_reindex(store_dir)
+        image_fns = list(image_fns)
+        _write_text(os.path.join(store_dir, REINDEX_IMAGES_FN), "\n".join(image_fns))
+        manifest = {"generation": _next_generation(store_dir), "count": 0, "filenames_nbytes": 0,
+                    "dtype": np.dtype(dtype or live["dtype"]).name, "num_locations": num_locations,
+                    "capacity": max(MIN_CAPACITY, 2*len(image_fns)), "position": 0, "skipped": 0,
+                    "total": len(image_fns), "job": job,
+                    "base": {"version": live["version"], "lineage": live.get("lineage", 0), "count": live["count"]}}
+        _write_generation(store_dir, manifest, [], None, None)
+        _publish(store_dir, manifest, REINDEX_FN)
+        return manifest, image_fns
+
+def read_reindex(store_dir:str) -> Optional[dict]:
+    "Reads the manifest of the reindex staged in `store_dir`, or returns None if there isn't one."
+    try:
+        with open(os.path.join(store_dir, REINDEX_FN), "r") as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return None
+
+def checkpoint_reindex(store_dir:str, manifest:dict, filenames:Sequence[str], stages, locations, position:int,
+                       skipped:int=0) -> dict:
+    """
+    Writes a chunk of reindexed predictions into the staged generation described by `manifest` (see `begin_reindex`),
+    then atomically records that the first `position` images of the reindex are done (`skipped` more of which were
+    unreadable). If the reindex is interrupted, it resumes from the last checkpoint.
+
+    Returns:
+    The updated staged manifest.
+    """
+    manifest = dict(manifest)
+    stages, locations = _as_rows(stages), _as_rows(locations)
+    assert len(filenames) == len(stages) == len(locations)
+    with store_lock(store_dir):
+        replaced = None
+        if manifest["count"] + len(filenames) > manifest["capacity"]:
+            # Out of capacity (e.g. from images appended to the store while reindexing): copy into larger files
+            staged = _open_generation(store_dir, manifest)
+            grown = dict(manifest, generation=_next_generation(store_dir), count=0, filenames_nbytes=0,
+                         capacity=2*(manifest["count"]+len(filenames)))
+            _write_generation(store_dir, grown, staged.filenames, staged.stages, staged.locations)
+            replaced, manifest = manifest, grown
+        _write_rows(store_dir, manifest, filenames, stages, locations)
+        manifest["position"], manifest["skipped"] = position, manifest["skipped"] + skipped
+        _publish(store_dir, manifest, REINDEX_FN)
+        # The smaller files are only removed once the staged manifest no longer refers to them
+        if replaced is not None: _remove_generation(store_dir, replaced["generation"])
+        return manifest
+
+def publish_reindex(store_dir:str, models:dict=None) -> dict:
+    """
+    Publishes the staged reindex in `store_dir` as the current version of the store, with a new lineage (so readers
+    rebuild their indexes). The version it replaces is recorded in the new manifest ("rollback"), and its files are
+    kept until the next reindex, so `rollback` can switch back to it. `models` identifies the models that made the
+    reindexed predictions (see `model_fingerprint` in model_export.py), and is recorded in the manifest too.
+
+    Returns:
+    The published manifest.
+    """
+    with store_lock(store_dir):
+        live, staged = read_manifest(store_dir), read_reindex(store_dir)
+        if staged is None: raise FileNotFoundError(f"No reindex is staged in {store_dir}")
+        manifest = {key: value for key, value in staged.items() if key not in ("position", "skipped", "total", "base")}
+        manifest.update(version=live["version"]+1, lineage=live.get("lineage", 0)+1, rollback=_without_rollback(live))
+        if models is not None: manifest["models"] = models
+        _publish(store_dir, manifest)
+        for fn in (REINDEX_FN, REINDEX_IMAGES_FN):
+            os.remove(os.path.join(store_dir, fn))
+        _remove_old_generations(store_dir, keep={manifest["generation"], live["generation"]})
+        return manifest
+
+def abort_reindex(store_dir:str):
+    "Discards the reindex staged in `store_dir` (if any), and its files."
+    with store_lock(store_dir):
+        staged = read_reindex(store_dir)
+        if staged is None: return
+        for fn in (REINDEX_FN, REINDEX_IMAGES_FN):
+            if os.path.exists(os.path.join(store_dir, fn)): os.remove(os.path.join(store_dir, fn))
+        _remove_generation(store_dir, staged["generation"])
+
+def rollback(store_dir:str) -> dict:
+    """
+    Switches the store in `store_dir` back to the version a reindex replaced (see `publish_reindex`), publishing it
+    as a new version and lineage. The version rolled back from becomes the one recorded for rollback, so calling
+    this again rolls forward. Images appended since the reindex was published aren't in the version rolled back to.
+    The version rolled back to keeps the record of the models that made it, so restore those models too.
+
+    Returns:
+    The published manifest.
+    """
+    with store_lock(store_dir):
+        live = read_manifest(store_dir)
+        if not live.get("rollback"): raise FileNotFoundError(f"No previous version of {store_dir} to roll back to")
+        manifest = dict(live["rollback"], version=live["version"]+1, lineage=live.get("lineage", 0)+1,
+                        rollback=_without_rollback(live))
+        _publish(store_dir, manifest)
+        return manifest
+
+def convert_pickle(pickle_fn:str, store_dir:str, dtype:str="float32") -> dict:
+    """
+    Converts the legacy pickled (filenames, stages, locations) tuple in `pickle_fn` into a prediction store in
+    `store_dir`. Returns the published manifest. Filenames pickled as other types (e.g. Paths) are saved as strings.
+    """
+    with open(pickle_fn, "rb") as inp:
+        filenames, stages, locations = pickle.load(inp)
+    return create_store(store_dir, [str(fn) for fn in filenames], stages, locations, dtype=dtype)
+
+def _as_rows(preds) -> np.ndarray:
+    "Converts predictions (numpy arrays or PyTorch tensors) into a 2D numpy array with one row per image."
+    if hasattr(preds, "detach"): preds = preds.detach().cpu().numpy()
+    preds = np.asarray(preds)
+    # (The row width is given explicitly, since -1 can't be inferred for an empty chunk)
+    return preds.reshape(len(preds), int(np.prod(preds.shape[1:])))
+
+def _generation_fns(generation:int) -> dict:
+    "Returns the names of the files that make up a generation of the store."
+    return {"filenames": f"filenames-{generation:06d}.txt", "stages": f"stages-{generation:06d}.npy",
+            "locations": f"locations-{generation:06d}.npy"}
+
+def _write_generation(store_dir:str, manifest:dict, filenames, stages, locations):
+    """
+    Creates the (unpublished) files of a new generation with `manifest["capacity"]` rows, and copies the given rows
+    into them. Updates `manifest` with the file names and the number of rows written.
+    """
+    manifest.update(_generation_fns(manifest["generation"]))
+    capacity, dtype = manifest["capacity"], np.dtype(manifest["dtype"])
+    stages_out = np.lib.format.open_memmap(os.path.join(store_dir, manifest["stages"]), mode="w+",
+                                           dtype=dtype, shape=(capacity, 1))
+    locations_out = np.lib.format.open_memmap(os.path.join(store_dir, manifest["locations"]), mode="w+",
+                                              dtype=dtype, shape=(capacity, manifest["num_locations"]))
+    count = len(filenames)
+    if count:
+        stages_out[:count] = stages
+        locations_out[:count] = locations
+    stages_out.flush(); locations_out.flush()
+    del stages_out, locations_out
+    encoded = "".join(str(fn) + "\n" for fn in filenames).encode("utf-8")
+    with open(os.path.join(store_dir, manifest["filenames"]), "wb") as file:
+        file.write(encoded)
+        file.flush(); os.fsync(file.fileno())
+    manifest["count"], manifest["filenames_nbytes"] = count, len(encoded)
+
+def _append_to_generation(store_dir:str, manifest:dict, replaced:dict, filenames, stages, locations) -> dict:
+    """
+    Writes rows into the spare capacity of the generation described by `manifest`, then publishes it as a new version.
+    `replaced` is the manifest of the generation being replaced by this one (if any), so older ones can be removed.
+    """
+    _write_rows(store_dir, manifest, filenames, stages, locations)
+    manifest["version"] += 1
+    _publish(store_dir, manifest)
+    if replaced is not None: _remove_old_generations(store_dir, keep={manifest["generation"], replaced["generation"]})
+    return manifest
+
+def _write_rows(store_dir:str, manifest:dict, filenames, stages, locations):
+    "Writes rows into the spare capacity of the generation described by `manifest`, and updates its row count."
+    start, end = manifest["count"], manifest["count"] + len(filenames)
+    if len(filenames):
+        stages_out = np.load(os.path.join(store_dir, manifest["stages"]), mmap_mode="r+")
+        locations_out = np.load(os.path.join(store_dir, manifest["locations"]), mmap_mode="r+")
+        stages_out[start:end] = stages
+        locations_out[start:end] = locations
+        stages_out.flush(); locations_out.flush()
+        del stages_out, locations_out
+        # Unpublished bytes past filenames_nbytes (e.g. from an interrupted append) are overwritten
+        encoded = "".join(str(fn) + "\n" for fn in filenames).encode("utf-8")
+        with open(os.path.join(store_dir, manifest["filenames"]), "r+b") as file:
+            file.seek(manifest["filenames_nbytes"])
+            file.write(encoded)
+            file.truncate()
+            file.flush(); os.fsync(file.fileno())
+        manifest["filenames_nbytes"] += len(encoded)
+    manifest["count"] = end
+
+def _publish(store_dir:str, manifest:dict, manifest_fn:str=MANIFEST_FN):
+    "Atomically replaces the store's manifest (or another manifest, e.g. a staged reindex's), making `manifest` current."
+    _write_text(os.path.join(store_dir, manifest_fn), json.dumps(manifest, indent=2))
+
+def _write_text(fn:str, text:str):
+    "Atomically replaces the file `fn` with `text`."
+    with open(fn + ".tmp", "w", encoding="utf-8") as file:
+        file.write(text)
+        file.flush(); os.fsync(file.fileno())
+    os.replace(fn + ".tmp", fn)
+
+def _without_rollback(manifest:dict) -> dict:
+    "Returns a manifest without the version it can roll back to (so rollbacks don't nest)."
+    return {key: value for key, value in manifest.items() if key != "rollback"}
+
+def _generations(store_dir:str) -> dict:
+    "Returns the files of each generation in `store_dir`, as {generation: [file names]}."
+    generations = {}
+    for fn in os.listdir(store_dir):
+        name, _, rest = fn.partition("-")
+        if name not in ("filenames", "stages", "locations"): continue
+        generation = rest.split(".")[0]
+        if generation.isdigit(): generations.setdefault(int(generation), []).append(fn)
+    return generations
+
+def _next_generation(store_dir:str) -> int:
+    "Returns a generation number that no files in `store_dir` use yet."
+    return max(_generations(store_dir), default=0) + 1
+
+def _remove_generation(store_dir:str, generation:int):
+    "Deletes the files of one generation."
+    for fn in _generations(store_dir).get(generation, []):
+        os.remove(os.path.join(store_dir, fn))
+
+def _remove_old_generations(store_dir:str, keep:set):
+    """
+    Deletes the files of generations not in `keep`. The generation the current version can roll back to, and the
+    generation of a staged reindex, are always kept.
+    """
+    keep = set(keep)
+    rollback = read_manifest(store_dir).get("rollback")
+    if rollback: keep.add(rollback["generation"])
+    staged = read_reindex(store_dir)
+    if staged is not None: keep.add(staged["generation"])
+    for generation in _generations(store_dir):
+        if generation not in keep: _remove_generation(store_dir, generation)
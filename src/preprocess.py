@@ -0,0 +1,115 @@
+"""
+File: preprocess.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Converts embryo images into the normalized tensors that the trained models predict on.
+
+Previously, every image was wrapped in a fastai DataBunch (ImageList -> split_none -> label_empty -> transform ->
+databunch -> normalize) just to be fed to the models, which costs more than decoding the image itself. This module
+goes directly from an image (a file, raw bytes, or a file-like object) to a normalized 400 (h) x 300 (w) tensor:
+- Images are decoded with PIL and converted to RGB, as fastai's `open_image` does
+- Images are resized the same way fastai resizes them (an area downsample for large images, then bilinear
+interpolation with aligned corners), so predictions match the DataBunch path within floating point tolerance
+- imagenet_stats normalization is folded into a single scale-and-shift, written into a preallocated output tensor
+
+Both search.py (for input embryos) and update-data.py (for new database images) use the ImagePreprocessor.
+"""
+
+## Libraries
+import io
+from typing import Union, Sequence
+import numpy as np
+import torch
+import torch.nn.functional as F
+from PIL import Image
+
+## Settings
+# Size that the models were trained on, (height, width)
+IMAGE_SIZE = (400, 300)
+# The imagenet_stats that fastai normalizes with, (mean, std)
+IMAGENET_STATS = ([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
+
+ImageSource = Union[str, bytes, io.IOBase]
+
+## Functions
+def open_image_array(image:ImageSource) -> np.ndarray:
+    """
+    Decodes an image into an RGB uint8 array of shape (height, width, 3).
+
+    Arguments:
+    - image: the path to an image file, the raw bytes of an image, or a file-like object containing an image
+    """
+    if isinstance(image, (bytes, bytearray)): image = io.BytesIO(image)
+    with Image.open(image) as im:
+        return np.array(im.convert("RGB"))
+
+## Objects
+class ImagePreprocessor():
+    """
+    Converts images into normalized tensors for the trained models, matching the fastai DataBunch pipeline.
+
+    Arguments:
+    - size: the (height, width) to resize images to
+    - stats: the (mean, std) of each channel to normalize with
+    """
+    def __init__(self, size=IMAGE_SIZE, stats=IMAGENET_STATS):
+        self.size = tuple(size)
+        mean, std = (torch.tensor(stat, dtype=torch.float32).view(3, 1, 1) for stat in stats)
+        # (x/255 - mean)/std == x*scale - shift
+        self.scale = 1/(255*std)
+        self.shift = mean/std
+
+    def resize(self, image_array:np.ndarray) -> torch.Tensor:
+        """
+        Resizes an RGB uint8 array of shape (height, width, 3) into a float tensor of shape (3, *self.size), with the
+        same interpolation fastai uses to "squish" an image to a fixed size. Values stay in [0, 255].
+        """
+        x = torch.from_numpy(np.ascontiguousarray(image_array)).permute(2, 0, 1).float()[None]
+        h, w = self.size
+        # fastai first area-downsamples images more than twice as large as the target
+        d = min(x.shape[2]/h, x.shape[3]/w)/2
+        if d > 1: x = F.interpolate(x, scale_factor=1/d, mode="area")
+        return F.interpolate(x, size=self.size, mode="bilinear", align_corners=True)[0]
+
+    def __call__(self, image:ImageSource, out:torch.Tensor=None) -> torch.Tensor:
+        """
+        Converts a single image into a normalized tensor of shape (1, 3, *self.size), ready for the models.
+
+        Arguments:
+        - image: the path to an image file, the raw bytes of an image, or a file-like object containing an image
+        - out: optionally, a preallocated tensor of shape (1, 3, *self.size) (or (3, *self.size)) to write into
+        """
+        if out is None: out = torch.empty((1, 3) + self.size, dtype=torch.float32)
+        self.normalize(self.resize(open_image_array(image)), out=out.view((3,) + self.size))
+        return out
+
+    def normalize(self, x:torch.Tensor, out:torch.Tensor) -> torch.Tensor:
+        "Normalizes a resized image tensor `x` (values in [0, 255]) with the imagenet stats, writing into `out`."
+        torch.mul(x, self.scale, out=out)
+        return out.sub_(self.shift)
+
+    def batch(self, images:Sequence[ImageSource], out:torch.Tensor=None) -> torch.Tensor:
+        """
+        Converts several images into one normalized batch of shape (len(images), 3, *self.size), written into `out`
+        if it is given (and has room for them).
+        """
+        if out is None: out = torch.empty((len(images), 3) + self.size, dtype=torch.float32)
+        for i, image in enumerate(images):
+            self(image, out=out[i])
+        return out[:len(images)]
+
+def check_against_databunch(image_fns:Sequence[str], atol:float=1e-3) -> float:
+    """
+    Compares the tensors this module produces with the ones the fastai DataBunch pipeline produces for the same
+    images, and returns the largest absolute difference. Raises an AssertionError if it is larger than `atol`.
+    Requires fastai.
+    """
+    from fastai.vision import ImageList, imagenet_stats
+    preprocessor = ImagePreprocessor()
+    max_diff = 0.
+    for image_fn in image_fns:
+        data = (ImageList([image_fn]).split_none().label_empty().transform(tfms=([],[]), size=IMAGE_SIZE)
+                .databunch(bs=1).normalize(imagenet_stats))
+        xb, _ = data.one_item(data.train_ds[0][0])
+        max_diff = max(max_diff, (xb.cpu() - preprocessor(image_fn)).abs().max().item())
+    assert max_diff <= atol, f"Preprocessing differs from the DataBunch pipeline by {max_diff}"
+    return max_diff
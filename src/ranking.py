@@ -0,0 +1,207 @@
+"""
+File: ranking.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Ranks the database images by similarity to an input embryo, returning only the top results.
+
+The `similarity` framework in search.py computes stage and locations similarities with separate functions, then
+sorts the entire database. For the default algorithm (negative absolute stage difference and euclidean locations
+similarity, see search.py), this module computes the same ranking in a single vectorized pass:
+- Stage and locations similarities are written into buffers that are allocated once, rather than per query
+- Euclidean distances use the precomputed squared norms of the database locations vectors, so only one
+matrix-vector product over the database is needed
+- The z-scored, alpha-weighted combination is folded into a single scale-and-add
+- Only the top `n` images are selected (a partial sort), instead of sorting the whole database
+
+A subset of the database (e.g. the images matching a search filter) can be ranked on its own (`top_n_subset`), with
+z-scores over the subset. Many input embryos can also be ranked at once (`top_n_batch`), computing a query x database
+similarity matrix a block of queries at a time, so that memory use stays bounded however many queries there are.
+
+Locations vectors stored at reduced precision (float16, see prediction_store.py) are used in place, and converted
+to float32 a chunk at a time, so the engine doesn't need a private float32 copy of the database.
+"""
+
+## Libraries
+import threading
+import torch
+
+## Settings
+# A similarity counts as constant (and contributes nothing to rankings) if its standard deviation is at most this
+# fraction of its mean's magnitude: in float32, a constant similarity's standard deviation is rounding noise, not 0
+CONSTANT_TOLERANCE = 1e-5
+
+## Objects
+class RankingEngine():
+    """
+    Ranks the database images against input embryos with the default similarity algorithm.
+
+    Arguments:
+    - stages: the saved stage predictions of the database images, shape (N,) or (N, 1)
+    - locations: the saved locations predictions of the database images, shape (N, number of locations)
+    - chunk_size: the number of rows converted to float32 at a time when `locations` is stored at lower precision
+
+    Buffers are kept per thread, so one engine can be shared by concurrent requests.
+    """
+    def __init__(self, stages, locations, chunk_size:int=65536):
+        self.stages = torch.as_tensor(stages, dtype=torch.float32).reshape(-1).contiguous()
+        self.locations = torch.as_tensor(locations)
+        if not self.locations.is_floating_point(): self.locations = self.locations.float()
+        assert self.stages.shape[0] == self.locations.shape[0]
+        self.chunk_size = chunk_size
+        self.locations_sq_norms = torch.empty(len(self), dtype=torch.float32)
+        for start, chunk in self._locations_chunks():
+            torch.sum(chunk*chunk, dim=1, out=self.locations_sq_norms[start:start+len(chunk)])
+        self._buffers = threading.local()
+
+    def __len__(self): return self.stages.shape[0]
+
+    def _locations_chunks(self):
+        "Yields (start row, float32 rows) for the database locations vectors, a chunk at a time if needed."
+        if self.locations.dtype == torch.float32:
+            yield 0, self.locations
+            return
+        for start in range(0, len(self), self.chunk_size):
+            yield start, self.locations[start:start+self.chunk_size].float()
+
+    def _get_buffers(self):
+        "Returns this thread's (stage, locations, combined) similarity buffers, allocating them on first use."
+        buffers = getattr(self._buffers, "value", None)
+        if buffers is None:
+            buffers = tuple(torch.empty(len(self), dtype=torch.float32) for _ in range(3))
+            self._buffers.value = buffers
+        return buffers
+
+    def similarities(self, stage_pred, locations_pred):
+        """
+        Computes the stage similarity (negative absolute difference) and the locations similarity (1/(1 + euclidean
+        distance)) of every database image to the input embryo. Returns (stage similarities, locations similarities),
+        which are the engine's buffers: they are overwritten by the next call on the same thread.
+        """
+        stage_sims, locations_sims, _ = self._get_buffers()
+        with torch.no_grad():
+            stage_pred = torch.as_tensor(stage_pred, dtype=torch.float32).reshape(-1)[0]
+            query = torch.as_tensor(locations_pred, dtype=torch.float32).reshape(-1)
+            # Stage similarity: negative absolute difference
+            torch.sub(self.stages, stage_pred, out=stage_sims)
+            stage_sims.abs_().neg_()
+            # Locations similarity: 1/(1 + euclidean distance), with ||a-b||^2 = ||a||^2 - 2a.b + ||b||^2
+            for start, chunk in self._locations_chunks():
+                torch.mv(chunk, query, out=locations_sims[start:start+len(chunk)])
+            locations_sims.mul_(-2).add_(self.locations_sq_norms).add_(query.dot(query))
+            locations_sims.clamp_(min=0).sqrt_().add_(1).reciprocal_()
+        return stage_sims, locations_sims
+
+    def scores(self, stage_pred, locations_pred, alpha:float=0.5):
+        """
+        Computes the combined similarity score of every database image, as in `similarity` with the default
+        algorithm: alpha*z(stage similarity) + (1-alpha)*z(locations similarity).
+
+        Arguments:
+        - stage_pred: the input embryo's stage prediction (a single value)
+        - locations_pred: the input embryo's locations prediction (a vector)
+        - alpha: the percent weight given to the stage similarity
+
+        Returns:
+        A tensor of combined scores (one for each database image). This is one of the engine's buffers, so it is
+        overwritten by the next call on the same thread; clone it to keep it.
+        """
+        stage_sims, locations_sims = self.similarities(stage_pred, locations_pred)
+        combined_sims = self._get_buffers()[2]
+        with torch.no_grad():
+            # Combine z-scores: a*(s - mean_s)/std_s + (1-a)*(l - mean_l)/std_l
+            stage_weight, stage_shift = _z_score_coefficients(stage_sims, alpha)
+            locations_weight, locations_shift = _z_score_coefficients(locations_sims, 1-alpha)
+            torch.mul(stage_sims, stage_weight, out=combined_sims)
+            combined_sims.add_(locations_sims, alpha=locations_weight).sub_(stage_shift + locations_shift)
+        return combined_sims
+
+    def top_n(self, stage_pred, locations_pred, n:int=None, alpha:float=0.5):
+        """
+        Returns the indices of the `n` database images most similar to the input embryo, from most to least similar.
+        If `n` is None (or larger than the database), the entire database is ranked.
+        """
+        combined_sims = self.scores(stage_pred, locations_pred, alpha)
+        n = len(self) if n is None else max(0, min(n, len(self)))
+        return combined_sims.topk(n, sorted=True)[1]
+
+    def top_n_subset(self, rows, stage_pred, locations_pred, n:int=None, alpha:float=0.5):
+        """
+        Ranks only the database images in `rows` (e.g. those matching a search filter, see filters.py), with z-scores
+        computed over those images alone. Returns the indices (into the whole database) of the `n` most similar of
+        them, from most to least similar. If `n` is None (or larger than `rows`), all of them are ranked.
+        """
+        rows = torch.as_tensor(rows, dtype=torch.long).reshape(-1)
+        n = len(rows) if n is None else max(0, min(n, len(rows)))
+        if n == 0: return rows[:0]
+        with torch.no_grad():
+            stage_pred = torch.as_tensor(stage_pred, dtype=torch.float32).reshape(-1)[0]
+            query = torch.as_tensor(locations_pred, dtype=torch.float32).reshape(-1)
+            stage_sims = (self.stages[rows] - stage_pred).abs_().neg_()
+            locations_sims = self.locations[rows].float().mv(query).mul_(-2)
+            locations_sims.add_(self.locations_sq_norms[rows]).add_(query.dot(query))
+            locations_sims.clamp_(min=0).sqrt_().add_(1).reciprocal_()
+            # Z-scores over the subset (a single image has nothing to be compared with)
+            if len(rows) > 1:
+                stage_weight, stage_shift = _z_score_coefficients(stage_sims, alpha)
+                locations_weight, locations_shift = _z_score_coefficients(locations_sims, 1-alpha)
+                combined_sims = stage_sims.mul_(stage_weight).add_(locations_sims, alpha=locations_weight)
+                combined_sims.sub_(stage_shift + locations_shift)
+            else:
+                combined_sims = torch.zeros(1)
+        return rows[combined_sims.topk(n, sorted=True)[1]]
+
+    def top_n_batch(self, stage_preds, locations_preds, n:int=None, alpha:float=0.5, max_elements:int=1<<24):
+        """
+        Ranks the database against many input embryos at once. Scores are z-scored per input embryo, so each ranking
+        is the same as `top_n` would return for that embryo alone.
+
+        Arguments:
+        - stage_preds: the input embryos' stage predictions, shape (Q,) or (Q, 1)
+        - locations_preds: the input embryos' locations predictions, shape (Q, number of locations)
+        - n: the number of most similar images to return for each embryo. If None, the entire database is ranked.
+        - alpha: the percent weight given to the stage similarity
+        - max_elements: the largest similarity matrix (queries x database images) computed at once. Queries are
+        processed in blocks of max_elements // N rows.
+
+        Yields:
+        (index of the first query in the block, tensor of shape (block size, n) with the indices of each query's most
+        similar images), block by block as they are computed.
+        """
+        stage_preds = torch.as_tensor(stage_preds, dtype=torch.float32).reshape(-1, 1)
+        locations_preds = torch.as_tensor(locations_preds, dtype=torch.float32).reshape(len(stage_preds), -1)
+        n = len(self) if n is None else max(0, min(n, len(self)))
+        block = max(1, max_elements // max(1, len(self)))
+        with torch.no_grad():
+            for start in range(0, len(stage_preds), block):
+                stages, queries = stage_preds[start:start+block], locations_preds[start:start+block]
+                # Stage similarity: negative absolute difference
+                stage_sims = (self.stages[None] - stages).abs_().neg_()
+                # Locations similarity: 1/(1 + euclidean distance), with a matrix product for the dot products
+                locations_sims = torch.empty(len(queries), len(self), dtype=torch.float32)
+                for chunk_start, chunk in self._locations_chunks():
+                    locations_sims[:, chunk_start:chunk_start+len(chunk)] = queries @ chunk.t()
+                locations_sims.mul_(-2).add_(self.locations_sq_norms[None]).add_((queries*queries).sum(1, keepdim=True))
+                locations_sims.clamp_(min=0).sqrt_().add_(1).reciprocal_()
+                # Combine z-scores (per query)
+                combined_sims = _z_score_rows_(stage_sims, alpha).add_(_z_score_rows_(locations_sims, 1-alpha))
+                yield start, combined_sims.topk(n, dim=1, sorted=True)[1]
+
+## Functions
+def _z_score_coefficients(sims, weight:float):
+    """
+    Returns (scale, shift) such that `weight` times the z-scores of `sims` equals sims*scale - shift. A constant
+    similarity (standard deviation 0) contributes nothing to the ranking.
+    """
+    mean, std = sims.mean().item(), sims.std().item()
+    if is_constant(mean, std): return 0., 0.
+    scale = weight/std
+    return scale, mean*scale
+
+def _z_score_rows_(sims, weight:float):
+    "Replaces each row of `sims` with `weight` times its z-scores, in place. Constant rows become 0."
+    mean, std = sims.mean(dim=1, keepdim=True), sims.std(dim=1, keepdim=True)
+    scale = torch.where(std > CONSTANT_TOLERANCE*mean.abs(), weight/std, torch.zeros_like(std))
+    return sims.sub_(mean).mul_(scale)
+
+def is_constant(mean:float, std:float) -> bool:
+    "Returns whether a similarity with this mean and standard deviation counts as constant (see CONSTANT_TOLERANCE)."
+    return not std > CONSTANT_TOLERANCE*abs(mean)
@@ -0,0 +1,232 @@
+"""
+File: reindex-predictions.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Description: Regenerates every saved prediction, e.g. after the stage or locations model is retrained.
+
+update-data.py only predicts on images created since the last update. When the models change, the saved predictions
+of every database image have to be regenerated instead, which this script does:
+* The images are taken from the current prediction store (the default), from a file listing their filenames (one per
+line, --filenames), or from every image file in the image home directory (--walk).
+* They are streamed through the models (see pipeline.py): decoded by parallel worker processes, in large batches that
+are shared by both models. Progress (images per second and the estimated time left) is reported as it goes.
+* Predictions are written a chunk at a time into a new, unpublished generation of the prediction store (see
+prediction_store.py), recording how far the run has got. If the run is interrupted, running the same command again
+resumes from the last chunk saved (--restart starts over instead).
+* Images that update-data.py appended to the store while the reindex was running are reindexed too (the store is
+locked while publishing, so none can be appended between the last catch-up and the publish). Then the new
+predictions are published atomically as a new version of the store, recording which models made them: a running
+search server switches to them without a restart, and reloads its models if it loaded different ones.
+* If none of the images could be read, or more than GEISHA_REINDEX_MAX_UNREADABLE of them couldn't, the reindex is
+left staged instead of published: check the image home directory and run it again with --restart, or publish it as
+it is with --force.
+* The previous version is kept, so it can be restored with --rollback (running --rollback again switches back).
+
+Example Script Usage:
+python src/reindex-predictions.py /home/geisha/images # Reindex every image in the database
+python src/reindex-predictions.py /home/geisha/images --filenames public-images.txt # Reindex the images listed
+python src/reindex-predictions.py /home/geisha/images --walk # Reindex every image under /home/geisha/images
+python src/reindex-predictions.py /home/geisha/images --force # Publish a reindex that had too many unreadable images
+python src/reindex-predictions.py --rollback # Switch back to the predictions before the last reindex
+
+These optional environment variables tune the run:
+- GEISHA_UPDATE_WORKERS: the number of processes decoding images (default: the number of CPUs, up to 8)
+- GEISHA_REINDEX_BATCH_SIZE: the number of images run through the models at once (default 256)
+- GEISHA_REINDEX_CHUNK_SIZE: the number of predictions saved at a time (default 8192)
+- GEISHA_REINDEX_MAX_UNREADABLE: the largest fraction of the images that may be unreadable for the reindex to be
+published without --force (default 0.1)
+- GEISHA_MODEL_RUNTIME: "eager" (the default) runs the fastai models as trained; "fp32", "int8" or "channels_last"
+runs that variant of the models exported by export-models.py, on the CPU (see model_export.py)
+"""
+
+import argparse
+from datetime import date, timedelta
+import os
+import sys
+import time
+from typing import Callable, List, Tuple
+from fastai.vision import *
+from pipeline import predict_images
+from model_export import MODEL_FNS, VARIANTS, load_exported_models, exported_model_path, model_fingerprint
+from preprocess import IMAGE_SIZE
+from prediction_store import load_snapshot, read_manifest, begin_reindex, checkpoint_reindex, publish_reindex, \
+    abort_reindex, rollback, store_lock
+
+# Pipeline settings
+num_workers = int(os.environ.get("GEISHA_UPDATE_WORKERS", min(8, os.cpu_count() or 1)))
+bs = int(os.environ.get("GEISHA_REINDEX_BATCH_SIZE", 256))
+chunk_size = int(os.environ.get("GEISHA_REINDEX_CHUNK_SIZE", 8192))
+max_unreadable = float(os.environ.get("GEISHA_REINDEX_MAX_UNREADABLE", 0.1))
+model_runtime = os.environ.get("GEISHA_MODEL_RUNTIME", "eager")
+# File extensions of the images found with --walk
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp")
+predictions_dir = "../data/predictions"
+
+def walk_images(image_home_dir:str) -> List[str]:
+    "Returns the filenames (relative to `image_home_dir`) of every image file within it, sorted."
+    fnames = []
+    for dirpath, _, filenames in os.walk(image_home_dir):
+        for filename in filenames:
+            if filename.lower().endswith(IMAGE_EXTENSIONS):
+                fnames.append(os.path.relpath(os.path.join(dirpath, filename), image_home_dir))
+    return sorted(fnames)
+
+def model_files() -> dict:
+    "Identifies the model files used (by their sizes and modification times), so a resumed run uses the same ones."
+    if model_runtime == "eager": fns = [os.path.join("../models", fn) for fn in MODEL_FNS.values()]
+    else: fns = [exported_model_path("../models", name, model_runtime) for name in MODEL_FNS]
+    return {os.path.basename(fn): [os.stat(fn).st_size, os.stat(fn).st_mtime_ns] for fn in fns}
+
+def format_duration(seconds:float) -> str:
+    return str(timedelta(seconds=int(seconds))) if seconds != float("inf") else "?"
+
+def log(message:str):
+    "Appends a message to the data updates log (see update-data.py)."
+    with open("data-updates-log", "a") as file:
+        file.write(f"{date.today().strftime('%m/%d/%y')}: {message}\n")
+
+def appended_since(manifest:dict, base:dict) -> Tuple[List[str], dict]:
+    """
+    Returns the filenames of the images appended to the store since `base` (the live store's lineage and row count
+    when the reindex began, or when last caught up) that the staged reindex doesn't have yet, and the new base.
+    """
+    live = read_manifest(predictions_dir)
+    if live.get("lineage", 0) != base["lineage"] or live["count"] <= base["count"]: return [], base
+    reindexed = set(load_snapshot(predictions_dir, manifest).filenames)
+    appended = [fname for fname in load_snapshot(predictions_dir, live).filenames[base["count"]:]
+                if fname not in reindexed]
+    return appended, dict(base, count=live["count"])
+
+def reindex(manifest:dict, fnames:List[str], image_home_dir:str, stage_net:Callable, locations_net:Callable,
+            device=None, position:int=0, catch_up:bool=False) -> Tuple[dict, List[str]]:
+    """
+    Predicts on the images `fnames[position:]` (in `image_home_dir`) with the stage and locations models (see
+    `predict_images` in pipeline.py), saving their predictions to the staged reindex a chunk at a time, and reporting
+    progress at least every 10 seconds. Unless catching up on images appended to the store after the reindex began,
+    each chunk also records the position in `fnames` the reindex has reached.
+    Returns (the updated staged manifest, the filenames of the images that couldn't be read).
+    """
+    chunk_fnames, chunk_stage_preds, chunk_locations_preds, chunk_skipped = [], [], [], 0
+    unreadable_fnames = []
+    started = last_report = time.monotonic()
+    done = position
+    image_fns = [os.path.join(image_home_dir, fname) for fname in fnames[position:]]
+    for indices, failed, stage_preds, locations_preds in predict_images(
+            image_fns, stage_net, locations_net, bs=bs, num_workers=num_workers, device=device):
+        unreadable_fnames.extend(fnames[position+i] for i in failed)
+        if indices:
+            chunk_fnames += [fnames[position+i] for i in indices]
+            chunk_stage_preds.append(stage_preds)
+            chunk_locations_preds.append(locations_preds)
+        chunk_skipped += len(failed)
+        # Batches come in order, so every image up to the end of this one is done
+        done = position + max(indices + failed) + 1
+        last_batch = done == len(fnames)
+        if len(chunk_fnames) >= chunk_size or last_batch:
+            stages = torch.cat(chunk_stage_preds) if chunk_stage_preds else torch.empty(0, 1)
+            locations = (torch.cat(chunk_locations_preds) if chunk_locations_preds
+                         else torch.empty(0, manifest["num_locations"]))
+            manifest = checkpoint_reindex(predictions_dir, manifest, chunk_fnames, stages, locations,
+                                          manifest["position"] if catch_up else done, skipped=chunk_skipped)
+            chunk_fnames, chunk_stage_preds, chunk_locations_preds, chunk_skipped = [], [], [], 0
+        if time.monotonic() - last_report >= 10 or last_batch:
+            rate = (done - position)/max(time.monotonic() - started, 1e-9)
+            eta = (len(fnames) - done)/rate if rate > 0 else float("inf")
+            print(f"Reindexed {done}/{len(fnames)} images ({manifest['skipped'] + chunk_skipped} unreadable) | "
+                  f"{rate:.1f} images/s | ETA {format_duration(eta)}", flush=True)
+            last_report = time.monotonic()
+    return manifest, unreadable_fnames
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Regenerate every saved prediction with the current models.")
+    parser.add_argument("image_home_dir", nargs="?", help="the directory containing the database images")
+    source = parser.add_mutually_exclusive_group()
+    source.add_argument("--filenames", help="a file listing the filenames of the images to reindex, one per line")
+    source.add_argument("--walk", action="store_true", help="reindex every image file in the image home directory")
+    parser.add_argument("--restart", action="store_true", help="discard an interrupted reindex instead of resuming it")
+    parser.add_argument("--dtype", choices=("float32", "float16"), default=None,
+                        help="the type to store predictions as (default: that of the current predictions)")
+    parser.add_argument("--force", action="store_true",
+                        help="publish the reindex even if too many images were unreadable (but at least one wasn't)")
+    parser.add_argument("--rollback", action="store_true", help="switch back to the predictions before the last reindex")
+    args = parser.parse_args()
+    if args.filenames is not None: args.filenames = os.path.abspath(args.filenames)
+    if args.image_home_dir is not None: args.image_home_dir = os.path.abspath(args.image_home_dir)
+
+    # Change working directory to src/
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+
+    if args.rollback:
+        manifest = rollback(predictions_dir)
+        log(f"Rolled the predictions back to generation {manifest['generation']} ({manifest['count']} images)")
+        print(f"Rolled back to generation {manifest['generation']} ({manifest['count']} images) as version "
+              f"{manifest['version']}")
+        sys.exit(0)
+    if args.image_home_dir is None: parser.error("the image home directory is required to reindex")
+    if model_runtime != "eager" and model_runtime not in VARIANTS:
+        raise TypeError(f"Unknown model runtime {model_runtime} (choose from eager, {', '.join(VARIANTS)})")
+
+    # Load models (as trained, or exported with export-models.py)
+    if model_runtime == "eager":
+        stage_model = load_learner("../models/","stage-prediction-model.pkl")
+        locations_model = load_learner("../models/","locations-prediction-model.pkl")
+        locations_model.model.eval()
+        stage_model.model.eval()
+        stage_net, locations_net, device = stage_model.model, locations_model.model, defaults.device
+    else:
+        exported_models = load_exported_models("../models/", model_runtime)
+        stage_net, locations_net, device = exported_models["stage"], exported_models["locations"], None
+    models = model_fingerprint("../models")
+    with torch.no_grad():
+        num_locations = locations_net(torch.zeros((1, 3) + IMAGE_SIZE, device=device)).shape[1]
+
+    # Start (or resume) the reindex: the images to reindex are saved with it, so a resumed run uses the same list
+    if args.filenames is not None:
+        with open(args.filenames, "r") as file:
+            image_fnames, job_source = [line.strip() for line in file if line.strip()], args.filenames
+    elif args.walk:
+        image_fnames, job_source = walk_images(args.image_home_dir), f"walk:{args.image_home_dir}"
+    else:
+        image_fnames, job_source = load_snapshot(predictions_dir).filenames.tolist(), "store"
+    image_fnames = list(dict.fromkeys(image_fnames))
+    if args.restart: abort_reindex(predictions_dir)
+    job = {"source": job_source, "runtime": model_runtime, "models": model_files(), "dtype": args.dtype}
+    manifest, image_fnames = begin_reindex(predictions_dir, image_fnames, num_locations, job=job, dtype=args.dtype)
+    total, start_position = manifest["total"], manifest["position"]
+    if start_position: print(f"Resuming the reindex from image {start_position}/{total}")
+    else: print(f"Reindexing {total} images")
+
+    manifest, unreadable_fnames = reindex(manifest, image_fnames, args.image_home_dir, stage_net, locations_net,
+                                          device=device, position=start_position)
+
+    # Catch up on images update-data.py appended to the store while reindexing (until there are none left)
+    base = manifest["base"]
+    while True:
+        appended, base = appended_since(manifest, base)
+        if appended:
+            print(f"Reindexing {len(appended)} images added while reindexing")
+            manifest, unreadable = reindex(manifest, appended, args.image_home_dir, stage_net, locations_net,
+                                           device=device, catch_up=True)
+            unreadable_fnames += unreadable
+            continue
+
+        # Don't replace the predictions with a reindex of (mostly) unreadable images, e.g. from the wrong directory
+        attempted = manifest["count"] + manifest["skipped"]
+        if manifest["count"] == 0 or (manifest["skipped"] > max_unreadable*attempted and not args.force):
+            print(f"Not publishing the reindex: {manifest['skipped']}/{attempted} images were unreadable. Check the "
+                  f"image home directory and run the reindex again with --restart"
+                  f"{'' if manifest['count'] == 0 else ', or publish it as it is with --force'}", file=sys.stderr)
+            sys.exit(1)
+
+        # Publish the new predictions (a running server switches to them), keeping the previous ones for rollback.
+        # The store is locked, so no images can be appended between the last check and publishing.
+        with store_lock(predictions_dir):
+            appended, _ = appended_since(manifest, base)
+            if not appended:
+                manifest = publish_reindex(predictions_dir, models=models)
+                break
+    log(f"Reindexed {manifest['count']} images with the {model_runtime} models (generation {manifest['generation']}, "
+        f"previous generation {manifest['rollback']['generation']} kept for rollback)")
+    if unreadable_fnames:
+        log(f"Skipped {len(unreadable_fnames)} unreadable images while reindexing ({' '.join(unreadable_fnames)})")
+    print(f"Published {manifest['count']} reindexed images as version {manifest['version']} "
+          f"(roll back with --rollback)")
@@ -0,0 +1,298 @@
+"""
+File: run-benchmarks.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Description: Benchmarks the search engine on synthetic data, to measure how it scales and catch regressions.
+
+The benchmarks run offline: the database and images are generated (see synthetic.py), and small randomly initialised
+models stand in for the trained ones, so neither the saved predictions nor the .pkl learners are needed. These
+phases are measured, each in its own process (so peak memory use is measured per phase):
+- fetch: downloading images from a local HTTP server standing in for the Geisha website (see fetch.py), and reading
+them back from the download cache
+- preprocess: converting an image into a normalized tensor (see preprocess.py)
+- inference: running both models on one image, and on concurrent queries through the batching scheduler
+- similarity: ranking the database against one input embryo (the top 50), with the current engine and with the
+original full sort; ranking through the candidate index (see candidate_index.py), with its recall@n; and ranking a
+batch of input embryos at once
+- update: appending new predictions to a prediction store of the given size, and streaming image files (some of
+them unreadable) through the update pipeline into a prediction store, as update-data.py does (see pipeline.py)
+
+For each phase, the p50/p95/p99 latency, throughput (queries or images per second) and peak RSS are reported, and
+all results are written to a JSON file, which can be compared with the results from another commit.
+
+Example Script Usage:
+python src/run-benchmarks.py # Database sizes of 10k and 100k, results written to bench-results.json
+python src/run-benchmarks.py --sizes 10000 100000 1000000 --output after.json # Up to 1M images
+python src/run-benchmarks.py --compare before.json # Also compare with earlier results (exits with 1 on regressions)
+"""
+
+import argparse
+import functools
+import http.server
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import numpy as np
+import torch
+from synthetic import synthetic_database, synthetic_images, num_locations, StandInModel
+from preprocess import ImagePreprocessor
+from batching import InferenceScheduler
+from ranking import RankingEngine
+from candidate_index import CandidateIndex, recall_at_n
+from prediction_store import create_store, append_predictions, load_snapshot
+from pipeline import append_new_predictions
+from fetch import ImageFetcher
+
+## Measurement helpers
+def summarize(latencies, elapsed:float, items:int) -> dict:
+    "Summarizes a list of latencies (in seconds) and the total time taken to process `items` items."
+    latencies_ms = np.array(latencies)*1000
+    return {"iterations": len(latencies), "p50_ms": float(np.percentile(latencies_ms, 50)),
+            "p95_ms": float(np.percentile(latencies_ms, 95)), "p99_ms": float(np.percentile(latencies_ms, 99)),
+            "mean_ms": float(latencies_ms.mean()), "per_second": items/elapsed if elapsed > 0 else float("inf")}
+
+def time_calls(fn, inputs, warmup:int=2) -> dict:
+    "Calls `fn` on each input in turn (after a few warm-up calls) and summarizes the latencies."
+    for x in inputs[:warmup]: fn(x)
+    latencies = []
+    start = time.perf_counter()
+    for x in inputs:
+        t = time.perf_counter()
+        fn(x)
+        latencies.append(time.perf_counter() - t)
+    return summarize(latencies, time.perf_counter() - start, len(inputs))
+
+def _phase_worker(conn, fn, fn_args, threads):
+    "Runs one benchmark phase in a child process, and sends back its results with the process's peak RSS."
+    torch.set_num_threads(threads)
+    try:
+        results = fn(*fn_args)
+        peak_rss_mb = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024
+        for result in results: result["peak_rss_mb"] = peak_rss_mb
+        conn.send(results)
+    except Exception as e:
+        conn.send(e)
+
+def run_phase(fn, fn_args, threads:int) -> list:
+    "Runs a benchmark phase in a fresh process, so that its peak memory use is measured on its own."
+    ctx = multiprocessing.get_context("fork")
+    parent_conn, child_conn = ctx.Pipe()
+    process = ctx.Process(target=_phase_worker, args=(child_conn, fn, fn_args, threads))
+    process.start()
+    results = parent_conn.recv()
+    process.join()
+    if isinstance(results, Exception): raise results
+    return results
+
+## Phases
+def bench_fetch(args):
+    images = synthetic_images(args.images, seed=args.seed)
+    with tempfile.TemporaryDirectory() as image_dir, tempfile.TemporaryDirectory() as cache_dir:
+        fnames = []
+        for i, image in enumerate(images):
+            fnames.append(f"{i}.jpg")
+            with open(os.path.join(image_dir, fnames[-1]), "wb") as file: file.write(image)
+        handler = functools.partial(QuietHandler, directory=image_dir)
+        server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            fetcher = ImageFetcher(f"http://127.0.0.1:{server.server_port}/", cache_dir)
+            # Every download is a cache miss (no warm-up calls), then every read is a hit
+            results = [dict(phase="fetch", db_size=None, **time_calls(fetcher.fetch, fnames, warmup=0)),
+                       dict(phase="fetch_cached", db_size=None, **time_calls(fetcher.fetch, fnames))]
+            assert fetcher.stats()["misses"] == len(fnames)
+        finally:
+            server.shutdown()
+            server.server_close()
+    return results
+
+class QuietHandler(http.server.SimpleHTTPRequestHandler):
+    "Serves files over HTTP/1.1 (so connections are kept alive) without logging each request."
+    protocol_version = "HTTP/1.1"
+    def log_message(self, *args): pass
+
+def bench_preprocess(args):
+    images = synthetic_images(args.images, seed=args.seed)
+    preprocessor = ImagePreprocessor()
+    return [dict(phase="preprocess", db_size=None, **time_calls(preprocessor, images))]
+
+def bench_inference(args):
+    width = num_locations()
+    stage_model, locations_model = StandInModel(1, seed=args.seed), StandInModel(width, seed=args.seed+1)
+    preprocessor = ImagePreprocessor()
+    xs = [preprocessor(image) for image in synthetic_images(args.images, seed=args.seed)]
+    def predict(xb):
+        with torch.no_grad(): return stage_model(xb), locations_model(xb).sigmoid()
+    results = [dict(phase="inference", db_size=None, **time_calls(predict, xs))]
+    # Concurrent queries, batched by the scheduler
+    scheduler = InferenceScheduler({"stage": stage_model, "locations": lambda xb: locations_model(xb).sigmoid()},
+                                   max_batch_size=args.batch_size, max_wait=0.005)
+    latencies, lock = [], threading.Lock()
+    def client(client_xs):
+        for x in client_xs:
+            t = time.perf_counter()
+            scheduler.predict(x)
+            with lock: latencies.append(time.perf_counter() - t)
+    clients = [threading.Thread(target=client, args=(xs[i::args.concurrency],)) for i in range(args.concurrency)]
+    start = time.perf_counter()
+    for c in clients: c.start()
+    for c in clients: c.join()
+    results.append(dict(phase="inference_batched", db_size=None, concurrency=args.concurrency,
+                        mean_batch_size=scheduler.stats()["mean_batch_size"],
+                        **summarize(latencies, time.perf_counter() - start, len(xs))))
+    return results
+
+def bench_similarity(args, size):
+    filenames, stages, locations = synthetic_database(size, seed=args.seed)
+    _, query_stages, query_locations = synthetic_database(args.queries, seed=args.seed+1)
+    queries = list(zip(torch.from_numpy(query_stages), torch.from_numpy(query_locations)))
+    engine = RankingEngine(stages, locations)
+    def rank(query):
+        return filenames[engine.top_n(query[0], query[1], n=args.n).numpy()].tolist()
+    results = [dict(phase="similarity", db_size=size, **time_calls(rank, queries))]
+    # The original approach: separate similarity passes, then a full sort of the database
+    database_stages, database_locations = torch.from_numpy(stages), torch.from_numpy(locations)
+    def rank_full_sort(query):
+        stage_sims = -1*(query[0] - database_stages).abs()
+        locations_sims = 1/(1+torch.norm(database_locations - query[1], dim=1).unsqueeze(1))
+        stage_sims = (stage_sims - stage_sims.mean())/stage_sims.std()
+        locations_sims = (locations_sims - locations_sims.mean())/locations_sims.std()
+        combined_sims = 0.5*stage_sims + 0.5*locations_sims
+        sim_order = combined_sims.topk(len(combined_sims), dim=0)[1].squeeze()
+        return filenames[sim_order.numpy()].tolist()[:args.n]
+    results.append(dict(phase="similarity_full_sort", db_size=size, **time_calls(rank_full_sort, queries)))
+    # Approximate search through the candidate index
+    start = time.perf_counter()
+    index = CandidateIndex(stages, locations, nprobe=args.nprobe)
+    build_seconds = time.perf_counter() - start
+    def rank_index(query):
+        return filenames[index.top_n(query[0].numpy(), query[1].numpy(), n=args.n)].tolist()
+    recall = recall_at_n(index, engine, query_stages, query_locations, n=args.n)
+    results.append(dict(phase="similarity_index", db_size=size, nprobe=args.nprobe, recall=recall,
+                        build_seconds=build_seconds, **time_calls(rank_index, queries)))
+    # Many input embryos at once
+    def rank_batch(block):
+        return [filenames[order.numpy()].tolist() for _, orders in
+                engine.top_n_batch(query_stages[block], query_locations[block], n=args.n) for order in orders]
+    blocks = [slice(i, i+args.batch_size) for i in range(0, args.queries, args.batch_size)]
+    result = time_calls(rank_batch, blocks, warmup=1)
+    result["per_second"] *= args.batch_size
+    results.append(dict(phase="similarity_batch", db_size=size, block_size=args.batch_size, **result))
+    return results
+
+def bench_update(args, size):
+    filenames, stages, locations = synthetic_database(size, seed=args.seed)
+    chunk = 1024
+    new = synthetic_database(chunk*args.appends, seed=args.seed+2)
+    with tempfile.TemporaryDirectory() as store_dir:
+        create_store(store_dir, filenames, stages, locations)
+        chunks = [[array[i*chunk:(i+1)*chunk] for array in new] for i in range(args.appends)]
+        def append(rows):
+            append_predictions(store_dir, [fn + ".new" for fn in rows[0]], rows[1], rows[2])
+        result = time_calls(append, chunks, warmup=0)
+        result["per_second"] *= chunk
+    return [dict(phase="update_append", db_size=size, chunk_size=chunk, **result)]
+
+def bench_update_pipeline(args):
+    width = num_locations()
+    stage_model, locations_model = StandInModel(1, seed=args.seed), StandInModel(width, seed=args.seed+1)
+    filenames, stages, locations = synthetic_database(1000, seed=args.seed)
+    with tempfile.TemporaryDirectory() as image_dir, tempfile.TemporaryDirectory() as store_dir:
+        create_store(store_dir, filenames, stages, locations)
+        # Every 9th image, and one whole batch, can't be read (as update-data.py has to cope with)
+        fnames, image_fns = [], []
+        for i, image in enumerate(synthetic_images(args.images, seed=args.seed)):
+            unreadable = i % 9 == 8 or args.batch_size <= i < 2*args.batch_size
+            fnames.append(f"new-{i}.jpg")
+            image_fns.append(os.path.join(image_dir, fnames[-1]))
+            with open(image_fns[-1], "wb") as file: file.write(b"not an image" if unreadable else image)
+        chunk_times = []
+        start = time.perf_counter()
+        added, unreadable = append_new_predictions(
+            store_dir, fnames, image_fns, stage_model, locations_model, bs=args.batch_size,
+            num_workers=args.workers, chunk_size=2*args.batch_size,
+            on_chunk=lambda saved: chunk_times.append(time.perf_counter()))
+        elapsed = time.perf_counter() - start
+        assert len(added) + len(unreadable) == len(fnames)
+        assert load_snapshot(store_dir).count == len(filenames) + len(added)
+        latencies = np.diff([start] + chunk_times).tolist()
+        result = summarize(latencies, elapsed, len(added))
+    return [dict(phase="update_pipeline", db_size=None, batch_size=args.batch_size, workers=args.workers,
+                 unreadable=len(unreadable), **result)]
+
+## Reporting
+def metadata(args) -> dict:
+    "Describes the environment the benchmarks ran in, so results from different commits can be compared."
+    try:
+        commit = subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {"commit": commit, "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": platform.python_version(),
+            "torch": torch.__version__, "numpy": np.__version__, "platform": platform.platform(),
+            "cpus": os.cpu_count(), "args": vars(args)}
+
+def print_results(results):
+    print(f"{'phase':<22}{'db size':>10}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'per sec':>12}{'peak MB':>10}")
+    for r in results:
+        print(f"{r['phase']:<22}{r['db_size'] or '':>10}{r['p50_ms']:>10.2f}{r['p95_ms']:>10.2f}{r['p99_ms']:>10.2f}"
+              f"{r['per_second']:>12.1f}{r['peak_rss_mb']:>10.0f}")
+
+def compare(results, baseline_fn:str, threshold:float) -> bool:
+    """
+    Prints the change in p50 latency and throughput of each phase from the results in `baseline_fn`. Returns
+    whether any phase got slower by more than `threshold` (a fraction).
+    """
+    with open(baseline_fn, "r") as file:
+        baseline = {(r["phase"], r["db_size"]): r for r in json.load(file)["results"]}
+    regressed = False
+    print(f"\nCompared with {baseline_fn}:")
+    print(f"{'phase':<22}{'db size':>10}{'p50 change':>12}{'per sec change':>16}")
+    for r in results:
+        old = baseline.get((r["phase"], r["db_size"]))
+        if old is None: continue
+        p50_change = r["p50_ms"]/old["p50_ms"] - 1
+        rate_change = r["per_second"]/old["per_second"] - 1
+        flag = ""
+        if p50_change > threshold:
+            regressed, flag = True, "  <- regression"
+        print(f"{r['phase']:<22}{r['db_size'] or '':>10}{p50_change:>+12.1%}{rate_change:>+16.1%}{flag}")
+    return regressed
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the search engine on synthetic data.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[10000, 100000], help="database sizes to test")
+    parser.add_argument("--queries", type=int, default=200, help="input embryos ranked per database size")
+    parser.add_argument("--images", type=int, default=64, help="synthetic images preprocessed/predicted on")
+    parser.add_argument("--appends", type=int, default=5, help="chunks of 1024 predictions appended per size")
+    parser.add_argument("--n", type=int, default=50, help="number of similar images returned per query")
+    parser.add_argument("--nprobe", type=int, default=16, help="clusters searched per query by the candidate index")
+    parser.add_argument("--batch-size", type=int, default=8, help="batch size for inference and batch ranking")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent clients for batched inference")
+    parser.add_argument("--workers", type=int, default=2, help="decoding processes for the update pipeline")
+    parser.add_argument("--threads", type=int, default=torch.get_num_threads(), help="torch threads per phase")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", default="bench-results.json", help="where to write the results (JSON)")
+    parser.add_argument("--compare", default=None, help="results (JSON) from another commit to compare with")
+    parser.add_argument("--threshold", type=float, default=0.1, help="p50 slowdown counted as a regression")
+    args = parser.parse_args()
+
+    results = run_phase(bench_fetch, (args,), args.threads)
+    results += run_phase(bench_preprocess, (args,), args.threads)
+    results += run_phase(bench_inference, (args,), args.threads)
+    results += run_phase(bench_update_pipeline, (args,), args.threads)
+    for size in args.sizes:
+        results += run_phase(bench_similarity, (args, size), args.threads)
+        results += run_phase(bench_update, (args, size), args.threads)
+    print_results(results)
+    with open(args.output, "w") as file:
+        json.dump({"meta": metadata(args), "results": results}, file, indent=2)
+    print(f"\nResults written to {args.output}")
+    if args.compare is not None and compare(results, args.compare, args.threshold):
+        sys.exit(1)
@@ -3,16 +3,24 @@ File: search.py
 Author: Daniel Lee <danielslee@email.arizona.edu>
 Purpose: Imports and creates all of the objects needed for live image search.
 
+Importing this module only defines the search functions. The models and data are loaded by `init`, so servers can
+decide when (and in which process) to load them, and `warm_up` runs them once before the first real search.
+
 The following libraries are imported:
 - fastai (used for model evaluation)
-- urllib (to download images)
-- pickle (to load data objects)
+- fetch (to download images, see fetch.py)
+- prediction_store (to read saved predictions, see prediction_store.py)
 
-The following data objects are loaded:
+The following data objects are loaded by `init`:
 - Trained stage and location models
-- Saved results for existing images in the database (filename, stage predictions, anatomical locations predictions)
+- Saved results for existing images in the database (filename, stage predictions, anatomical locations predictions).
+These are memory-mapped from the prediction store, and reloaded automatically when update-data.py publishes new ones.
+- A cache of features for recently searched images (see feature_cache.py)
+- A cache of the rankings of recent searches, for paged results (see cursor_cache.py)
 
 Functions are defined for the image search process. In general, functions have the following purpose:
+- To look up the features of input images that have already been predicted on
+- To time each phase of the search, and collect metrics on it (see metrics.py)
 - To wrap the input image in deep learning objects for prediction
 - To predict on input embryos using trained models
 - To retrieve save information on database images
@@ -21,29 +29,393 @@ Functions are defined for the image search process. In general, functions have t
 
 ## Libraries
 from fastai.vision import *
-import urllib
-import pickle
+import sys
+import threading
+import time
+from feature_cache import FeatureCache, ImageFeatures, hash_image_file, hash_image_bytes
+from ranking import RankingEngine
+from candidate_index import CandidateIndex, recall_at_n
+from filters import FilterIndex, SearchFilter, load_location_names
+from model_export import load_exported_models, model_fingerprint
+from sharding import ShardedSearch
+from cursor_cache import CursorCache, CursorKey, Cursor, hash_features, compact_rows
+from batching import InferenceScheduler
+from preprocess import ImagePreprocessor
+from prediction_store import PredictionStore, PredictionSnapshot, store_exists, convert_pickle
+from fetch import ImageFetcher
+import metrics
+from metrics import gauge_lines, counter_lines
 
-## Create directory to download images
-os.getcwd().split("/")[-1] == "GEISHA-Image-Search", "Must run from repo home directory"
-try:
-    os.mkdir("src/downloaded-search-images")
-except FileExistsError:
-    pass
+## Settings
+# Which models to run: "eager" (the fastai models as trained), or an exported TorchScript variant ("fp32", "int8" or
+# "channels_last", see model_export.py); and the number of threads torch uses (0 leaves torch's default)
+MODEL_RUNTIME = os.environ.get("GEISHA_MODEL_RUNTIME", "eager")
+TORCH_THREADS = int(os.environ.get("GEISHA_TORCH_THREADS", 0))
+# Number of uploaded/external images whose features are kept in memory (0 disables the cache)
+FEATURE_CACHE_SIZE = int(os.environ.get("GEISHA_FEATURE_CACHE_SIZE", 1024))
+# Largest number of concurrent queries run through the models together, and how long (ms) a query waits for others
+INFERENCE_BATCH_SIZE = int(os.environ.get("GEISHA_INFERENCE_BATCH_SIZE", 8))
+INFERENCE_BATCH_WINDOW_MS = float(os.environ.get("GEISHA_INFERENCE_BATCH_WINDOW_MS", 5))
+# Location of the prediction store, and how often (seconds) to check it for predictions published by update-data.py
+PREDICTIONS_DIR = os.environ.get("GEISHA_PREDICTIONS_DIR", "data/predictions")
+PREDICTIONS_RELOAD_INTERVAL = float(os.environ.get("GEISHA_PREDICTIONS_RELOAD_INTERVAL", 5))
+# Where input images that aren't available locally are downloaded from, and the limits on the downloaded images kept
+GEISHA_PHOTOS_URL = os.environ.get("GEISHA_PHOTOS_URL", "http://geisha.arizona.edu/geisha/photos/")
+DOWNLOAD_CACHE_MB = float(os.environ.get("GEISHA_DOWNLOAD_CACHE_MB", 1024))
+DOWNLOAD_CACHE_MAX_AGE_HOURS = float(os.environ.get("GEISHA_DOWNLOAD_CACHE_MAX_AGE_HOURS", 24*7))
+DOWNLOAD_TIMEOUT = float(os.environ.get("GEISHA_DOWNLOAD_TIMEOUT", 10))
+# Batch search: images run through the models at once, and queries ranked per block (see `batch_similarity`)
+BATCH_SEARCH_SIZE = int(os.environ.get("GEISHA_BATCH_SEARCH_SIZE", 64))
+# Candidate index (see candidate_index.py): databases with at least this many images are searched approximately,
+# through the index (0, the default, disables the index: check `index_recall` before enabling it), and the index's
+# speed/recall settings
+CANDIDATE_INDEX_MIN_SIZE = int(os.environ.get("GEISHA_CANDIDATE_INDEX_MIN_SIZE", 0))
+INDEX_LISTS = int(os.environ.get("GEISHA_INDEX_LISTS", 0)) or None
+INDEX_PROBES = int(os.environ.get("GEISHA_INDEX_PROBES", 16))
+INDEX_STAGE_CANDIDATES = int(os.environ.get("GEISHA_INDEX_STAGE_CANDIDATES", 2048))
+INDEX_STATS_SAMPLE = int(os.environ.get("GEISHA_INDEX_STATS_SAMPLE", 8192))
+# Paged searches (see `paged_similarity`): the memory (in MB) cached rankings may take up (0 disables the cache), the
+# number of seconds they are kept, and the number of images the first page of a search ranks
+CURSOR_CACHE_MB = float(os.environ.get("GEISHA_CURSOR_CACHE_MB", 64))
+CURSOR_TTL = float(os.environ.get("GEISHA_CURSOR_TTL", 600))
+CURSOR_DEPTH = int(os.environ.get("GEISHA_CURSOR_DEPTH", 500))
+# Number of processes the ranking of each search is split across (see sharding.py; 0 ranks in the searching process),
+# and the number of threads torch uses in each
+SHARDS = int(os.environ.get("GEISHA_SHARDS", 0))
+SHARD_THREADS = int(os.environ.get("GEISHA_SHARD_THREADS", 1))
+# Locations prediction at or above which an image counts as showing expression in a location (for search filters)
+LOCATION_THRESHOLD = float(os.environ.get("GEISHA_LOCATION_THRESHOLD", 0.5))
 
 ## Data
-# Load trained models
-stage_model = load_learner("models/","stage-prediction-model.pkl")
-locations_model = load_learner("models/","locations-prediction-model.pkl")
-locations_model.model.eval()
-stage_model.model.eval()
-
-# Load saved results for existing images
-with open("data/database-image-predictions.pkl", "rb") as inp:
-    database_image_filenames, database_image_stages, database_image_locations = pickle.load(inp)
-    
+# The objects that hold the models and data, created by `init` (nothing is loaded when this module is imported)
+image_fetcher = None
+stage_model = locations_model = None
+stage_net = locations_net = None
+# Which trained models are loaded (see `model_fingerprint` in model_export.py), and how many times they have been
+models_fingerprint, models_loaded = None, 0
+inference_scheduler = None
+location_names = None
+prediction_store = None
+feature_cache = None
+cursor_cache = None
+_init_lock = threading.Lock()
+_warmed_up = False
+# The shard processes of this process (see `sharded_search`), the process they belong to, and when a new pool of
+# shards can next be started after one failed
+_sharded_search, _sharded_search_pid, _sharded_search_retry_at = None, None, 0.
+# Starting shards is slow, so it has its own lock rather than holding up threads waiting on `init`
+_shards_lock = threading.Lock()
+
+# Converts input images into normalized tensors for the models
+preprocessor = ImagePreprocessor()
+
+def _predict_stages(xb:Tensor) -> Tensor:
+    with metrics.registry.timer("stage_forward"): return stage_net(xb).cpu()
+def _predict_locations(xb:Tensor) -> Tensor:
+    with metrics.registry.timer("locations_forward"): return locations_net(xb).sigmoid().cpu()
+
+# Inference batch sizes and queue waits (see `run_inference`)
+batch_size_histogram = metrics.registry.histogram("geisha_inference_batch_size", "Images per inference batch",
+                                                  buckets=(1, 2, 4, 8, 16, 32, 64, 128))
+queue_wait_histogram = metrics.registry.histogram("geisha_inference_queue_wait_seconds",
+                                                  "Time images wait for their inference batch to start")
+def _record_batch(batch_size:int, waits:List[float]):
+    batch_size_histogram.observe(batch_size)
+    for wait in waits: queue_wait_histogram.observe(wait)
+
+# Saved results for existing images
+class Database():
+    """
+    One version of the saved results for the public images in the Geisha database, along with the objects used to
+    search them:
+    - filenames, stages, locations: the saved filenames and predictions. The predictions are PyTorch tensors that
+    share memory with the memory-mapped prediction store (stages are always float32; locations may be float16).
+    - filename_index: maps each filename (and its base name) to its row, so known images can skip inference
+    - ranking_engine: ranks the database with the default similarity algorithm (see `embryo_similarity`)
+    - candidate_index: finds the most similar images without scoring the whole database, for databases with at least
+    CANDIDATE_INDEX_MIN_SIZE images (None otherwise). Except for the first version loaded, it is built in a background
+    thread (it can take seconds), and is None until it is ready, so searches are exact in the meantime.
+    - filter_index: finds the images matching a search filter (a stage range and/or locations, see filters.py)
+
+    A new Database is created whenever new predictions are published. Searches hold on to the Database they started
+    with, so they are unaffected by the switch. When the new predictions were appended to the `previous` Database's,
+    its indexes are extended with the new rows rather than rebuilt.
+    """
+    def __init__(self, snapshot:PredictionSnapshot, previous:"Database"=None):
+        self.version, self.lineage = snapshot.version, snapshot.lineage
+        self.filenames = snapshot.filenames
+        self.stages = torch.from_numpy(snapshot.stages).float()
+        self.locations = torch.from_numpy(snapshot.locations)
+        self.filename_index = {}
+        for i, fn in enumerate(self.filenames):
+            self.filename_index[fn] = i
+            self.filename_index.setdefault(Path(fn).name, i)
+        self.ranking_engine = RankingEngine(self.stages, self.locations)
+        extend = previous is not None and previous.lineage == self.lineage
+        if extend: self.filter_index = previous.filter_index.extend(snapshot.stages, snapshot.locations)
+        else: self.filter_index = FilterIndex(snapshot.stages, snapshot.locations, location_names, LOCATION_THRESHOLD)
+        self.candidate_index = None
+        self.index_ready = threading.Event()
+        if not CANDIDATE_INDEX_MIN_SIZE or len(self) < CANDIDATE_INDEX_MIN_SIZE: self.index_ready.set()
+        # New versions are loaded by whichever search notices them, so their indexes are built in the background
+        elif previous is None: self._build_candidate_index(snapshot, None)
+        else: threading.Thread(target=self._build_candidate_index, args=(snapshot, previous if extend else None),
+                               daemon=True).start()
+    def __len__(self): return len(self.filenames)
+
+    def _build_candidate_index(self, snapshot:PredictionSnapshot, previous:"Database"):
+        "Builds the candidate index, extending the `previous` Database's (once it's ready) if given, and indexed."
+        try:
+            if previous is not None: previous.index_ready.wait()
+            if previous is not None and previous.candidate_index is not None:
+                self.candidate_index = previous.candidate_index.extend(snapshot.stages, snapshot.locations)
+            else:
+                self.candidate_index = CandidateIndex(snapshot.stages, snapshot.locations, nlist=INDEX_LISTS,
+                                                      nprobe=INDEX_PROBES, stage_candidates=INDEX_STAGE_CANDIDATES,
+                                                      stats_sample=INDEX_STATS_SAMPLE)
+        finally:
+            self.index_ready.set()
+
+# Metrics kept by the objects above, collected when the metrics are requested
+def _collect_metrics():
+    database, cache, downloads = current_database(), feature_cache.stats(), image_fetcher.stats()
+    cursors = cursor_cache.stats()
+    return (gauge_lines("geisha_database_images", "Images in the current version of the database", len(database)) +
+            gauge_lines("geisha_database_version", "Version of the prediction store in use", database.version) +
+            counter_lines("geisha_feature_cache_hits_total", "Feature cache hits", cache["hits"]) +
+            counter_lines("geisha_feature_cache_misses_total", "Feature cache misses", cache["misses"]) +
+            gauge_lines("geisha_feature_cache_entries", "Images in the feature cache", cache["size"]) +
+            counter_lines("geisha_cursor_cache_hits_total", "Paged searches whose ranking was cached",
+                          cursors["hits"]) +
+            counter_lines("geisha_cursor_cache_misses_total", "Paged searches whose ranking wasn't cached",
+                          cursors["misses"]) +
+            counter_lines("geisha_cursor_cache_evictions_total", "Cached rankings evicted to stay within memory",
+                          cursors["evictions"]) +
+            gauge_lines("geisha_cursor_cache_bytes", "Memory taken up by cached rankings", cursors["bytes"]) +
+            counter_lines("geisha_download_cache_hits_total", "Download cache hits", downloads["hits"]) +
+            counter_lines("geisha_download_cache_misses_total", "Download cache misses", downloads["misses"]) +
+            counter_lines("geisha_downloaded_bytes_total", "Bytes of images downloaded", downloads["bytes_downloaded"]) +
+            gauge_lines("geisha_download_cache_bytes", "Bytes of downloaded images cached on disk", downloads["bytes"]))
+def init(torch_threads:int=None):
+    """
+    Loads everything needed for live image search, and creates the objects that hold it:
+    - The cache that input images are downloaded into
+    - The trained models (as trained, or exported with export-models.py, see GEISHA_MODEL_RUNTIME), and the
+    scheduler that batches concurrent queries through them
+    - The saved results for existing images, from the prediction store (converting the legacy pickle on first run)
+    - The cache of features for recently searched images, and the cache of their rankings (for paged searches)
+
+    Nothing is loaded when this module is imported. `init` should be called (from the repo home directory) before
+    searching, e.g. when a server starts; otherwise it is called by the first search. Later calls do nothing.
+    Everything loaded here can be shared by forked worker processes (see serving.py): the models' weights and the
+    indexes are shared copy-on-write, the predictions are memory-mapped, and the inference scheduler starts its
+    thread in each process on first use.
+
+    Arguments:
+    - torch_threads: the number of threads torch uses. Defaults to GEISHA_TORCH_THREADS (or torch's default).
+    """
+    global image_fetcher, inference_scheduler, location_names, prediction_store, feature_cache, cursor_cache
+    with _init_lock:
+        if prediction_store is not None: return
+        torch_threads = ifnone(torch_threads, TORCH_THREADS)
+        if torch_threads: torch.set_num_threads(torch_threads)
+
+        # Create the cache that images are downloaded into
+        os.getcwd().split("/")[-1] == "GEISHA-Image-Search", "Must run from repo home directory"
+        image_fetcher = ImageFetcher(GEISHA_PHOTOS_URL, "src/downloaded-search-images",
+                                     max_bytes=int(DOWNLOAD_CACHE_MB*2**20),
+                                     max_age=DOWNLOAD_CACHE_MAX_AGE_HOURS*3600, timeout=DOWNLOAD_TIMEOUT)
+
+        # Load trained models (as trained, or exported with export-models.py)
+        _load_models()
+
+        # Batches concurrent queries through the models, recording batch sizes and queue waits
+        inference_scheduler = InferenceScheduler({"stage": _predict_stages, "locations": _predict_locations},
+                                                 max_batch_size=INFERENCE_BATCH_SIZE,
+                                                 max_wait=INFERENCE_BATCH_WINDOW_MS/1000, on_batch=_record_batch)
+
+        # Names of the anatomical locations, in the order of the locations predictions (see `Database`)
+        location_names = load_location_names("data/locations.txt")
+
+        # Convert the legacy pickled results on first run, then load the prediction store
+        if not store_exists(PREDICTIONS_DIR):
+            convert_pickle("data/database-image-predictions.pkl", PREDICTIONS_DIR)
+        feature_cache = FeatureCache(FEATURE_CACHE_SIZE)
+        cursor_cache = CursorCache(max_bytes=int(CURSOR_CACHE_MB*2**20), ttl=CURSOR_TTL)
+        prediction_store = PredictionStore(PREDICTIONS_DIR, loader=_load_database,
+                                           reload_interval=PREDICTIONS_RELOAD_INTERVAL)
+        metrics.registry.add_collector(_collect_metrics)
+
+def _load_models():
+    "Loads the trained models from models/ (as trained, or exported, see GEISHA_MODEL_RUNTIME) for `run_inference`."
+    global stage_model, locations_model, stage_net, locations_net, models_fingerprint, models_loaded
+    fingerprint = model_fingerprint("models/")
+    if MODEL_RUNTIME == "eager":
+        stage_model = load_learner("models/","stage-prediction-model.pkl")
+        locations_model = load_learner("models/","locations-prediction-model.pkl")
+        locations_model.model.eval()
+        stage_model.model.eval()
+        stage_net, locations_net = stage_model.model, locations_model.model
+    else:
+        # Exported models run on the CPU
+        exported_models = load_exported_models("models/", MODEL_RUNTIME)
+        stage_net = lambda xb: exported_models["stage"](xb.cpu())
+        locations_net = lambda xb: exported_models["locations"](xb.cpu())
+    models_fingerprint, models_loaded = fingerprint, models_loaded + 1
+
+def _load_database(snapshot:PredictionSnapshot, previous:Database) -> Database:
+    """
+    Loads a version of the prediction store as a Database (see `PredictionStore`). Its predictions are only compared
+    with input images' if the same models made them: if they were made by other models (e.g. they were reindexed
+    after the models were retrained), the models are reloaded, provided the ones now in models/ made them. Otherwise,
+    the previous version keeps being served.
+    """
+    if snapshot.models and models_fingerprint and snapshot.models != models_fingerprint:
+        if model_fingerprint("models/") == snapshot.models:
+            _load_models()
+            # (Features still being predicted by the old models are cached under the old `models_loaded`, so unused)
+            feature_cache.clear()
+            print(f"Reloaded the models, which made version {snapshot.version} of the predictions", file=sys.stderr)
+        elif previous is not None:
+            print(f"Not searching version {snapshot.version} of the predictions: they were made by other models than "
+                  f"the ones loaded (restart the server once models/ has the models that made them)", file=sys.stderr)
+            return previous
+        else:
+            print("Warning: the predictions were made by other models than the ones loaded", file=sys.stderr)
+    return Database(snapshot, previous)
+
+def warm_up(iterations:int=3):
+    """
+    Runs a few blank searches, so that the first real ones don't pay for one-off costs: the models' first runs (JIT
+    optimization of exported models, memory allocation) and the ranking buffers. Call it after `init`, in each
+    process that serves searches.
+    """
+    global _warmed_up
+    init()
+    # Start the shard processes (if any) before the models start any threads
+    if SHARDS: sharded_search(start_method="fork")
+    x = torch.zeros((1, 3) + preprocessor.size)
+    for _ in range(iterations):
+        inference_scheduler.predict(x)
+    database = current_database()
+    if len(database):
+        features = ImageFeatures(database.stages[:1], database.locations[:1].float())
+        for _ in range(iterations):
+            embryo_similarity(features, n=10, database=database)
+    _warmed_up = True
+
+def sharded_search(start_method:str="spawn") -> Optional[ShardedSearch]:
+    """
+    Returns this process's pool of shard processes (see sharding.py), starting it on first use. Each server process
+    (see serving.py) has its own pool of GEISHA_SHARDS shards.
+
+    A pool whose shard died (see `ShardedSearch.broken`) is replaced by a new one, at most every 30 seconds; until
+    then, None is returned (and searches rank in this process). Pools are started with `start_method`: "spawn" by
+    default, since this may be called from a server thread; `warm_up` forks them before the server starts instead.
+    """
+    global _sharded_search, _sharded_search_pid, _sharded_search_retry_at
+    with _shards_lock:
+        if _sharded_search_pid == os.getpid() and not _sharded_search.broken: return _sharded_search
+        if time.monotonic() < _sharded_search_retry_at: return None
+        _sharded_search_retry_at = time.monotonic() + 30
+        _sharded_search = ShardedSearch(PREDICTIONS_DIR, num_shards=SHARDS, threads_per_shard=SHARD_THREADS,
+                                        start_method=start_method)
+        _sharded_search_pid = os.getpid()
+        return _sharded_search
+
+def is_ready() -> bool:
+    "Returns whether the models and data are loaded and warmed up (see `init` and `warm_up`)."
+    return prediction_store is not None and _warmed_up
+
 ## Functions
 
+# To find the features of an input image, only running the models when they haven't been computed before
+def grab_features(image_in:str, image_home_dir:str, *args, **kwargs) -> ImageFeatures:
+    """
+    Given a filename or string that corresponds to an image, returns the image's predicted stage and anatomical
+    locations. This is a drop-in replacement for `grab_image`: its result can be passed to `run_inference` and the
+    similarity functions in place of a DataBunch.
+
+    The models are only run when needed. Images already in the Geisha database resolve straight to their saved
+    predictions (without being downloaded). Other images are located/downloaded as in `grab_image` and looked up in
+    `feature_cache` by the hash of their contents (and the models loaded); only on a cache miss is the image preprocessed (directly into a
+    tensor, without a DataBunch) and predicted on (and then cached).
+
+    Arguments:
+    - image_in: A string indicating the input image (see `grab_image`).
+    - image_home_dir: a local directory to look for `image_in` in
+
+    Returns:
+    An ImageFeatures tuple containing the image's (stage prediction, locations prediction).
+    """
+    # Known database image: use its saved predictions
+    database = current_database()
+    row = database.filename_index.get(image_in)
+    if row is not None:
+        return ImageFeatures(database.stages[row:row+1], database.locations[row:row+1].float())
+    # Otherwise, check the cache for an image with the same contents
+    image_fn = _locate_image(image_in, image_home_dir)
+    with metrics.registry.timer("feature_lookup"):
+        key = f"{models_loaded}:{hash_image_file(image_fn)}"
+        features = feature_cache.get(key)
+    if features is None:
+        with metrics.registry.timer("preprocess"):
+            xb = preprocessor(image_fn)
+        features = ImageFeatures(*run_inference(xb))
+        feature_cache.put(key, features)
+    return features
+
+# To find the features of many input images at once (see `batch_similarity`)
+def grab_features_batch(images:List[Union[str, bytes]], image_home_dir:str, database:Database=None) -> List:
+    """
+    Returns the predicted features of several input images, as `grab_features` does for one image. Images already in
+    the database or in `feature_cache` skip the models; the rest are preprocessed into one batch and run through each
+    model once.
+
+    Arguments:
+    - images: the input images. Each is either a string (as for `grab_features`) or the raw bytes of an uploaded image.
+    - image_home_dir: a local directory to look for images in
+    - database: the version of the database to look up known images in. Defaults to the current one.
+
+    Returns:
+    A list with an ImageFeatures tuple for each image, in order. Images that can't be found or read have the
+    exception raised for them in place of their features.
+    """
+    database = ifnone(database, current_database())
+    results, pending = [None]*len(images), []
+    for i, image in enumerate(images):
+        try:
+            # Known database image: use its saved predictions
+            row = database.filename_index.get(image) if isinstance(image, str) else None
+            if row is not None:
+                results[i] = ImageFeatures(database.stages[row:row+1], database.locations[row:row+1].float())
+                continue
+            # Otherwise, check the cache for an image with the same contents
+            source = image if isinstance(image, bytes) else _locate_image(image, image_home_dir)
+            key = hash_image_bytes(source) if isinstance(image, bytes) else hash_image_file(source)
+            key = f"{models_loaded}:{key}"
+            results[i] = feature_cache.get(key)
+            if results[i] is None: pending.append((i, key, source))
+        except Exception as e:
+            results[i] = e
+    # Preprocess the remaining images into one batch, and run each model on it once
+    for start in range(0, len(pending), BATCH_SEARCH_SIZE):
+        xb, predicted = torch.empty((BATCH_SEARCH_SIZE, 3) + preprocessor.size), []
+        for i, key, source in pending[start:start+BATCH_SEARCH_SIZE]:
+            try:
+                preprocessor(source, out=xb[len(predicted)])
+                predicted.append((i, key))
+            except Exception as e:
+                results[i] = e
+        if not predicted: continue
+        with torch.no_grad():
+            xb = xb[:len(predicted)].to(defaults.device)
+            stages, locations = _predict_stages(xb), _predict_locations(xb)
+        for row, (i, key) in enumerate(predicted):
+            results[i] = ImageFeatures(stages[row:row+1], locations[row:row+1])
+            feature_cache.put(key, results[i])
+    return results
+
 # To create an ImageDataBunch object to run inference on and find similar images to 
 def grab_image(image_in:str, image_home_dir:str, *args, **kwargs) -> ImageDataBunch:
     """
@@ -63,17 +435,24 @@ def grab_image(image_in:str, image_home_dir:str, *args, **kwargs) -> ImageDataBu
     Returns:
     An ImageDataBunch containing the following image.  The databunch resizes the image to 300 (w) x 400 (h)
     """
+    image_fn = _locate_image(image_in, image_home_dir)
+    with metrics.registry.timer("databunch"):
+        return _create_databunch(image_fn)
+
+def _locate_image(image_in:str, image_home_dir:str) -> str:
+    """
+    Given a filename or string that corresponds to an image, returns the path of that image on disk. Images are
+    looked for in the image home directory first, and are otherwise downloaded from the Geisha website (or taken
+    from the cache of images downloaded previously, see `image_fetcher`).
+    """
     # Check for image locally
     if os.path.exists(image_home_dir+"/"+image_in):
-        return _create_databunch(image_home_dir+"/"+image_in)
-    # Check the Geisha website for the image
+        return image_home_dir+"/"+image_in
+    # Check the Geisha website for the image (raises FileNotFoundError if it isn't there)
     else:
-        try:
-            image_url = "http://geisha.arizona.edu/geisha/photos/" + urllib.parse.quote(image_in)
-            urllib.request.urlretrieve(image_url, "src/downloaded-search-images/" + image_in)
-            return _create_databunch("src/downloaded-search-images/" + image_in) 
-        except urllib.error.HTTPError:
-            raise FileNotFoundError(f"Image not found locally or on the Geisha database. Tried {image_url}")
+        if image_fetcher is None: init()
+        with metrics.registry.timer("download"):
+            return image_fetcher.fetch(image_in)
 
 def _create_databunch(image_fn:str) -> ImageDataBunch:
     """
@@ -94,8 +473,13 @@ def run_inference(image_db:DataBunch, do_stage=True, do_locations=True):
     Given an image in data bunch form, runs inference on that image by predicting on its stage and
     locations (via the trained models).
 
+    If the image is given as ImageFeatures (from `grab_features`), its features have already been predicted on,
+    and they are returned without running the models. Otherwise, the image is submitted to `inference_scheduler`,
+    which runs it through the models in a batch with any other queries that arrive at the same time.
+
     Arguments:
-    - image_db: A DataBunch created by `grab_image` which contains an input image.
+    - image_db: A DataBunch created by `grab_image` which contains an input image, the image as a normalized tensor
+    (from `preprocessor`), or its ImageFeatures.
     - do_stage: Whether to predict on an image's stage
     - do_locations: Whether to predict on an image's anatomical locations
     
@@ -104,22 +488,34 @@ def run_inference(image_db:DataBunch, do_stage=True, do_locations=True):
     unless instructed to not predict on either feature. Both predictions are in the form of a PyTorch tensor.
     """
     res = []
-    # Get data and predict using models
-    xb, yb = image_db.one_item(image_db.train_ds[0][0])
-    if do_stage:
-        stage_pred = stage_model.model(xb).cpu()
-        res.append(stage_pred.detach())
-    if do_locations:
-        locations_pred = locations_model.model(xb).sigmoid().cpu()
-        res.append(locations_pred.detach())
-    return tuple(res)
-def retrieve_predictions():
+    # Features already known, no need for the models
+    if isinstance(image_db, ImageFeatures):
+        if do_stage: res.append(image_db.stage)
+        if do_locations: res.append(image_db.locations)
+        return tuple(res)
+    # Get data and predict using models (batched with concurrent queries)
+    if isinstance(image_db, Tensor): xb = image_db.to(defaults.device)
+    else: xb, yb = image_db.one_item(image_db.train_ds[0][0])
+    outputs = [name for name, do in (("stage", do_stage), ("locations", do_locations)) if do]
+    if not outputs: return tuple(res)
+    if inference_scheduler is None: init()
+    with metrics.registry.timer("inference"):
+        return inference_scheduler.predict(xb, outputs)
+def current_database() -> Database:
+    """
+    Returns the current version of the saved information on the public images in the Geisha database (see `Database`),
+    switching to a new version if update-data.py has published one.
+    """
+    if prediction_store is None: init()
+    return prediction_store.current()
+def retrieve_predictions(database:Database=None):
     """
     Retrieves the saved information on the public images in the Geisha database. This includes the stage and
     anatomical locations predictions for each image. This information will be returned in a tuple of PyTorch
-    tensors in the form (stages, locations).
+    tensors in the form (stages, locations). Uses the current version of the database unless one is given.
     """
-    return (database_image_stages, database_image_locations)
+    database = ifnone(database, current_database())
+    return (database.stages, database.locations)
 def normalize_z_score(tensors:List[Tensor]):
     """
     Given a list of tensors, normalizes them to mean 0 and standard deviation 1, in essence returning z-scores.
@@ -138,7 +534,7 @@ def normalize_z_score(tensors:List[Tensor]):
     return tensors
 # Framework for creating similarity algorithms
 def similarity(image:DataBunch, stage_sim_func:Callable[[DataBunch], tensor], locations_sim_func:Callable, \
-               alpha:int=0.5, *args, **kwargs) -> List[str]:
+               alpha:int=0.5, n:int=None, *args, **kwargs) -> List[str]:
     """
     After models predict the stage and anatomical locations of an input embryo image, the next step in the image
     search involves comparing those results with the existing database and computing similarity. This function
@@ -170,20 +566,28 @@ def similarity(image:DataBunch, stage_sim_func:Callable[[DataBunch], tensor], lo
     - location_sim_func: a locations similarity function in the same manner.*
     - alpha: determines the percent weight given to the stage similarity. Must be a float between 0 and 1. A value of 0.4
     means that stage similarity is weighted at 40% and locations similarity 60%.
+    - n: the number of most similar images to return. If None, the entire database is ranked and returned.
     * See the functions/algorithms I use below. They have been tested and are found to deliver the best results.
 
     Returns: A list of filenames images in the Geisha database, ranked in order of similarity to the input image. 
     """
-    # Compute similarities using functions given
-    stage_sims = stage_sim_func(image, **kwargs)
-    locations_sims = locations_sim_func(image, **kwargs)
+    # Compute similarities using functions given, against a single version of the database
+    kwargs["database"] = ifnone(kwargs.get("database"), current_database())
+    with metrics.registry.timer("stage_similarity"):
+        stage_sims = stage_sim_func(image, **kwargs)
+    with metrics.registry.timer("locations_similarity"):
+        locations_sims = locations_sim_func(image, **kwargs)
     assert stage_sims.shape[0] == locations_sims.shape[0]
     # Normalize similarity scores into z-scores
-    (stage_sims, locations_sims) = normalize_z_score([stage_sims, locations_sims])
-    combined_sims = alpha*stage_sims + (1-alpha)*locations_sims
-    # Sort filenames in order of similarity, return
-    sim_order = combined_sims.topk(len(combined_sims), dim=0)[1].squeeze()
-    return database_image_filenames[sim_order].tolist()
+    with metrics.registry.timer("z_score"):
+        (stage_sims, locations_sims) = normalize_z_score([stage_sims, locations_sims])
+        combined_sims = alpha*stage_sims + (1-alpha)*locations_sims
+    # Sort filenames in order of similarity (only the top n, if given), return
+    combined_sims = combined_sims.reshape(-1)
+    n = len(combined_sims) if n is None else min(n, len(combined_sims))
+    with metrics.registry.timer("sort"):
+        sim_order = combined_sims.topk(n, dim=0)[1]
+    return kwargs["database"].filenames[sim_order.numpy()].tolist()
 def stage_sim_absolute(image:DataBunch, **kwargs) -> Tensor:
     """
     The default function for computing stage similarity between embryos. Predicts the stage of the input image, and
@@ -198,7 +602,7 @@ def stage_sim_absolute(image:DataBunch, **kwargs) -> Tensor:
     in stage.
     """
     stage_pred = run_inference(image, do_locations=False)[0]
-    database_image_stages, _ = retrieve_predictions()
+    database_image_stages, _ = retrieve_predictions(kwargs.get("database"))
     return -1*(stage_pred - database_image_stages).abs()
 
 def locations_sim_euclidean(image:DataBunch, **kwargs):
@@ -218,8 +622,8 @@ def locations_sim_euclidean(image:DataBunch, **kwargs):
     locations vectors.
     """
     locations_pred = run_inference(image, do_stage=False)[0]
-    _, database_image_locations = retrieve_predictions()
-    euclidean_distance = torch.norm(database_image_locations-locations_pred, dim=1).unsqueeze(1)
+    _, database_image_locations = retrieve_predictions(kwargs.get("database"))
+    euclidean_distance = torch.norm(database_image_locations.float()-locations_pred, dim=1).unsqueeze(1)
     return 1/(1+euclidean_distance)
 def _create_similarity_func(stage_sim_func:Callable[[DataBunch], tensor], locations_sim_func:Callable, **kwargs):
     """
@@ -230,4 +634,163 @@ def _create_similarity_func(stage_sim_func:Callable[[DataBunch], tensor], locati
     return partial(similarity, stage_sim_func = stage_sim_func, locations_sim_func = locations_sim_func, **kwargs)
 # Define the similarity algorithm I will use. I use negative absolute stage difference and euclidean locations similarity,
 # and weight stage and locations equally.
-embryo_similarity = _create_similarity_func(stage_sim_absolute, locations_sim_euclidean, alpha=0.5)
\ No newline at end of file
+def embryo_similarity(image:DataBunch, n:int=None, alpha:float=0.5, database:Database=None, exact:bool=False,
+                      stage_range:Tuple[float, float]=None, required:List[str]=(), excluded:List[str]=(),
+                      **kwargs) -> List[str]:
+    """
+    Ranks the database images by similarity to the input image, using negative absolute stage difference and euclidean
+    locations similarity. Returns the same ranking as
+    `_create_similarity_func(stage_sim_absolute, locations_sim_euclidean, alpha=alpha)(image, n=n)`, but computes it
+    in a single pass with the database's `ranking_engine` and only selects (and creates filenames for) the top `n` images.
+
+    With GEISHA_CANDIDATE_INDEX_MIN_SIZE set, large databases are searched through the database's `candidate_index`
+    instead: only the images closest in stage or locations are scored, so the top `n` are approximate (see
+    `index_recall`). With
+    GEISHA_SHARDS set, exact rankings are split across that many shard processes (see `sharded_search`), with the
+    same results as ranking in this process (up to the ordering of practically tied images, see sharding.py).
+
+    The search can be restricted to images in a range of stages, and/or showing (or not showing) expression in given
+    locations. The matching images are found first (see `Database.filter_index`), and only they are ranked: the
+    z-scores are computed over the matching images alone.
+
+    Arguments:
+    - image: an input image in DataBunch or ImageFeatures form
+    - n: the number of most similar images to return. If None, the entire database is ranked and returned.
+    - alpha: the percent weight given to the stage similarity (see `similarity`)
+    - database: the version of the database to search. Defaults to the current one.
+    - exact: whether to score the whole database even if it has a candidate index
+    - stage_range: only return images with (predicted) stages in this range, (lowest, highest). Either end may be None.
+    - required: only return images showing expression in all of these locations (named as in data/locations.txt)
+    - excluded: only return images showing expression in none of these locations
+
+    Returns: A list of the filenames of the `n` most similar images in the Geisha database, in order of similarity.
+    """
+    database = ifnone(database, current_database())
+    stage_pred, locations_pred = run_inference(image)
+    search_filter = SearchFilter(stage_range, tuple(required), tuple(excluded))
+    sim_order = _similar_rows(stage_pred, locations_pred, database, n, alpha, exact, search_filter)
+    return database.filenames[sim_order].tolist()
+
+def _similar_rows(stage_pred:Tensor, locations_pred:Tensor, database:Database, n:int=None, alpha:float=0.5,
+                  exact:bool=False, search_filter:SearchFilter=SearchFilter()) -> np.ndarray:
+    "Returns the database rows of the `n` most similar images to an input embryo's predictions (see `embryo_similarity`)."
+    # Only the images matching the filter are ranked
+    if not search_filter.is_empty():
+        with metrics.registry.timer("filter"):
+            rows = database.filter_index.rows(search_filter)
+        with metrics.registry.timer("ranking"):
+            return database.ranking_engine.top_n_subset(rows, stage_pred, locations_pred, n=n, alpha=alpha).numpy()
+    # Only the candidates found by the index are scored
+    if database.candidate_index is not None and n is not None and not exact:
+        with metrics.registry.timer("index_ranking"):
+            sim_order = database.candidate_index.top_n(stage_pred.numpy(), locations_pred.numpy(), n=n, alpha=alpha)
+        if len(sim_order) == min(n, len(database)): return sim_order
+    # Very large databases: rank across the shard processes (once they have this version of the database loaded)
+    shards = sharded_search() if SHARDS and n is not None else None
+    if shards is not None:
+        try:
+            if shards.version != database.version: shards.sync()
+            with metrics.registry.timer("sharded_ranking"):
+                sim_order = shards.top_n(stage_pred, locations_pred, n=n, alpha=alpha, version=database.version)
+            if sim_order is not None: return sim_order
+        except (EOFError, OSError) as e:
+            # A shard died: rank in this process instead (a new pool of shards is started by a later search)
+            print(f"Sharded ranking failed ({e!r}), ranking without shards", file=sys.stderr)
+    # Similarities, z-scores and the partial sort are computed together
+    with metrics.registry.timer("ranking"):
+        return database.ranking_engine.top_n(stage_pred, locations_pred, n=n, alpha=alpha).numpy()
+
+# Paged search: later pages of results are sliced from a cached ranking
+def paged_similarity(image:DataBunch, offset:int=0, n:int=50, alpha:float=0.5, database:Database=None,
+                     stage_range:Tuple[float, float]=None, required:List[str]=(), excluded:List[str]=()) -> List[str]:
+    """
+    Returns one page of the results of `embryo_similarity`: the filenames of the `n` images ranked just after the
+    first `offset`.
+
+    The first search for an input embryo ranks the top CURSOR_DEPTH images (or as many as the page needs), and saves
+    the ranking as a cursor in `cursor_cache` (see cursor_cache.py). Later pages of the same search (the same input
+    embryo features, alpha and filters, against the same version of the database) are sliced from it, without ranking
+    again; a page past the end of the cursor ranks deeper and extends it. The rows already in the cursor are kept as
+    they are (only the newly ranked rows are added after them), so pages never repeat or skip an image even if the
+    deeper ranking (e.g. by the candidate index) orders them slightly differently. Cursors expire after CURSOR_TTL seconds,
+    and are dropped when a new version of the database is published.
+
+    Arguments:
+    - image: an input image in DataBunch or ImageFeatures form (input images are best given as ImageFeatures, from
+    `grab_features`, so later pages skip the models too)
+    - offset: the number of most similar images to skip
+    - n: the number of images to return
+    - alpha, database, stage_range, required, excluded: as for `embryo_similarity`
+
+    Returns: A list of the filenames of the images ranked `offset`+1 to `offset`+`n` in the Geisha database, in
+    order of similarity (shorter, or empty, past the last result).
+    """
+    database = ifnone(database, current_database())
+    if cursor_cache is None: init()
+    stage_pred, locations_pred = run_inference(image)
+    search_filter = SearchFilter(stage_range, tuple(required), tuple(excluded))
+    key = CursorKey(hash_features(stage_pred, locations_pred), float(alpha), search_filter, database.version)
+    cursor = cursor_cache.get(key)
+    if cursor is None or (len(cursor.rows) < offset+n and not cursor.complete):
+        # Rank past the page (at least twice as deep as before), so the next few pages come from the cursor
+        depth = max(offset+n, CURSOR_DEPTH if cursor is None else 2*len(cursor.rows))
+        if not CURSOR_CACHE_MB: depth = offset+n
+        with metrics.registry.timer("cursor_ranking"):
+            rows = _similar_rows(stage_pred, locations_pred, database, depth, alpha, search_filter=search_filter)
+        complete = len(rows) < depth
+        if cursor is not None: rows = np.concatenate([cursor.rows, rows[~np.isin(rows, cursor.rows)]])
+        cursor = Cursor(compact_rows(rows), complete=complete)
+        cursor_cache.put(key, cursor)
+    return database.filenames[cursor.rows[offset:offset+n]].tolist()
+
+# To check how many of the most similar images the candidate index finds
+def index_recall(n:int=50, num_queries:int=100, alpha:float=0.5, database:Database=None, seed:int=0) -> float:
+    """
+    Measures the recall@n of the database's candidate index: the mean fraction of the exact `n` most similar images
+    (from scoring the whole database) that the index also returns, using the saved predictions of `num_queries`
+    random database images as input embryos. Use it to tune the GEISHA_INDEX_* settings. Waits for the index to be
+    built if it isn't ready yet.
+    """
+    database = ifnone(database, current_database())
+    database.index_ready.wait()
+    assert database.candidate_index is not None, "The database isn't indexed (see CANDIDATE_INDEX_MIN_SIZE)"
+    rows = np.random.default_rng(seed).choice(len(database), size=min(num_queries, len(database)), replace=False)
+    return recall_at_n(database.candidate_index, database.ranking_engine, database.stages[rows].numpy(),
+                       database.locations[rows].float().numpy(), n=n, alpha=alpha)
+# Batch search: find similar images for many input images at once
+def batch_similarity(images:List[Union[str, bytes]], image_home_dir:str, n:int=50, alpha:float=0.5,
+                     database:Database=None) -> Iterator[Tuple[int, Union[List[str], Exception]]]:
+    """
+    Finds the most similar database images for each of many input images, with the same algorithm (and results) as
+    `embryo_similarity`. Input images are handled in blocks of `BATCH_SEARCH_SIZE`: each block's features are
+    predicted in one batch (see `grab_features_batch`), then the block is ranked against the database with a
+    query x database similarity matrix (see `RankingEngine.top_n_batch`), which is computed in pieces so memory use
+    stays bounded. Z-scores are computed separately for each input image.
+
+    Arguments:
+    - images: the input images. Each is either a filename/string (as for `grab_features`) or the raw bytes of an image.
+    - image_home_dir: a local directory to look for images in
+    - n: the number of most similar images to return for each input image
+    - alpha: the percent weight given to the stage similarity (see `similarity`)
+    - database: the version of the database to search. Defaults to the current one.
+
+    Yields:
+    (index of the input image, list of the filenames of its `n` most similar images) for each input image, in order,
+    as soon as its block has been ranked. If an input image couldn't be found or read, the exception raised for it is
+    given in place of the list.
+    """
+    database = ifnone(database, current_database())
+    for start in range(0, len(images), BATCH_SEARCH_SIZE):
+        with metrics.registry.timer("batch_features"):
+            results = grab_features_batch(images[start:start+BATCH_SEARCH_SIZE], image_home_dir, database)
+        found = [i for i, res in enumerate(results) if isinstance(res, ImageFeatures)]
+        if found:
+            stage_preds = torch.cat([results[i].stage.reshape(1, -1) for i in found])
+            locations_preds = torch.cat([results[i].locations.reshape(1, -1) for i in found])
+            with metrics.registry.timer("batch_ranking"):
+                for block_start, sim_orders in database.ranking_engine.top_n_batch(stage_preds, locations_preds,
+                                                                                   n=n, alpha=alpha):
+                    for row, sim_order in enumerate(sim_orders):
+                        results[found[block_start+row]] = database.filenames[sim_order.numpy()].tolist()
+        for i, res in enumerate(results):
+            yield start+i, res
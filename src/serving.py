@@ -0,0 +1,132 @@
+"""
+File: serving.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Serves the web app from several pre-forked worker processes, for production.
+
+Flask's development server (app.run) handles requests in a single process, so searches are limited to one core,
+and it restarts itself whenever the code changes. The PreforkServer defined here instead:
+- Runs a setup function once, in the main process, before any workers exist (e.g. `search.init`, which loads the
+models and data). The workers are forked from the main process afterwards, so they share the loaded models' weights
+and the indexes copy-on-write rather than each loading their own copy.
+- Opens the listening socket once, and forks worker processes that all accept connections on it. Each worker runs a
+threaded WSGI server, after running a per-worker setup function (e.g. to set its number of torch threads and warm
+up the models).
+- Restarts workers that exit unexpectedly, and stops them all when it receives SIGTERM or SIGINT.
+
+Only the standard library and werkzeug (which comes with Flask) are used.
+"""
+
+## Libraries
+import gc
+import os
+import signal
+import socket
+import sys
+import threading
+import time
+from typing import Callable
+from werkzeug.serving import make_server
+
+## Objects
+class PreforkServer():
+    """
+    Serves a WSGI app from several worker processes forked from this one.
+
+    Arguments:
+    - app: the WSGI app (e.g. a Flask app)
+    - host, port: the address to listen on
+    - workers: the number of worker processes
+    - setup: optionally, a function run once in the main process before the workers are forked (e.g. loading the
+    models and data, so the workers share them)
+    - post_fork: optionally, a function run in each worker before it starts serving, called with the worker's number
+    - backlog: the number of pending connections the socket queues
+    """
+    def __init__(self, app, host:str="127.0.0.1", port:int=8081, workers:int=2, setup:Callable=None,
+                 post_fork:Callable[[int], None]=None, backlog:int=128):
+        self.app, self.host, self.port = app, host, port
+        self.num_workers = max(1, workers)
+        self.setup, self.post_fork, self.backlog = setup, post_fork, backlog
+        self.workers = {}
+        self._stopping = False
+
+    def serve_forever(self):
+        "Sets up, forks the workers, and supervises them until SIGTERM or SIGINT is received."
+        if self.setup is not None: self.setup()
+        self.socket = socket.socket(socket.AF_INET6 if ":" in self.host else socket.AF_INET, socket.SOCK_STREAM)
+        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.socket.bind((self.host, self.port))
+        self.socket.listen(self.backlog)
+        self.socket.set_inheritable(True)
+        # Objects that exist now are shared with the workers; keep the garbage collector from writing to them (which
+        # would copy their pages into each worker)
+        gc.collect()
+        if hasattr(gc, "freeze"): gc.freeze()
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        print(f"Serving on http://{self.host}:{self.port} with {self.num_workers} workers (main process {os.getpid()})",
+              flush=True)
+        for number in range(self.num_workers):
+            self._spawn(number)
+        try:
+            self._supervise()
+        finally:
+            self.socket.close()
+
+    def _spawn(self, number:int):
+        "Forks worker `number`."
+        # Block SIGTERM while forking, so the worker never runs the main process's handler for it
+        signal.pthread_sigmask(signal.SIG_BLOCK, {signal.SIGTERM})
+        try:
+            pid = os.fork()
+        except BaseException:
+            signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+            raise
+        if pid == 0:
+            status = 1
+            try:
+                # Until it starts serving, SIGTERM stops the worker straight away
+                signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+                self._run_worker(number)
+                status = 0
+            except BaseException as e:
+                print(f"Worker {number} failed: {e!r}", file=sys.stderr, flush=True)
+            finally:
+                os._exit(status)
+        self.workers[pid] = (number, time.monotonic())
+        signal.pthread_sigmask(signal.SIG_UNBLOCK, {signal.SIGTERM})
+
+    def _run_worker(self, number:int):
+        "Runs in a worker process: sets it up, then serves requests until it is told to stop."
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        if self.post_fork is not None: self.post_fork(number)
+        server = make_server(self.host, self.port, self.app, threaded=True, fd=self.socket.fileno())
+        # Finish serving (rather than dying mid-request) when the main process stops the workers
+        signal.signal(signal.SIGTERM, lambda signum, frame: threading.Thread(target=server.shutdown).start())
+        server.serve_forever()
+
+    def _supervise(self):
+        "Waits on the workers, restarting any that exit while the server is running."
+        while self.workers:
+            try:
+                pid, status = os.wait()
+            except ChildProcessError:
+                break
+            except InterruptedError:
+                continue
+            number, started = self.workers.pop(pid, (None, None))
+            if number is None or self._stopping: continue
+            print(f"Worker {number} (process {pid}) exited with status {status}, restarting it", file=sys.stderr,
+                  flush=True)
+            # Don't restart in a tight loop if workers fail as soon as they start
+            if time.monotonic() - started < 1: time.sleep(1)
+            if not self._stopping: self._spawn(number)
+
+    def _stop(self, signum, frame):
+        "Stops every worker (they finish the requests they're serving first)."
+        self._stopping = True
+        for pid in list(self.workers):
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
@@ -0,0 +1,177 @@
+"""
+File: sharding.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Splits the ranking of very large databases across a pool of worker processes (shards).
+
+Once the prediction database is too large for one core to rank within the latency budget, ShardedSearch partitions
+its rows into contiguous ranges, one per shard process. Each shard memory-maps the prediction store itself (see
+prediction_store.py), so the rows are never copied between processes, and ranks only its own range.
+
+The default algorithm z-scores each similarity over the whole database, so a shard can't pick its top images on its
+own. Each search is a two-step scatter-gather instead:
+1. Every shard computes the stage and locations similarities of its rows, and returns their partial sums: the count,
+sum and sum of squares of each similarity. The coordinator combines them into the mean and standard deviation of
+each similarity over the whole database.
+2. Every shard scores its rows with the resulting global z-score weights, and returns its local top n (rows and
+scores). The coordinator merges them into the global top n.
+
+The result is the ranking a single process would produce (see RankingEngine.top_n in ranking.py), except where
+rounding differences in the z-score statistics (which the shards sum in float64) reorder images whose scores are
+practically tied. When new
+predictions are published, `sync` spreads the rows evenly over the shards again, so appended rows don't all land on
+the last shard.
+"""
+
+## Libraries
+import multiprocessing
+import threading
+from typing import List, Tuple
+import numpy as np
+import torch
+from prediction_store import read_manifest, load_snapshot
+from ranking import RankingEngine, is_constant
+
+## Objects
+class ShardedSearch():
+    """
+    Ranks the prediction store in `store_dir` across `num_shards` worker processes.
+
+    Arguments:
+    - store_dir: the directory containing the prediction store
+    - num_shards: the number of shard processes
+    - threads_per_shard: the number of threads torch uses in each shard
+    - start_method: how the shard processes are started (see multiprocessing). "fork" starts them quickly, without
+    re-importing the main script, but should be used before the process starts any threads (e.g. at startup, as
+    `search.warm_up` does); "spawn" is safe at any time, but slower.
+
+    One search runs at a time (concurrent callers wait their turn); each search is spread over every shard. Call
+    `close` to stop the shards. If a shard process dies, the search raises EOFError or OSError (e.g. BrokenPipeError),
+    and the pool is marked `broken`: every shard is stopped, and a new pool has to be started.
+    """
+    def __init__(self, store_dir:str, num_shards:int=2, threads_per_shard:int=1, start_method:str="fork"):
+        self.store_dir = store_dir
+        self.num_shards = max(1, num_shards)
+        self.version, self.count, self.ranges = None, 0, []
+        self.broken = False
+        self._lock = threading.Lock()
+        ctx = multiprocessing.get_context(start_method)
+        self._connections, self._processes = [], []
+        for _ in range(self.num_shards):
+            parent_conn, child_conn = ctx.Pipe()
+            process = ctx.Process(target=_shard_worker, args=(child_conn, threads_per_shard), daemon=True)
+            process.start()
+            self._connections.append(parent_conn)
+            self._processes.append(process)
+        self.sync()
+
+    def sync(self) -> bool:
+        """
+        Switches the shards to the current version of the prediction store if it has changed, spreading its rows
+        evenly over the shards. Returns whether the version changed.
+        """
+        with self._lock:
+            manifest = read_manifest(self.store_dir)
+            if manifest["version"] == self.version: return False
+            count = manifest["count"]
+            bounds = [count*i//self.num_shards for i in range(self.num_shards+1)]
+            ranges = list(zip(bounds[:-1], bounds[1:]))
+            self._scatter([("load", self.store_dir, manifest, start, end) for start, end in ranges])
+            self.version, self.count, self.ranges = manifest["version"], count, ranges
+            return True
+
+    def top_n(self, stage_pred, locations_pred, n:int=50, alpha:float=0.5, version:int=None) -> np.ndarray:
+        """
+        Returns the rows of the `n` database images most similar to the input embryo, from most to least similar, as
+        RankingEngine.top_n would (up to the ordering of practically tied images) for the version of the store the
+        shards have loaded (`self.version`). If `version` is given and the shards have a different version loaded,
+        returns None instead.
+        """
+        stage_pred = float(torch.as_tensor(stage_pred, dtype=torch.float32).reshape(-1)[0])
+        query = torch.as_tensor(locations_pred, dtype=torch.float32).reshape(-1).numpy()
+        n = max(0, min(n, self.count))
+        with self._lock:
+            if version is not None and version != self.version: return None
+            # 1. Partial sums of each similarity, combined into global z-score weights
+            partials = self._scatter([("similarities", stage_pred, query)]*self.num_shards)
+            stage_weight = _z_score_weight([p[0] for p in partials], alpha)
+            locations_weight = _z_score_weight([p[1] for p in partials], 1-alpha)
+            # 2. Each shard's top n with the global weights, merged
+            results = self._scatter([("top_n", stage_weight, locations_weight, n)]*self.num_shards)
+        rows = np.concatenate([rows for rows, _ in results])
+        scores = np.concatenate([scores for _, scores in results])
+        order = np.lexsort((rows, -scores))[:n]
+        return rows[order]
+
+    def _scatter(self, messages) -> list:
+        "Sends one message to each shard, and returns their replies (re-raising any shard's error)."
+        if self.broken: raise BrokenPipeError("A shard process died")
+        try:
+            for conn, message in zip(self._connections, messages):
+                conn.send(message)
+            replies = [conn.recv() for conn in self._connections]
+        except (EOFError, OSError):
+            # A shard died: the others may be part way through the search, so none of them can be used again
+            self.broken = True
+            self.close(timeout=0)
+            raise
+        for reply in replies:
+            if isinstance(reply, Exception): raise reply
+        return replies
+
+    def close(self, timeout:float=5):
+        "Stops the shard processes, killing any that haven't stopped within `timeout` seconds."
+        for conn in self._connections:
+            try:
+                conn.send(("stop",))
+            except (BrokenPipeError, OSError):
+                pass
+        for process in self._processes:
+            process.join(timeout=timeout)
+            if process.is_alive():
+                process.terminate()
+                process.join()
+
+## Functions
+def _shard_worker(conn, threads:int):
+    "Runs in a shard process: loads its range of rows, and answers the coordinator's requests."
+    torch.set_num_threads(threads)
+    engine, start, stage_sims, locations_sims = None, 0, None, None
+    while True:
+        message = conn.recv()
+        try:
+            if message[0] == "stop": return
+            elif message[0] == "load":
+                _, store_dir, manifest, start, end = message
+                snapshot = load_snapshot(store_dir, manifest)
+                engine = RankingEngine(snapshot.stages[start:end], snapshot.locations[start:end])
+                reply = None
+            elif message[0] == "similarities":
+                _, stage_pred, query = message
+                stage_sims, locations_sims = engine.similarities(stage_pred, torch.from_numpy(query))
+                reply = (_partial_sums(stage_sims), _partial_sums(locations_sims))
+            elif message[0] == "top_n":
+                _, stage_weight, locations_weight, n = message
+                # Every shard subtracts the same global means, so they can be left out when comparing scores
+                combined_sims = stage_sims*stage_weight + locations_sims*locations_weight
+                scores, rows = combined_sims.topk(min(n, len(combined_sims)), sorted=False)
+                reply = (rows.numpy() + start, scores.numpy())
+        except Exception as e:
+            reply = e
+        conn.send(reply)
+
+def _partial_sums(sims) -> Tuple[int, float, float]:
+    "Returns the count, sum and sum of squares of similarities (in float64)."
+    sims = sims.double()
+    return len(sims), sims.sum().item(), sims.dot(sims).item()
+
+def _z_score_weight(partials:List[Tuple[int, float, float]], weight:float) -> float:
+    """
+    Combines the shards' partial sums of a similarity into its standard deviation over the whole database, and
+    returns the weight its z-scores are scaled by: weight/std (0 for a constant similarity, with the same tolerance as
+    ranking.py).
+    """
+    count = sum(p[0] for p in partials)
+    total, total_sq = sum(p[1] for p in partials), sum(p[2] for p in partials)
+    if count < 2: return 0.
+    std = np.sqrt(max(0., (total_sq - total*total/count)/(count-1)))
+    return 0. if is_constant(total/count, std) else weight/std
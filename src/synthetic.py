@@ -0,0 +1,94 @@
+"""
+File: synthetic.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Purpose: Generates synthetic stand-ins for the search engine's data and models, so it can be benchmarked offline.
+
+The real prediction database and trained models aren't needed (or wanted) to measure how the search engine scales.
+This module creates objects shaped like the real ones:
+- synthetic_database: filenames, stage predictions and locations predictions for any number of images, with the
+locations width taken from data/locations.txt
+- synthetic_images: embryo-sized JPEG images (as raw bytes)
+- StandInModel: small, randomly initialised CNNs with the same inputs and outputs as the stage and locations models
+
+Everything is seeded, so results are reproducible. See run-benchmarks.py.
+"""
+
+## Libraries
+import io
+import os
+from typing import List, Tuple
+import numpy as np
+import torch
+import torch.nn as nn
+from PIL import Image
+
+## Settings
+# Stages of the embryos in Geisha span (roughly) Hamburger-Hamilton stages 1 to 45
+STAGE_RANGE = (1., 45.)
+# Size of the images in Geisha, (height, width)
+SOURCE_IMAGE_SIZE = (800, 950)
+
+## Functions
+def num_locations(locations_fn:str=None) -> int:
+    "Returns the number of anatomical locations (the width of the locations vectors), from data/locations.txt."
+    if locations_fn is None:
+        locations_fn = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "data", "locations.txt")
+    with open(locations_fn, "r") as file:
+        return sum(1 for line in file if line.strip())
+
+def synthetic_database(size:int, width:int=None, seed:int=0) -> Tuple[np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Generates (filenames, stages, locations) for `size` synthetic database images, shaped like the saved predictions:
+    filenames like "R123.GENE45.S17.001.jpg", float32 stages of shape (size, 1), and float32 locations predictions of
+    shape (size, width) which are mostly near 0 with a few locations near 1 (as after the sigmoid).
+    """
+    width = num_locations() if width is None else width
+    rng = np.random.default_rng(seed)
+    stages = rng.uniform(*STAGE_RANGE, size=(size, 1)).astype(np.float32)
+    locations = rng.beta(0.3, 6., size=(size, width)).astype(np.float32)
+    # Each embryo shows strong expression in a handful of locations
+    expressed = rng.integers(0, width, size=(size, 4))
+    locations[np.arange(size)[:, None], expressed] = rng.uniform(0.6, 1., size=(size, 4)).astype(np.float32)
+    genes = rng.integers(0, 5000, size=size)
+    filenames = np.array([f"R{i % 1000}.GENE{g}.S{int(s)}.{i // 1000:03d}.jpg"
+                          for i, (g, s) in enumerate(zip(genes, stages[:, 0]))], dtype=object)
+    return filenames, stages, locations
+
+def synthetic_images(count:int, size:Tuple[int, int]=SOURCE_IMAGE_SIZE, seed:int=0) -> List[bytes]:
+    "Generates `count` JPEG images (as raw bytes) of a pale embryo-like blob with blue stained patches."
+    rng = np.random.default_rng(seed)
+    h, w = size
+    yy, xx = np.mgrid[0:h, 0:w]
+    images = []
+    for _ in range(count):
+        image = np.full((h, w, 3), 235, dtype=np.float32)
+        cy, cx, r = rng.uniform(0.4, 0.6)*h, rng.uniform(0.4, 0.6)*w, rng.uniform(0.25, 0.4)*min(h, w)
+        embryo = ((yy-cy)**2 + (xx-cx)**2) < r**2
+        image[embryo] = (210, 190, 160)
+        for _ in range(rng.integers(1, 5)):
+            sy, sx, sr = cy + rng.uniform(-r, r)/2, cx + rng.uniform(-r, r)/2, rng.uniform(0.05, 0.15)*r*2
+            image[embryo & (((yy-sy)**2 + (xx-sx)**2) < sr**2)] = (70, 60, 140)
+        image += rng.normal(0, 6, size=image.shape)
+        buffer = io.BytesIO()
+        Image.fromarray(image.clip(0, 255).astype(np.uint8)).save(buffer, format="JPEG", quality=90)
+        images.append(buffer.getvalue())
+    return images
+
+## Objects
+class StandInModel(nn.Module):
+    """
+    A small, randomly initialised CNN that takes the same input as the trained models (a batch of normalized
+    400 x 300 images) and returns `out_features` outputs per image: 1 for a stand-in stage model, or the number of
+    locations for a stand-in locations model.
+    """
+    def __init__(self, out_features:int, seed:int=0):
+        super().__init__()
+        torch.manual_seed(seed)
+        self.body = nn.Sequential(nn.Conv2d(3, 16, 7, stride=4, padding=3), nn.ReLU(),
+                                  nn.Conv2d(16, 32, 3, stride=2, padding=1), nn.ReLU(),
+                                  nn.Conv2d(32, 64, 3, stride=2, padding=1), nn.ReLU(),
+                                  nn.AdaptiveAvgPool2d(1), nn.Flatten())
+        self.head = nn.Linear(64, out_features)
+        self.eval()
+
+    def forward(self, x): return self.head(self.body(x))
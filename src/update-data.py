@@ -15,7 +15,23 @@ Updating the image information involves these steps:
 is stored in the "last-updated" file, and new image metadata is downloaded from Geisha.
 * Generating stage and anatomical locations predictions on the new images, using the trained stage and
 locations models.
-* Updating the saved information with the new entries (and logging results)
+* Updating the saved information with the new entries (and logging results). New entries are appended to the
+prediction store (data/predictions, see prediction_store.py) and published atomically, so a running search server
+picks them up without a restart.
+
+Large backlogs of new images are streamed through the models (see pipeline.py): images are decoded by parallel
+worker processes, each decoded batch is shared by both models, and predictions are saved to the store in chunks as
+they are made. If a run is interrupted, the images already saved are skipped by the next run, which picks up where
+the last one stopped. "last-updated" is only advanced (atomically) once every new image has been saved. Images that
+couldn't be read (e.g. ones still being written) are listed in "unreadable-images", and tried again by the next run.
+After the models are retrained, regenerate every saved prediction with reindex-predictions.py instead.
+
+These optional environment variables tune the pipeline:
+- GEISHA_UPDATE_WORKERS: the number of processes decoding images (default: the number of CPUs, up to 8)
+- GEISHA_UPDATE_BATCH_SIZE: the number of images run through the models at once (default 64)
+- GEISHA_UPDATE_CHUNK_SIZE: the number of new predictions saved at a time (default 1024)
+- GEISHA_MODEL_RUNTIME: "eager" (the default) runs the fastai models as trained; "fp32", "int8" or "channels_last"
+runs that variant of the models exported by export-models.py, on the CPU (see model_export.py)
 """
 
 
@@ -23,10 +39,27 @@ from datetime import date
 import os
 import urllib
 import pandas as pd
-import pickle
 from fastai.vision import *
+from pipeline import append_new_predictions
+from model_export import load_exported_models
+from prediction_store import load_snapshot, store_exists, convert_pickle
 import sys
 
+# Pipeline settings
+num_workers = int(os.environ.get("GEISHA_UPDATE_WORKERS", min(8, os.cpu_count() or 1)))
+bs = int(os.environ.get("GEISHA_UPDATE_BATCH_SIZE", 64))
+chunk_size = int(os.environ.get("GEISHA_UPDATE_CHUNK_SIZE", 1024))
+model_runtime = os.environ.get("GEISHA_MODEL_RUNTIME", "eager")
+# Images that couldn't be read, to try again on the next run
+unreadable_images_fn = "unreadable-images"
+
+def write_atomically(fn:str, text:str):
+    "Replaces the file `fn` with `text` atomically, so it's never left partially written."
+    with open(fn + ".tmp", "w") as file:
+        file.write(text)
+        file.flush(); os.fsync(file.fileno())
+    os.replace(fn + ".tmp", fn)
+
 # Grab image home directory from command line
 if len(sys.argv) == 1:
     raise TypeError("Command line argument required specifying the directory containg embryo images")
@@ -53,69 +86,60 @@ urllib.request.urlretrieve(new_images_metadata_url, new_images_metadata_path)
 new_image_metadata = pd.read_csv(new_images_metadata_path, names = ["fname", "stage", "locations"])
 new_image_fnames = new_image_metadata.fname.values
 
-# Load existing data
-with open("../data/database-image-predictions.pkl", "rb") as inp:
-    database_image_filenames, database_image_stages, database_image_locations = pickle.load(inp)
+# Add the images that couldn't be read on the last run
+retry_fnames = []
+if os.path.exists(unreadable_images_fn):
+    with open(unreadable_images_fn, "r") as file:
+        retry_fnames = [line.strip() for line in file if line.strip()]
 
-# Remove any new images that are already saved (due to overlap in filtering) or not on disk (errors in metadata)
-images_to_remove = np.array([], dtype=object)
-for fname in new_image_fnames:
-    already_saved = fname in database_image_filenames
-    doesnt_exist = not os.path.exists(image_home_dir+fname)
-    if already_saved or doesnt_exist:
-        images_to_remove = np.append(images_to_remove, fname)
+# Load existing data (converting the legacy pickled predictions if needed)
+predictions_dir = "../data/predictions"
+if not store_exists(predictions_dir):
+    convert_pickle("../data/database-image-predictions.pkl", predictions_dir)
+database_image_filenames = load_snapshot(predictions_dir).filenames
 
-new_image_fnames = np.setdiff1d(new_image_fnames, images_to_remove)
+# Remove any new images that are already saved (due to overlap in filtering, or an interrupted previous run) or not
+# on disk (errors in metadata)
+saved_fnames = set(database_image_filenames)
+new_image_fnames = sorted({fname for fname in list(new_image_fnames) + retry_fnames
+                           if fname not in saved_fnames and os.path.exists(os.path.join(image_home_dir, fname))})
 
 # Begin update if new images exist
 if len(new_image_fnames) > 0:
 
-    # Create databunch containing new images (a bit inefficient here, but it works)
-    new_image_df = pd.DataFrame({"fname": new_image_fnames, "Label": range(len(new_image_fnames))})
-    bs = min(64, len(new_image_fnames))
-    new_image_data = (ImageList.from_df(new_image_df, path=image_home_dir)
-                  .split_none()
-                  .label_from_df(1, label_cls=FloatList)
-                  .transform(tfms=([], []), size=(400,300))
-                  .databunch(bs=bs).normalize(imagenet_stats))
     print("Calculating new predictions")
 
-    # Load models
-    stage_model = load_learner("../models/","stage-prediction-model.pkl")
-    locations_model = load_learner("../models/","locations-prediction-model.pkl")
-    locations_model.model.eval()
-    stage_model.model.eval()
-    stage_model.data = new_image_data
-    locations_model.data = new_image_data
-
-    # Run inference and get predictions
-    new_stage_preds = stage_model.get_preds(new_image_data.train_dl)
-    new_locations_preds = locations_model.get_preds(new_image_data.train_dl)
-
-    # Add new filenames, stage predictions, and locations predictions to existing ones
-    database_image_filenames = np.append(database_image_filenames, new_image_fnames)
-    database_image_stages = torch.cat((database_image_stages, new_stage_preds[0]))
-    database_image_locations = torch.cat((database_image_locations, new_locations_preds[0]))
-    assert len(new_image_fnames) == len(new_stage_preds[0])
-    assert len(new_stage_preds[0]) == len(new_locations_preds[0])
-
-    # Save results
-    def save_object(obj, filename="../data/database-image-predictions.pkl"):
-        """Saved a python object to the given file using pickle"""
-        with open(filename, 'wb') as output:  # Overwrites any existing file.
-            pickle.dump(obj, output, pickle.HIGHEST_PROTOCOL)
-        return
-    updated_database_image_information = [database_image_filenames, database_image_stages, database_image_locations]
+    # Load models (as trained, or exported with export-models.py)
+    if model_runtime == "eager":
+        stage_model = load_learner("../models/","stage-prediction-model.pkl")
+        locations_model = load_learner("../models/","locations-prediction-model.pkl")
+        locations_model.model.eval()
+        stage_model.model.eval()
+        stage_net, locations_net, device = stage_model.model, locations_model.model, defaults.device
+    else:
+        exported_models = load_exported_models("../models/", model_runtime)
+        stage_net, locations_net, device = exported_models["stage"], exported_models["locations"], None
+
+    # Run inference and get predictions, saving them a chunk at a time
     # Data is changed below here
-    save_object(updated_database_image_information)
+    image_fns = [os.path.join(image_home_dir, fname) for fname in new_image_fnames]
+    added_fnames, unreadable_fnames = append_new_predictions(
+        predictions_dir, new_image_fnames, image_fns, stage_net, locations_net, bs=bs, num_workers=num_workers,
+        device=device, chunk_size=chunk_size, on_chunk=lambda saved: print(f"Saved {saved}/{len(new_image_fnames)} images"))
 
-    # Update logs
+    # Update logs. The images that couldn't be read are saved first, so they're tried again even though last-updated
+    # has moved past them.
     current_date = date.today().strftime("%m/%d/%y")
-    with open("last-updated", "w") as file:
-        file.write(current_date)
+    write_atomically(unreadable_images_fn, "".join(fname + "\n" for fname in unreadable_fnames))
+    write_atomically("last-updated", current_date)
     with open("data-updates-log", "a") as file:
-        file.write(f"{current_date}: Added {len(new_image_fnames)} images ({' '.join(list(new_image_fnames))})\n")
-    print(f"Updated with {len(new_image_fnames)} images")
+        file.write(f"{current_date}: Added {len(added_fnames)} images ({' '.join(added_fnames)})\n")
+        if unreadable_fnames:
+            file.write(f"{current_date}: Skipped {len(unreadable_fnames)} unreadable images, to try again next run "
+                       f"({' '.join(unreadable_fnames)})\n")
+    print(f"Updated with {len(added_fnames)} images")
 
 else:
+    # Any images left to try again were saved, or are gone
+    if retry_fnames: write_atomically(unreadable_images_fn, "")
     print("Data already up to date")
\ No newline at end of file
@@ -0,0 +1,75 @@
+"""
+File: validate-models.py
+Author: Daniel Lee <danielslee@email.arizona.edu>
+Description: Checks how closely the exported models (see export-models.py) match the trained models.
+
+A sample of database images is run through the trained (eager) models and through each exported variant. For each
+variant, this reports:
+- drift: the largest and mean absolute difference from the trained models' stage and locations predictions
+- overlap: the mean fraction of the top n search results (ranking the saved predictions, as in embryo_similarity)
+that stay the same when the input embryo's features come from the variant instead of the trained models
+- ms/image: the time each variant takes to predict on a batch, per image
+
+Example Script Usage:
+python src/validate-models.py /home/geisha/images # Validate every exported variant on 64 database images
+python src/validate-models.py /home/geisha/images --variants int8 --count 256 --n 20
+"""
+
+import argparse
+import os
+import random
+import time
+import torch
+from fastai.vision import load_learner
+from model_export import VARIANTS, MODEL_FNS, load_exported_models, exported_model_path, prediction_drift, \
+    top_n_overlap
+from prediction_store import load_snapshot
+from preprocess import ImagePreprocessor
+
+def predict(models, xb, repeats:int=3):
+    "Returns (stage predictions, locations predictions, ms per image) for a batch, timing the best of `repeats` runs."
+    best = float("inf")
+    for _ in range(repeats):
+        start = time.perf_counter()
+        with torch.no_grad():
+            stage_preds, locations_preds = models["stage"](xb), models["locations"](xb).sigmoid()
+        best = min(best, time.perf_counter() - start)
+    return stage_preds, locations_preds, best*1000/len(xb)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare the exported models with the trained models.")
+    parser.add_argument("image_home_dir", help="the directory containing the database images")
+    parser.add_argument("--variants", nargs="+", default=None, help="variants to validate (default: all exported)")
+    parser.add_argument("--count", type=int, default=64, help="number of database images to predict on")
+    parser.add_argument("--n", type=int, default=50, help="number of search results compared")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    # Change working directory to src/
+    os.chdir(os.path.dirname(os.path.abspath(__file__)))
+    variants = args.variants or [v for v in VARIANTS if os.path.exists(exported_model_path("../models", "stage", v))]
+    if not variants: raise FileNotFoundError("No exported models found: run export-models.py first")
+
+    # Sample database images that are available locally
+    snapshot = load_snapshot("../data/predictions")
+    fnames = [fn for fn in snapshot.filenames if os.path.exists(os.path.join(args.image_home_dir, fn))]
+    fnames = random.Random(args.seed).sample(fnames, min(args.count, len(fnames)))
+    if not fnames: raise FileNotFoundError(f"No database images found in {args.image_home_dir}")
+    preprocessor = ImagePreprocessor()
+    xb = preprocessor.batch([os.path.join(args.image_home_dir, fn) for fn in fnames])
+
+    # Reference: the trained models
+    eager = {name: load_learner("../models/", model_fn).model.cpu().eval() for name, model_fn in MODEL_FNS.items()}
+    reference = predict(eager, xb)
+    print(f"Validating on {len(fnames)} images, top {args.n} results out of {snapshot.count}\n")
+    print(f"{'variant':<16}{'stage max':>11}{'stage mean':>12}{'locs max':>11}{'locs mean':>11}{'overlap':>9}"
+          f"{'ms/image':>10}")
+    print(f"{'eager':<16}{'':>11}{'':>12}{'':>11}{'':>11}{'':>9}{reference[2]:>10.2f}")
+    for variant in variants:
+        stage_preds, locations_preds, ms = predict(load_exported_models("../models", variant), xb)
+        stage_drift = prediction_drift(reference[0], stage_preds)
+        locations_drift = prediction_drift(reference[1], locations_preds)
+        overlap = top_n_overlap(snapshot.stages, snapshot.locations, reference[:2], (stage_preds, locations_preds),
+                                n=args.n)
+        print(f"{variant:<16}{stage_drift['max_abs']:>11.2e}{stage_drift['mean_abs']:>12.2e}"
+              f"{locations_drift['max_abs']:>11.2e}{locations_drift['mean_abs']:>11.2e}{overlap:>9.1%}{ms:>10.2f}")